@@ -1,20 +1,137 @@
+import io
 import os
-import re
+import threading
 
 from flask import request
 from lxml import etree
 from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
+from .metrics import timed
+from . import compression, layout, layout_index, rules
+from .rules import WHITESPACE_SPLITTER
+
+# Namespace of ABBYY FineReader 10 xml documents
+NAMESPACE = 'http://www.abbyy.com/FineReader_xml/FineReader10-schema-v1.xml'
+
+# XPath expressions used by the dom mode, `n` is bound to the document namespace
+# and `$bound` to the left position of the anchor <line>
+XPATH_EXPRESSIONS = {
+    'plaintiff_line': './/n:line[n:formatting[starts-with(text(), "Plaintiff,")]]',
+    'plaintiff_formatting': ".//n:formatting["
+                            "(preceding::n:formatting[contains(text(), 'COUNTY OF')])"
+                            " and "
+                            "(following::n:formatting[starts-with(text(), 'Plaintiff,')])"
+                            " and "
+                            "(ancestor::n:line[(@l < $bound)])]",
+    'defendants_line': './/n:line[n:formatting[starts-with(text(), "Defendants")]]',
+    'defendants_formatting': ".//n:formatting["
+                             "(preceding::n:formatting[starts-with(text(), 'Plaintiff,')])"
+                             " and "
+                             "(following::n:formatting[starts-with(text(), 'Defendants.')])"
+                             " and "
+                             "(ancestor::n:line[(@l < $bound)])]",
+}
+
+# Compiled etree.XPath objects per namespace. lxml serialises calls on one XPath object with a lock,
+# so each thread keeps its own compiled set instead of contending for a shared one.
+_compiled_xpaths = threading.local()
+
+def compiled_xpaths(namespace):
+    """Return a dict of the XPATH_EXPRESSIONS compiled as etree.XPath objects for a namespace
+    
+    Expressions are compiled once per namespace and thread and reused by every XmlParser.
+    
+    :param namespace: xml document namespace
+    """
+    registry = getattr(_compiled_xpaths, 'registry', None)
+    if registry is None:
+        registry = _compiled_xpaths.registry = {}
+
+    xpaths = registry.get(namespace)
+    if xpaths is None:
+        xpaths = registry[namespace] = {
+            name: etree.XPath(expression, namespaces={'n': namespace})
+            for name, expression in XPATH_EXPRESSIONS.items()
+        }
+
+    return xpaths
+
+def precompile(mode, fields=None, namespace=NAMESPACE):
+    """Compile the state XmlParser reuses across documents in an extraction mode, for the current thread
+    
+    :param mode: extraction mode, one of XmlParser.MODES
+    :param fields: names of the rules.RULES to compile (default: None, rules.DEFAULT_FIELDS)
+    :param namespace: xml document namespace of the 'dom' mode XPath expressions (default: NAMESPACE)
+    """
+    if mode not in XmlParser.MODES:
+        raise ValueError('Invalid extraction mode: {}'.format(mode))
+
+    # Every mode compiles its rules when a parser is created, only 'dom' evaluates the XPath expressions
+    rules.compile_rules(fields if fields is not None else rules.DEFAULT_FIELDS)
+    if mode == 'dom':
+        compiled_xpaths(namespace)
+
+def _line_left(line_elem):
+    """Return the numeric left position (@l) of a <line> element, or None if it has none"""
+    try:
+        return float(line_elem.get('l'))
+    except (TypeError, ValueError):
+        return None
+
+def _left_of(candidates, right_bound):
+    """Return the texts of (left, text) candidates positioned to the left of right_bound"""
+    if right_bound is None:
+        return []
+    return [text for left, text in candidates if left is not None and left < right_bound]
+
+def _left_column_text(text):
+    """Strip out any text followed by 2 or more whitespaces (the right side of the document)"""
+    return WHITESPACE_SPLITTER.split(text, 1)[0]
 
 class XmlParser:
     """A parser to extract plaintiff and defendant texts from a Legalmation xml file
     
     :param xml_file: <werkzeug.datastructures.FileStorage> object
     :param xml_namespace: namespace prefix used in xml document (default: 'http://www.abbyy.com/FineReader_xml/FineReader10-schema-v1.xml')
+    :param mode: extraction mode, one of XmlParser.MODES (default: 'paged')
+        'paged' builds one <page> at a time with etree.iterparse and stops once every required field is found
+        'geometric' reads pages like 'paged' and selects the caption from numpy arrays of <line> coordinates (requires numpy)
+        'index' loads the whole document and walks its <formatting> elements once, indexing the anchors
+        'dom' loads the whole document and runs the preceding::/following:: XPath queries against it
+        'stream' walks the document with etree.iterparse and stops reading once every required field is found
+    :param page_budget: maximum number of <page> elements the 'paged' and 'geometric' modes read (default: None, no limit)
+    :param fields: names of the rules.RULES to extract, fields other than plaintiff and defendants
+        need the 'paged' or 'stream' mode (default: rules.DEFAULT_FIELDS)
+    :param record_layout: keep a layout_index of the last layout_index.MAX_PAGES pages read in self.layout, or None
+        when those pages do not give the same fields, 'paged' mode only (default: False)
+    :param max_size: maximum decompressed size in bytes of .xml.gz / .xml.zst files, larger ones raise
+        compression.DecompressedSizeError (default: None, no limit)
     """
-    def __init__(self, xml_file,  xml_namespace='http://www.abbyy.com/FineReader_xml/FineReader10-schema-v1.xml'):
+    MODES = ('paged', 'geometric', 'index', 'dom', 'stream')
+    # Modes evaluating the compiled rules.RULES
+    RULE_MODES = ('paged', 'stream')
+
+    def __init__(self, xml_file,  xml_namespace=NAMESPACE, mode='paged', page_budget=None, fields=None,
+                 record_layout=False, max_size=None):
+        if mode not in self.MODES:
+            raise ValueError('Invalid extraction mode: {}'.format(mode))
+        fields = tuple(fields) if fields is not None else rules.DEFAULT_FIELDS
+        compiled_rules = rules.compile_rules(fields)
+        if mode not in self.RULE_MODES and fields != rules.DEFAULT_FIELDS:
+            raise ValueError("The '{}' extraction mode only extracts {}".format(mode, ' and '.join(rules.DEFAULT_FIELDS)))
+        if mode == 'geometric' and layout.np is None:
+            raise ValueError("The 'geometric' extraction mode requires numpy")
+
         if self.__validate_xml_file(xml_file):
             self.namespace = xml_namespace
+            self.mode = mode
+            self.page_budget = page_budget
+            self.pages_read = None
+            self.fields = fields
+            self.__rules = compiled_rules
+            self.record_layout = record_layout
+            self.layout = None
+            self.max_size = max_size
             
             # etree
             self.xml_file = xml_file
@@ -26,82 +143,272 @@ class XmlParser:
         else:
             raise IOError('Invalid xml file')
 
-    def __xpath(self, element, xpath, namespace_key='n'):
-        """Helper function to execute etree.Element.xpath w/ namespace prefix
-        
-        :param element: <etree.Element> object
-        :param xpath: xpath string
-        :param namespace_key: <etree.Element> namespace map key (default: 'n')
-        """
-        namespace = {}
-        namespace[namespace_key] = self.namespace
-
-        return element.xpath(xpath, namespaces=namespace)
-
     def __parse_plaintiff_text(self):
         """Parse and return plaintiff text"""
         
+        xpaths = compiled_xpaths(self.namespace)
+        
         # Find the <line> elements where its child <formatting> element has text that starts with 'Plaintiff,'
-        plaintiff_line_elem = self.__xpath(self.__root, './/n:line[n:formatting[starts-with(text(), "Plaintiff,")]]')
+        plaintiff_line_elem = xpaths['plaintiff_line'](self.__root)
         plaintiff_right_bound = plaintiff_line_elem[0].get('l')
         
         # Find all <formatting> elements in between the 'COUNTY OF' and 'Plaintiff' elements
         # Also only find formatting texts that are positioned to the left of the 'Plaintiff,' <line>
-        plaintiff_formatting_elems = self.__xpath(self.__root, 
-                        ".//n:formatting[" \
-                        "(preceding::n:formatting[contains(text(), 'COUNTY OF')])" \
-                        " and " \
-                        "(following::n:formatting[starts-with(text(), 'Plaintiff,')])" \
-                        " and " \
-                        "(ancestor::n:line[(@l < %s)])]" % (plaintiff_right_bound))
+        plaintiff_formatting_elems = xpaths['plaintiff_formatting'](self.__root, bound=plaintiff_right_bound)
 
         # Iterate through all found <formatting> elements and strip out any text followed by 2 or more whitespaces
         # This is needed to exclude all text found on the right side of the document that should NOT be parsed
-        return ' '.join(map(lambda elem: re.split('\s{2}', elem.text)[0], plaintiff_formatting_elems))
+        return ' '.join(map(lambda elem: _left_column_text(elem.text), plaintiff_formatting_elems))
 
     def __parse_defendants_text(self):
         """Parse and return defendants text"""
         
+        xpaths = compiled_xpaths(self.namespace)
+        
         # Find the <line> elements where its child <formatting> element has text that starts with 'Defendants.'
-        defendants_line_elem = self.__xpath(self.__root, './/n:line[n:formatting[starts-with(text(), "Defendants")]]')
+        defendants_line_elem = xpaths['defendants_line'](self.__root)
         defendants_right_bound = defendants_line_elem[0].get('l')
         
         # Find all <formatting> elements in between the 'Plaintiff,' and 'Defendants.' elements
         # Also only find formatting texts that are positioned to the left of the 'Defendants.' <line>
-        defendants_formatting_elems = self.__xpath(self.__root,
-                        ".//n:formatting[" \
-                        "(preceding::n:formatting[starts-with(text(), 'Plaintiff,')])" \
-                        " and " \
-                        "(following::n:formatting[starts-with(text(), 'Defendants.')])" \
-                        " and " \
-                        "(ancestor::n:line[(@l < %s)])]" % (defendants_right_bound))
+        defendants_formatting_elems = xpaths['defendants_formatting'](self.__root, bound=defendants_right_bound)
         
         # Iterate through all found <formatting> elements and strip out any text followed by 2 or more whitespaces
         # This is needed to exclude all text found on the right side of the document that should NOT be parsed
         # We also exclude the first found <formatting> element as this will always be the 'vs.' or 'v.' text
-        return ' '.join(map(lambda elem: re.split('\s{2}', elem.text)[0], defendants_formatting_elems[1:]))
-    
+        return ' '.join(map(lambda elem: _left_column_text(elem.text), defendants_formatting_elems[1:]))
+
+    def __index_texts(self):
+        """Parse plaintiff and defendants text from one ordered walk over the <formatting> elements
+        
+        Gives the same result as the dom mode XPath queries in linear time:
+            plaintiff: elements after the first 'COUNTY OF' and before the last 'Plaintiff,'
+            defendants: elements after the first 'Plaintiff,' and before the last 'Defendants.'
+        Both are bounded by the left position of the first 'Plaintiff,' / 'Defendants' <line>.
+        """
+        entries = []
+        first_county = first_plaintiff = last_plaintiff = last_defendants = None
+        plaintiff_right_bound = defendants_right_bound = None
+
+        for index, elem in enumerate(self.__root.iter('{%s}formatting' % self.namespace)):
+            text = elem.text or ''
+            left = _line_left(elem.getparent())
+            entries.append((left, text))
+
+            if first_county is None and 'COUNTY OF' in text:
+                first_county = index
+            if text.startswith('Plaintiff,'):
+                if first_plaintiff is None:
+                    first_plaintiff = index
+                    plaintiff_right_bound = left
+                last_plaintiff = index
+            if text.startswith('Defendants'):
+                if defendants_right_bound is None:
+                    defendants_right_bound = left
+                if text.startswith('Defendants.'):
+                    last_defendants = index
+
+        plaintiff_texts = []
+        if first_county is not None and last_plaintiff is not None:
+            plaintiff_texts = _left_of(entries[first_county + 1:last_plaintiff], plaintiff_right_bound)
+
+        defendants_texts = []
+        if first_plaintiff is not None and last_defendants is not None:
+            # Same as the dom mode, the first defendants element is always the 'vs.' or 'v.' text
+            defendants_texts = _left_of(entries[first_plaintiff + 1:last_defendants], defendants_right_bound)[1:]
+
+        return ' '.join(map(_left_column_text, plaintiff_texts)), ' '.join(map(_left_column_text, defendants_texts))
+
+    def __stream_texts(self):
+        """Extract every field in a single streaming pass
+        
+        Feeds every <formatting> element to a rules.RuleMatcher as it is parsed.
+        Elements are cleared once they are read.
+        """
+        formatting_tag = '{%s}formatting' % self.namespace
+        line_tag = '{%s}line' % self.namespace
+        block_tag = '{%s}block' % self.namespace
+
+        matcher = self.__rules.matcher()
+
+        source = self.__source()
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+
+        context = etree.iterparse(source, events=('end',), tag=(formatting_tag, line_tag, block_tag))
+
+        for event, elem in context:
+            if elem.tag == formatting_tag:
+                line = elem.getparent()
+                if matcher.feed(line, _line_left(line), elem.text or ''):
+                    break
+            elif elem.tag == line_tag:
+                elem.clear()
+            else:
+                # Drop finished <block> elements (and their emptied lines) so memory stays flat
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+        del context
+
+        return matcher.results()
+
+    def __iter_pages(self):
+        """Yield the <page> elements one at a time with etree.iterparse
+        
+        Each page is dropped once the caller asks for the next one, so only one page is held in
+        memory at a time. Stops after self.page_budget pages and counts the pages read in self.pages_read.
+        """
+        page_tag = '{%s}page' % self.namespace
+        self.pages_read = 0
+
+        source = self.__source()
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+
+        context = etree.iterparse(source, events=('end',), tag=page_tag)
+
+        for event, page in context:
+            self.pages_read += 1
+            yield page
+
+            page.clear()
+            while page.getprevious() is not None:
+                del page.getparent()[0]
+
+            if self.page_budget and self.pages_read >= self.page_budget:
+                break
+
+        del context
+
+    def __paged_texts(self):
+        """Extract every field one <page> at a time
+        
+        Feeds the <formatting> elements of each page to a rules.RuleMatcher and stops reading once
+        every required field is found or the page budget is spent, whichever comes first.
+        """
+        line_tag = '{%s}line' % self.namespace
+        formatting_tag = '{%s}formatting' % self.namespace
+        matcher = self.__rules.matcher()
+        recorder = layout_index.LayoutRecorder(layout_index.MAX_PAGES) if self.record_layout else None
+
+        for page in self.__iter_pages():
+            if recorder is not None:
+                recorder.add_page(page, line_tag, formatting_tag)
+
+            for elem in page.iter(formatting_tag):
+                line = elem.getparent()
+                if matcher.feed(line, _line_left(line), elem.text or ''):
+                    break
+
+            if matcher.done:
+                break
+
+        results = matcher.results()
+
+        if recorder is not None:
+            self.layout = recorder.dumps()
+            # A zone may have opened on a page that was dropped, re-extracting such an index would change the fields
+            if recorder.pages_dropped and layout_index.LayoutIndex(self.layout).extract(self.fields) != results:
+                self.layout = None
+
+        return results
+
+    def __geometric_texts(self):
+        """Parse plaintiff and defendants text from the <line> coordinates of the caption pages
+        
+        Pages are read like in the paged mode and loaded into a layout.CaptionLayout until both
+        anchors are found. Zones and the left column are selected with vectorised comparisons.
+        """
+        line_tag = '{%s}line' % self.namespace
+        formatting_tag = '{%s}formatting' % self.namespace
+        caption = layout.CaptionLayout()
+
+        for page in self.__iter_pages():
+            caption.add_page(page, line_tag, formatting_tag)
+
+            if caption.resolved:
+                break
+
+        plaintiff_texts, defendants_texts = caption.zone_texts()
+
+        return ' '.join(map(_left_column_text, plaintiff_texts)), ' '.join(map(_left_column_text, defendants_texts))
+
     def extract(self):
         """Executes all private parse functions and return object map"""
         
-        self.__tree = etree.parse(self.xml_file)
-        self.__root = self.__tree.getroot()
-        
-        self.__parsed_texts['defendants'] = self.__parse_defendants_text()
-        self.__parsed_texts['plaintiff'] = self.__parse_plaintiff_text()
+        if self.mode == 'paged':
+            with timed('parse.paged'):
+                self.__parsed_texts.update(self.__paged_texts())
+        elif self.mode == 'stream':
+            with timed('parse.stream'):
+                self.__parsed_texts.update(self.__stream_texts())
+        elif self.mode == 'geometric':
+            with timed('parse.geometric'):
+                plaintiff, defendants = self.__geometric_texts()
+
+            self.__parsed_texts['defendants'] = defendants
+            self.__parsed_texts['plaintiff'] = plaintiff
+        else:
+            with timed('parse.load'):
+                source = self.__source()
+                if isinstance(source, bytes):
+                    self.__root = etree.fromstring(source)
+                    self.__tree = self.__root.getroottree()
+                else:
+                    self.__tree = etree.parse(source)
+                    self.__root = self.__tree.getroot()
+            
+            if self.mode == 'index':
+                with timed('parse.index'):
+                    plaintiff, defendants = self.__index_texts()
+
+                self.__parsed_texts['defendants'] = defendants
+                self.__parsed_texts['plaintiff'] = plaintiff
+            else:
+                with timed('parse.defendants'):
+                    self.__parsed_texts['defendants'] = self.__parse_defendants_text()
+                with timed('parse.plaintiff'):
+                    self.__parsed_texts['plaintiff'] = self.__parse_plaintiff_text()
         
         return self.get_parsed_texts()
     
+    def __source(self):
+        """Return what lxml should read, avoiding copies through Python file objects
+        
+        In-memory uploads are returned as bytes and uploads spooled to a file on disk as its filename,
+        so libxml2 reads them natively. Compressed files are returned as a compression.DecompressingReader
+        lxml pulls decompressed chunks from. Anything else is returned as the file object.
+        """
+        stream = getattr(self.xml_file, 'stream', self.xml_file)
+
+        encoding = compression.file_compression(getattr(self.xml_file, 'filename', None))
+        if encoding is not None:
+            return compression.DecompressingReader(stream, encoding, self.max_size)
+
+        if isinstance(stream, io.BytesIO):
+            return stream.getvalue()
+
+        name = getattr(stream, 'name', None)
+        if isinstance(name, str) and os.path.isfile(name):
+            stream.flush()
+            return name
+
+        return self.xml_file
+
     def get_parsed_texts(self):
         return self.__parsed_texts.copy()
 
     def __validate_xml_file(self, xml_file):
         """Returns True if valid correct xml file extension is used
         
+        .xml.gz files are accepted, .xml.zst files when zstandard is installed (see compression.XML_EXTENSIONS)
+        
         :param xml_file - <werkzeug.datastructures.FileStorage> object
         """
         if isinstance(xml_file, FileStorage):
-            filename = xml_file.filename
-            return '.' in filename and filename.rsplit('.', 1)[1].lower() == 'xml'
+            filename = (xml_file.filename or '').lower()
+            return filename.endswith(compression.XML_EXTENSIONS) and compression.available(compression.file_compression(filename))
         else:
             raise TypeError("Invalid FileStorage object")
\ No newline at end of file
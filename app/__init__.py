@@ -1,20 +1,121 @@
 """NOTE: Application Setup and Project Layout is copied from http://flask.pocoo.org/docs/1.0/tutorial/"""
 
+import hashlib
+import heapq
+import itertools
+import json
 import os
+from operator import itemgetter
+import tarfile
+import zipfile
 
-from flask import Flask, request, flash, redirect, make_response, jsonify, abort
-from flask_restplus import Resource, Api, fields
+from flask import Flask, Response, current_app, request, flash, redirect, make_response, jsonify, abort, stream_with_context
+from flask_restplus import Resource, Api, fields, inputs, marshal
 from .LegalMation import XmlParser
+from .cache import LRUCache, hash_bytes, hash_file
+from .batch import extract_files, read_batch_files
+from .ingest import IngestQueue, find_job_by_id, upload_size
+from .writer import GroupCommitWriter
 from werkzeug.datastructures import FileStorage
+from werkzeug.http import quote_etag
 from lxml import etree
-from . import db
+from .metrics import timed
+from .layout_index import LayoutIndex
+from .uploads import UploadRequest
+from . import serializers
+from . import admission, compression, db, metrics
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
+    app.request_class = UploadRequest
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'app-db.sqlite'),
+        # Number of SQLite files the documents are spread over, each with its own write lock. With more than 1,
+        # documents move from DATABASE to files next to it, see db.shard_paths and `flask migrate-shards`
+        DB_SHARDS=1,
+        # Reject request bodies larger than this many bytes with 413 before buffering them, also the maximum
+        # decompressed size of Content-Encoding request bodies and .xml.gz / .xml.zst uploads
+        MAX_CONTENT_LENGTH=64 * 1024 * 1024,
+        # Uploads larger than this many bytes are spooled to a named file in UPLOAD_SPOOL_DIR
+        # (None uses the system temporary directory), smaller ones are parsed from memory
+        UPLOAD_SPOOL_THRESHOLD=512 * 1024,
+        UPLOAD_SPOOL_DIR=None,
+        # XmlParser extraction mode, see XmlParser.MODES
+        XML_PARSER_MODE='paged',
+        # Maximum number of <page> elements the 'paged' and 'geometric' modes read looking for the caption (None reads until found)
+        XML_PARSER_PAGE_BUDGET=None,
+        # Store a compressed layout_index of the caption pages of each extracted upload, so documents can be
+        # re-extracted without their xml (recorded by the 'paged' mode only, from the last
+        # layout_index.MAX_PAGES pages read)
+        LAYOUT_INDEX=True,
+        # What to do when an upload's content hash matches an already extracted document:
+        # 'insert' inserts a new row reusing the cached fields, 'existing' returns the existing document
+        UPLOAD_DEDUPLICATION='insert',
+        # Number of extraction results kept in the in-process LRU in front of SQLite (0 disables it)
+        EXTRACTION_CACHE_SIZE=1024,
+        # Number of serialized GET /documents/<id> bodies kept in the in-process LRU (0 disables it)
+        DOCUMENT_RESPONSE_CACHE_SIZE=4096,
+        # Serialize GET /documents/ and /documents/<id> straight from the rows instead of through
+        # flask-restplus marshalling, see serializers.py
+        FAST_SERIALIZER=False,
+        # Cache-Control max-age in seconds of GET /documents/<id>, documents only change when re-extracted
+        DOCUMENT_CACHE_MAX_AGE=3600,
+        # Cache-Control max-age in seconds of the documents with a layout index, which `flask reextract` may change
+        DOCUMENT_LAYOUT_CACHE_MAX_AGE=60,
+        # Number of worker processes used by /documents/batch (None uses the number of CPUs, 0 parses in-process)
+        BATCH_MAX_WORKERS=None,
+        # Accept uploads with 202 and extract them in background workers, see ingest.IngestQueue
+        INGEST_ASYNC=False,
+        # Uploads smaller than this many bytes are still extracted synchronously in async mode
+        INGEST_SYNC_THRESHOLD=256 * 1024,
+        INGEST_SPOOL_DIR=os.path.join(app.instance_path, 'spool'),
+        INGEST_WORKERS=2,
+        # Seconds an idle worker waits before checking the job table again
+        INGEST_POLL_INTERVAL=1.0,
+        # Seconds after which a running job is considered abandoned by a crashed process and queued
+        # again when the workers start (None never requeues them)
+        INGEST_STALE_JOB_TIMEOUT=600,
+        # Queue single document inserts and commit them in groups, see writer.GroupCommitWriter
+        INSERT_GROUP_COMMIT=False,
+        INSERT_GROUP_MAX_ROWS=64,
+        INSERT_GROUP_MAX_DELAY_MS=5,
+        # Return the stage timings of each request in a Server-Timing header, see metrics.timed
+        METRICS_STAGE_HEADER=False,
+        # SQLite connection pool, see db.ConnectionPool
+        # Number of idle connections kept per process (0 closes every connection after its request)
+        DB_POOL_SIZE=8,
+        DB_JOURNAL_MODE='WAL',
+        DB_SYNCHRONOUS='NORMAL',
+        # Page cache size, negative values are in KiB
+        DB_CACHE_SIZE=-16000,
+        # Bytes of the database file to memory-map
+        DB_MMAP_SIZE=256 * 1024 * 1024,
+        # Milliseconds to wait for a locked database
+        DB_BUSY_TIMEOUT=5000,
+        # Production server (`lm-server`), see server.server_options
+        SERVER_BIND='127.0.0.1:8000',
+        # Number of worker processes (0 uses 2 * CPUs + 1) and request threads per worker
+        SERVER_WORKERS=0,
+        SERVER_THREADS=1,
+        # Seconds before a silent worker is restarted, and seconds workers get to finish on a graceful restart
+        SERVER_TIMEOUT=30,
+        SERVER_GRACEFUL_TIMEOUT=30,
+        # Gracefully restart each worker after this many requests, plus up to the jitter (0 disables it)
+        SERVER_MAX_REQUESTS=0,
+        SERVER_MAX_REQUESTS_JITTER=0,
+        # Gzip json responses of at least this many bytes for clients accepting it, streamed lists are
+        # always compressed (None disables it), see compression.compress_response
+        RESPONSE_COMPRESSION_MIN_SIZE=1024,
+        RESPONSE_COMPRESSION_LEVEL=6,
+        # Admission control of the upload endpoints, see admission.AdmissionController
+        # Request body bytes parsed at once per process (None disables admission control)
+        PARSE_CAPACITY=32 * 1024 * 1024,
+        # Uploads waiting for capacity, more are rejected with 429 and a Retry-After
+        PARSE_QUEUE_SIZE=16,
+        # Seconds an upload waits for capacity before it is rejected with 429 (None waits until admitted)
+        PARSE_QUEUE_TIMEOUT=10,
     )
     if test_config is None:
         # load the instance config, if it exists, when not testing
@@ -33,6 +134,14 @@ def create_app(test_config=None):
         pass
 
     db.init_app(app)
+    metrics.init_app(app)
+    compression.init_app(app)
+    admission.init_app(app)
+    
+    app.extensions['extraction_cache'] = LRUCache(app.config['EXTRACTION_CACHE_SIZE'])
+    app.extensions['document_response_cache'] = LRUCache(app.config['DOCUMENT_RESPONSE_CACHE_SIZE'])
+    app.extensions['ingest_queue'] = IngestQueue(app, ingest_spooled_file)
+    app.extensions['group_commit_writer'] = GroupCommitWriter(app)
     
     # Fields for swagger
     document_api = api.model('Document', {
@@ -42,21 +151,127 @@ def create_app(test_config=None):
         'defendants': fields.String(required=True, description='The extracted defendants text')
     })
     
+    job_api = api.model('Job', {
+        'id': fields.Integer(readOnly=True, description='The ingest job unique identifier'),
+        'filename': fields.String(required=True, description='The uploaded filename'),
+        'status': fields.String(description='One of queued, running, done or failed'),
+        'document_id': fields.Integer(description='The extracted document identifier once done'),
+        'error': fields.String(description='Why the extraction failed'),
+        'created': fields.DateTime(description='When the upload was accepted'),
+        'updated': fields.DateTime(description='When the status last changed')
+    })
+    
+    batch_result_api = api.model('BatchResult', {
+        'filename': fields.String(required=True, description='The uploaded filename'),
+        'document': fields.Nested(document_api, allow_null=True, description='The inserted document'),
+        'error': fields.String(description='Why the file could not be processed')
+    })
+    
     upload_parser = api.parser()
     upload_parser.add_argument('file', location='files', type=FileStorage, required=True)
     
+    search_result_api = api.inherit('SearchResult', document_api, {
+        'rank': fields.Float(description='The bm25 relevance of the match, lower is more relevant')
+    })
+    
+    search_parser = api.parser()
+    search_parser.add_argument('q', type=str, location='args', required=True, help='Words to find in the parties')
+    search_parser.add_argument('field', type=str, location='args', choices=SEARCH_FIELDS,
+                               help='Only search the plaintiff or the defendants text')
+    search_parser.add_argument('limit', type=inputs.int_range(1, 100), location='args', default=20,
+                               help='Maximum number of documents to list (default: 20)')
+    search_parser.add_argument('offset', type=inputs.natural, location='args', default=0,
+                               help='Number of ranked documents to skip')
+    
+    list_parser = api.parser()
+    list_parser.add_argument('after_id', type=int, location='args', help='Only list documents with a greater id')
+    list_parser.add_argument('limit', type=inputs.positive, location='args', help='Maximum number of documents to list')
+    list_parser.add_argument('fields', type=str, location='args',
+                             help='Comma separated document fields to list, e.g. id,filename (id is always included)')
+    list_parser.add_argument('stream', type=inputs.boolean, location='args', default=False,
+                             help='Stream newline delimited json (also selected by Accept: application/x-ndjson)')
+    
+    batch_parser = api.parser()
+    batch_parser.add_argument('files', location='files', type=FileStorage, required=True, action='append',
+                              help='xml files, or a single zip/tar archive of xml files')
+    
     ''' ROUTES '''
     
     @ns.route('/')
     class DocumentList(Resource):
         
         @ns.doc('list_documents')
-        @ns.marshal_list_with(document_api)
+        @ns.expect(list_parser)
+        @ns.response(200, 'Success', [document_api])
+        @ns.response(400, 'Invalid fields')
         def get(self):
             '''List all documents'''
             
-            all_documents = find_documents()
-            return [dict(row) for row in all_documents]
+            args = list_parser.parse_args()
+            
+            columns = None
+            if args['fields']:
+                columns = [column.strip() for column in args['fields'].split(',') if column.strip()]
+            
+            stream = args['stream'] or request.accept_mimetypes.best == 'application/x-ndjson'
+            
+            # The list only changes when documents are inserted or re-extracted, so its ETag is the collection version
+            # plus everything that selects or formats the page
+            etag = hashlib.sha1('{}:{}:{}'.format(
+                documents_version(), request.query_string.decode('latin-1'), stream).encode('utf8')).hexdigest()
+            # Weak comparison, compressed responses carry the weak form of the ETag
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag, 'no-cache')
+            
+            try:
+                documents = find_documents(after_id=args['after_id'], limit=args['limit'], columns=columns)
+            except ValueError as e:
+                api.abort(400, str(e))
+            
+            if stream:
+                # Write one json document per line straight from the cursor
+                def generate():
+                    for row in documents:
+                        yield serializers.dumps(dict(row)) + b'\n'
+                
+                response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+                response.set_etag(etag)
+                response.cache_control.no_cache = True
+                return response
+            
+            if app.config['FAST_SERIALIZER']:
+                all_documents = serializers.rows_to_dicts(documents, document_api)
+            else:
+                mask = '{%s}' % ','.join(['id'] + [column for column in columns if column != 'id']) if columns else None
+                all_documents = marshal([dict(row) for row in documents], document_api, mask=mask)
+            
+            headers = {'ETag': quote_etag(etag), 'Cache-Control': 'no-cache'}
+            if args['limit'] is not None and len(all_documents) == args['limit']:
+                # A full page, there may be more documents after the last one
+                next_url = '{}?after_id={}&limit={}'.format(request.base_url, all_documents[-1]['id'], args['limit'])
+                if args['fields']:
+                    next_url += '&fields={}'.format(args['fields'])
+                headers['Link'] = '<{}>; rel="next"'.format(next_url)
+            
+            if app.config['FAST_SERIALIZER']:
+                return Response(serializers.dumps(all_documents) + b'\n', mimetype='application/json', headers=headers)
+            
+            return all_documents, 200, headers
+
+    @ns.route('/search')
+    class DocumentSearch(Resource):
+        
+        @ns.doc('search_documents')
+        @ns.expect(search_parser)
+        @ns.marshal_list_with(search_result_api)
+        def get(self):
+            '''Find documents naming the given parties, most relevant first'''
+            
+            args = search_parser.parse_args()
+            if not args['q'].split():
+                api.abort(400, 'Empty search query')
+            
+            return [dict(row) for row in search_documents(args['q'], args['field'], args['limit'], args['offset'])]
 
     @ns.route('/<int:document_id>')
     @ns.response(404, 'Document not found')
@@ -64,15 +279,66 @@ def create_app(test_config=None):
     class Document(Resource):
         
         @ns.doc('get_document')
-        @ns.marshal_with(document_api)
+        @ns.response(200, 'Success', document_api)
+        @ns.response(304, 'Not modified')
         def get(self, document_id):
             '''List one document by id'''
             
+            # Serialized bodies are cached by id and revision, so repeated reads skip the document query and
+            # the marshaller, and a re-extraction by any process leaves the previous bodies unused
+            cache = app.extensions['document_response_cache']
+            key = (document_id, document_revision(document_id))
+            cached = cache.get(key)
+            
+            if cached is None:
+                document = find_document_by_id(document_id)
+                if document is None:
+                    api.abort(404, "Document {} doesn't exist".format(document_id))
+                
+                if app.config['FAST_SERIALIZER']:
+                    body = serializers.dumps(serializers.row_to_dict(document, document_api))
+                else:
+                    body = json.dumps(marshal(dict(document), document_api)).encode('utf8')
+                etag = hashlib.sha1(str(document_id).encode('utf8') + b':' + body).hexdigest()
+                if has_layout_index(document):
+                    max_age = app.config['DOCUMENT_LAYOUT_CACHE_MAX_AGE']
+                else:
+                    max_age = app.config['DOCUMENT_CACHE_MAX_AGE']
+                cached = (body, etag, max_age)
+                cache.put(key, cached)
+            
+            body, etag, max_age = cached
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag, 'public, max-age={}'.format(max_age))
+            
+            response = Response(body + b'\n', mimetype='application/json')
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            return response
+    
+    @ns.route('/<int:document_id>/reextract')
+    @ns.response(404, 'Document not found')
+    @ns.response(409, 'Document has no layout index')
+    @ns.param('document_id', 'The document unique identifier')
+    class ReextractDocument(Resource):
+        
+        @ns.doc('reextract_document')
+        @ns.marshal_with(document_api)
+        def post(self, document_id):
+            '''Run the current extraction rules over a document's stored layout index'''
+            
             document = find_document_by_id(document_id)
-            if document is not None:
-                return dict(document)
-            else:
+            if document is None:
                 api.abort(404, "Document {} doesn't exist".format(document_id))
+            
+            processed = 0
+            if document['content_hash'] is not None:
+                processed, updated = reextract_documents(document['content_hash'])
+            if not processed:
+                api.abort(409, "Document {} has no layout index".format(document_id))
+            
+            return dict(find_document_by_id(document_id))
     
     @ns.route('/upload')
     @ns.expect(upload_parser)
@@ -80,30 +346,137 @@ def create_app(test_config=None):
     class UploadDocument(Resource):
         
         @ns.doc('upload_document')
-        @ns.marshal_with(document_api)
+        @ns.response(200, 'Success', document_api)
+        @ns.response(202, 'Accepted for background extraction', job_api)
+        @ns.response(413, 'Upload too large')
+        @ns.response(429, 'Too many uploads, retry after the Retry-After seconds')
+        @admission.admitted
         def post(self):
-            '''Upload an xml file'''
+            '''Upload an xml file, .xml.gz and .xml.zst files and gzip encoded request bodies are decompressed'''
+            
+            # Accessing request.files reads and buffers the multipart body
+            with timed('upload.multipart'):
+                files = request.files
             
-            if 'file' not in request.files:
+            if 'file' not in files:
                 api.abort(400, 'No file part')
             
-            file = request.files['file']
+            file = files['file']
             
             if file:
                 try:
-                    lm_xml_parser = XmlParser(file)
-                    # Parses the xml file and extracts its data
-                    parsed_data = lm_xml_parser.extract()
+                    lm_xml_parser = XmlParser(file, mode=app.config['XML_PARSER_MODE'], page_budget=app.config['XML_PARSER_PAGE_BUDGET'],
+                                              record_layout=app.config['LAYOUT_INDEX'], max_size=app.config['MAX_CONTENT_LENGTH'])
+                    
+                    # Reuse a previous extraction of the same bytes instead of parsing again
+                    with timed('upload.hash'):
+                        content_hash = hash_file(file)
+                    cached_document = find_cached_document(content_hash)
                     
-                    # Insert into database and get the newly created id
-                    row_id = insert_document(file.filename, parsed_data['plaintiff'], parsed_data['defendants'])
+                    if cached_document is not None:
+                        if app.config['UPLOAD_DEDUPLICATION'] == 'existing':
+                            return marshal(cached_document, document_api)
+                        parsed_data = cached_document
+                    elif app.config['INGEST_ASYNC'] and upload_size(file) >= app.config['INGEST_SYNC_THRESHOLD']:
+                        # Spool the upload and let a background worker extract it
+                        job = app.extensions['ingest_queue'].submit(file, content_hash)
+                        location = api.url_for(Job, job_id=job['id'])
+                        return marshal(dict(job), job_api), 202, {'Location': location}
+                    else:
+                        # Parses the xml file and extracts its data
+                        with timed('upload.extract'):
+                            parsed_data = lm_xml_parser.extract()
                     
-                    # Return the newly inserted document as json object
-                    document = find_document_by_id(row_id)
-                    return dict(document)
+                    # Insert into database and return the newly inserted document as json object
+                    document = insert_document(file.filename, parsed_data['plaintiff'], parsed_data['defendants'], content_hash,
+                                               lm_xml_parser.layout)
+                    if cached_document is None:
+                        extraction_cache().put(content_hash, document)
+                    return marshal(document, document_api)
+                except compression.DecompressedSizeError:
+                    abort(413)
                 except IOError:
                     abort(400, 'Invalid xml file.')
     
+    @ns.route('/jobs/<int:job_id>')
+    @ns.response(404, 'Job not found')
+    @ns.param('job_id', 'The ingest job unique identifier')
+    class Job(Resource):
+        
+        @ns.doc('get_job')
+        @ns.marshal_with(job_api)
+        def get(self, job_id):
+            '''Show the status of an ingest job'''
+            
+            job = find_job_by_id(job_id)
+            if job is not None:
+                return dict(job)
+            else:
+                api.abort(404, "Job {} doesn't exist".format(job_id))
+    
+    @ns.route('/batch')
+    @ns.expect(batch_parser)
+    @ns.response(400, 'Upload failure')
+    class UploadDocumentBatch(Resource):
+        
+        @ns.doc('upload_document_batch')
+        @ns.marshal_list_with(batch_result_api)
+        @ns.response(429, 'Too many uploads, retry after the Retry-After seconds')
+        @admission.admitted
+        def post(self):
+            '''Upload many xml files, or a zip/tar archive of xml files'''
+            
+            files = [file for file in request.files.getlist('files') if file]
+            if not files:
+                api.abort(400, 'No file part')
+            
+            try:
+                batch_files = read_batch_files(files, app.config['MAX_CONTENT_LENGTH'])
+            except compression.DecompressedSizeError:
+                abort(413)
+            except (zipfile.BadZipFile, tarfile.TarError):
+                api.abort(400, 'Invalid archive file.')
+            
+            content_hashes = [hash_bytes(data) for filename, data in batch_files]
+            cached_documents = [find_cached_document(content_hash) for content_hash in content_hashes]
+            
+            # Parse everything that has not been extracted before in the process pool
+            uncached_files = [batch_file for batch_file, cached in zip(batch_files, cached_documents) if cached is None]
+            extracted = iter(extract_files(uncached_files, app.config['XML_PARSER_MODE'], app.config['BATCH_MAX_WORKERS'],
+                                           app.config['XML_PARSER_PAGE_BUDGET'], app.config['LAYOUT_INDEX'],
+                                           app.config['MAX_CONTENT_LENGTH']))
+            
+            results = []
+            pending = []
+            layouts = []
+            for (filename, data), content_hash, cached_document in zip(batch_files, content_hashes, cached_documents):
+                result = {'filename': filename, 'document': None, 'error': None}
+                results.append(result)
+                
+                if cached_document is not None:
+                    if app.config['UPLOAD_DEDUPLICATION'] == 'existing':
+                        result['document'] = cached_document
+                        continue
+                    parsed_data = cached_document
+                else:
+                    parsed_data, result['error'] = next(extracted)
+                    if result['error'] is not None:
+                        continue
+                    if parsed_data.get('layout') is not None:
+                        layouts.append((content_hash, parsed_data['layout']))
+                
+                pending.append((result, (filename, parsed_data['plaintiff'], parsed_data['defendants'], content_hash), cached_document is None))
+            
+            # Insert every extracted file in one transaction
+            documents = insert_documents([values for result, values, is_new in pending], layouts)
+            
+            for (result, values, is_new), document in zip(pending, documents):
+                result['document'] = document
+                if is_new:
+                    extraction_cache().put(document['content_hash'], document)
+            
+            return results
+    
     return app
 
 '''
@@ -112,13 +485,47 @@ def create_app(test_config=None):
     For larger scale applications, we should probably use some type of model library
         and move outside of main app file.
 '''
-def find_documents():
-    """Find and return all document Row objects"""
+# Document columns that can be projected by find_documents
+DOCUMENT_COLUMNS = ('id', 'filename', 'plaintiff', 'defendants')
+
+def find_documents(after_id=None, limit=None, columns=None):
+    """Find and iterate over document Row objects in id order
+    
+    Rows are read lazily from the cursor, so callers can stream them without loading the result set.
+    
+    :param after_id: int, only find documents with a greater id (default: None)
+    :param limit: int, maximum number of documents (default: None)
+    :param columns: list of DOCUMENT_COLUMNS to select, id is always included (default: all columns)
+    """
+    if columns:
+        invalid_columns = [column for column in columns if column not in DOCUMENT_COLUMNS]
+        if invalid_columns:
+            raise ValueError('Invalid document fields: {}'.format(', '.join(invalid_columns)))
+        columns = ['id'] + [column for column in columns if column != 'id']
+    else:
+        columns = DOCUMENT_COLUMNS
+
+    sql = "SELECT {} FROM document".format(', '.join(columns))
+    params = []
+
+    if after_id is not None:
+        sql += " WHERE id > ?"
+        params.append(after_id)
+
+    sql += " ORDER BY id"
 
-    sql = "SELECT * FROM document"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
 
-    database = db.get_db()
-    return database.execute(sql).fetchall()
+    with timed('db.find_documents'):
+        shards = db.get_shards()
+        if len(shards) == 1:
+            return iter(shards[0].execute(sql, params))
+        
+        # Each shard returns its first rows in id order, merging the cursors keeps the list lazy
+        rows = heapq.merge(*[shard.execute(sql, params) for shard in shards], key=itemgetter(0))
+        return itertools.islice(rows, limit) if limit is not None else rows
 
 def find_document_by_id(row_id):
     """Find and return one document Row object
@@ -127,26 +534,326 @@ def find_document_by_id(row_id):
     """
     sql = "SELECT * FROM document WHERE id = ?"
 
-    database = db.get_db()
-    return database.execute(sql, (row_id,)).fetchone()
+    with timed('db.find_document_by_id'):
+        database = db.get_shard(db.shard_of_document(row_id))
+        return database.execute(sql, (row_id,)).fetchone()
+
+# Document columns in the full-text search index
+SEARCH_FIELDS = ('plaintiff', 'defendants')
+
+def search_query(text, field=None):
+    """Return an FTS5 query matching every word of text, optionally in one column
+    
+    Words are quoted, so punctuation such as 'HILL-ROM' is matched literally instead of as query syntax.
+    
+    :param text: string words to find
+    :param field: one of SEARCH_FIELDS (default: None searches both)
+    """
+    query = ' '.join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+    if field is not None:
+        query = '{} : ({})'.format(field, query)
+    return query
+
+def search_documents(text, field=None, limit=20, offset=0):
+    """Find and return document Row objects matching text, most relevant first
+    
+    Shards are searched separately and their results merged by rank, bm25 weighs terms with the
+    statistics of each shard, so ranks are comparable as long as the shards hold similar documents.
+    
+    :param text: string words to find
+    :param field: one of SEARCH_FIELDS (default: None searches both)
+    :param limit: int, maximum number of documents (default: 20)
+    :param offset: int, number of ranked documents to skip (default: 0)
+    """
+    sql = "SELECT document.id, document.filename, document.plaintiff, document.defendants, " \
+          "bm25(document_fts) AS rank " \
+          "FROM document_fts JOIN document ON document.id = document_fts.rowid " \
+          "WHERE document_fts MATCH ? ORDER BY rank, document.id LIMIT ? OFFSET ?"
+
+    query = search_query(text, field)
+    
+    with timed('db.search_documents'):
+        shards = db.get_shards()
+        if len(shards) == 1:
+            return shards[0].execute(sql, (query, limit, offset)).fetchall()
+        
+        results = [shard.execute(sql, (query, limit + offset, 0)).fetchall() for shard in shards]
+        rows = heapq.merge(*results, key=lambda row: (row['rank'], row['id']))
+        return list(itertools.islice(rows, offset, offset + limit))
+
+def not_modified(etag, cache_control):
+    """Return an empty 304 response for a request whose If-None-Match matched etag
+    
+    :param etag: string unquoted strong ETag
+    :param cache_control: string Cache-Control header value
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def documents_version():
+    """Return a string that changes whenever a document is inserted or its extracted fields are updated
+    
+    AUTOINCREMENT keeps the last issued id in sqlite_sequence and a trigger counts updates in
+    document_revision, so this is two single row lookups per shard.
+    """
+    sql = ("SELECT (SELECT seq FROM sqlite_sequence WHERE name = 'document'),"
+           " (SELECT revision FROM document_revision)")
+
+    versions = []
+    for shard in db.get_shards():
+        row = shard.execute(sql).fetchone()
+        versions.append('{}.{}'.format(row[0] or 0, row[1] or 0))
+    return ':'.join(versions)
+
+def document_revision(document_id):
+    """Return the update counter of the shard holding a document id, it changes when any of its documents is updated
+    
+    :param document_id: int id
+    """
+    sql = "SELECT revision FROM document_revision"
+    
+    shard = db.get_shard(db.shard_of_document(document_id))
+    return shard.execute(sql).fetchone()[0]
+
+def has_layout_index(document):
+    """Return True if a layout index is stored for a document, so `flask reextract` may change it
+    
+    :param document: document Row object
+    """
+    if document['content_hash'] is None:
+        return False
+    
+    sql = "SELECT 1 FROM document_layout WHERE content_hash = ?"
+    
+    # Documents and the layout indexes of their content are in the shard of their content hash
+    shard = db.get_shard(db.shard_for_hash(document['content_hash'], db.shard_count()))
+    return shard.execute(sql, (document['content_hash'],)).fetchone() is not None
+
+def find_document_by_content_hash(content_hash):
+    """Find and return the first document Row object uploaded with the given content hash
+    
+    Every document with a content hash is in the shard of that hash, including the ones moved by
+    `flask migrate-shards`, so this is one lookup.
+    
+    :param content_hash: string SHA-256 hex digest of the uploaded file
+    """
+    sql = "SELECT * FROM document WHERE content_hash = ? ORDER BY id LIMIT 1"
+
+    database = db.get_shard(db.shard_for_hash(content_hash, db.shard_count()))
+    with timed('db.find_document_by_content_hash'):
+        return database.execute(sql, (content_hash,)).fetchone()
+
+def extraction_cache():
+    """Return the in-process LRU of extracted documents keyed by content hash"""
+    return current_app.extensions['extraction_cache']
 
-def insert_document(filename, plaintiff, defendants):
-    """Create a new document Row object and return its id
+def find_cached_document(content_hash):
+    """Find and return a document dict previously extracted from the same content, or None
+    
+    Looks in the in-process LRU first and falls back to the indexed content_hash column.
     
+    :param content_hash: string SHA-256 hex digest of the uploaded file
+    """
+    cache = extraction_cache()
+    document = cache.get(content_hash)
+
+    if document is None:
+        row = find_document_by_content_hash(content_hash)
+        if row is not None:
+            document = dict(row)
+            cache.put(content_hash, document)
+
+    return document
+
+def document_record(row_id, filename, plaintiff, defendants, content_hash=None):
+    """Return the dict of a persisted document built from its inserted values
+    
+    :param row_id: int id
     :param filename: string filename
     :param plaintiff: string plaintiff data
     :param defendants: string defendants data
+    :param content_hash: string SHA-256 hex digest of the uploaded file (default: None)
     """
+    return {
+        'id': row_id,
+        'filename': filename,
+        'plaintiff': plaintiff,
+        'defendants': defendants,
+        'content_hash': content_hash
+    }
+
+# Layout indexes are stored once per content hash
+INSERT_LAYOUT_SQL = "INSERT OR IGNORE INTO document_layout (content_hash, layout) VALUES (?, ?)"
+
+# Ids come from db.allocate_ids, with a single shard the id is None and AUTOINCREMENT picks the next one
+INSERT_DOCUMENT_SQL = ("INSERT INTO document (id, filename, plaintiff, defendants, content_hash)"
+                       " VALUES (?, ?, ?, ?, ?)")
+
+def insert_document(filename, plaintiff, defendants, content_hash=None, layout=None):
+    """Create a new document Row object and return it as a dict, without reading it back
     
-    sql = "INSERT INTO document (filename, plaintiff, defendants) VALUES (?, ?, ?)"
+    :param filename: string filename
+    :param plaintiff: string plaintiff data
+    :param defendants: string defendants data
+    :param content_hash: string SHA-256 hex digest of the uploaded file (default: None)
+    :param layout: bytes layout_index of the uploaded file, stored with its content hash (default: None)
+    """
+    
+    params = (filename, plaintiff, defendants, content_hash)
+    store_layout = layout is not None and content_hash is not None
+    
+    shard = db.shard_for_hash(content_hash, db.shard_count())
+    
+    if current_app.config['INSERT_GROUP_COMMIT']:
+        # Share one commit with inserts from concurrent requests
+        writer = current_app.extensions['group_commit_writer']
+        with timed('db.insert_document'):
+            if store_layout:
+                writer.submit(INSERT_LAYOUT_SQL, (content_hash, layout), shard)
+            row_id, = db.allocate_ids([shard])
+            last_row_id = writer.execute(INSERT_DOCUMENT_SQL, (row_id,) + params, shard)
+        return document_record(last_row_id if row_id is None else row_id, *params)
+    
+    database = db.get_shard(shard)
+    
+    with timed('db.insert_document'):
+        row_id, = db.allocate_ids([shard])
+        cursor = database.cursor()
+        cursor.execute(INSERT_DOCUMENT_SQL, (row_id,) + params)
+        # Read before the layout insert, which moves lastrowid to the document_layout row
+        last_row_id = cursor.lastrowid if row_id is None else row_id
+        if store_layout:
+            cursor.execute(INSERT_LAYOUT_SQL, (content_hash, layout))
+        
+        database.commit()
+        cursor.close()
+    
+    # Every column is given explicitly, so the inserted values plus the id are the persisted row
+    return document_record(last_row_id, *params)
+
+def ingest_spooled_file(filename, spool_path, content_hash):
+    """Extract a spooled upload, insert it and return the new document id
     
-    database = db.get_db()
+    Runs in an ingest worker thread inside an app context.
     
-    cursor = database.cursor()
-    cursor.execute(sql, (filename, plaintiff, defendants))
+    :param filename: string filename
+    :param spool_path: string path of the spooled upload
+    :param content_hash: string SHA-256 hex digest of the uploaded file
+    """
+    with open(spool_path, 'rb') as fp:
+        lm_xml_parser = XmlParser(FileStorage(fp, filename=filename), mode=current_app.config['XML_PARSER_MODE'],
+                                  page_budget=current_app.config['XML_PARSER_PAGE_BUDGET'],
+                                  record_layout=current_app.config['LAYOUT_INDEX'],
+                                  max_size=current_app.config['MAX_CONTENT_LENGTH'])
+        parsed_data = lm_xml_parser.extract()
+
+    document = insert_document(filename, parsed_data['plaintiff'], parsed_data['defendants'], content_hash,
+                               lm_xml_parser.layout)
+    extraction_cache().put(content_hash, document)
+
+    return document['id']
+
+def insert_documents(documents, layouts=None):
+    """Create many document Row objects and return them as dicts in order
+    
+    Ids are allocated for the whole batch first, then each shard inserts its documents in one transaction,
+    shards are written in parallel.
+    
+    :param documents: list of (filename, plaintiff, defendants, content_hash) tuples
+    :param layouts: list of (content_hash, bytes layout_index) tuples stored in the same transactions (default: None)
+    """
+    if not documents:
+        return []
+
+    shards = db.shard_count()
+
+    def insert(database, shard, items):
+        positions, shard_documents, shard_layouts = items
+
+        cursor = database.cursor()
+        cursor.executemany(INSERT_DOCUMENT_SQL, shard_documents)
+
+        # With AUTOINCREMENT ids the write lock is held for the whole transaction, so they are consecutive
+        last_row_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+        if shard_layouts:
+            cursor.executemany(INSERT_LAYOUT_SQL, shard_layouts)
+
+        database.commit()
+        cursor.close()
+
+        if shard_documents[0][0] is not None:
+            return [document[0] for document in shard_documents]
+        first_row_id = last_row_id - (len(shard_documents) - 1)
+        return [first_row_id + i for i in range(len(shard_documents))]
+
+    with timed('db.insert_documents'):
+        indexes = [db.shard_for_hash(document[3], shards) for document in documents]
+        row_ids = db.allocate_ids(indexes)
+
+        # Shard index -> ([document positions], [(id, filename, plaintiff, defendants, content_hash)], [layouts])
+        items_by_shard = {}
+        for position, (index, row_id, document) in enumerate(zip(indexes, row_ids, documents)):
+            items = items_by_shard.setdefault(index, ([], [], []))
+            items[0].append(position)
+            items[1].append((row_id,) + tuple(document))
+        for content_hash, layout in layouts or []:
+            items = items_by_shard.get(db.shard_for_hash(content_hash, shards))
+            if items is not None:
+                items[2].append((content_hash, layout))
+
+        row_ids_by_shard = db.map_shards(insert, items_by_shard)
+
+    records = [None] * len(documents)
+    for shard, (positions, shard_documents, shard_layouts) in items_by_shard.items():
+        for position, row_id, document in zip(positions, row_ids_by_shard[shard], shard_documents):
+            records[position] = document_record(row_id, *document[1:])
+    return records
+
+def reextract_documents(content_hash=None, chunk_size=1000):
+    """Run the current extraction rules over stored layout indexes and update the documents whose fields changed
+    
+    Runs in one transaction per shard and returns a (layouts processed, documents updated) tuple.
+    Documents and the layout indexes of their content are in the shard of their content hash.
+    
+    :param content_hash: only re-extract the documents with this content hash (default: None, every document)
+    :param chunk_size: number of layout indexes decoded between two batched updates (default: 1000)
+    """
+    sql = "SELECT content_hash, layout FROM document_layout"
+    params = ()
+    if content_hash is not None:
+        sql += " WHERE content_hash = ?"
+        params = (content_hash,)
+    
+    update_sql = ("UPDATE document SET plaintiff = ?, defendants = ?"
+                  " WHERE content_hash = ? AND (plaintiff != ? OR defendants != ?)")
+    
+    processed = updated = 0
+    
+    with timed('db.reextract_documents'):
+        for database in db.get_shards():
+            cursor = database.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                
+                updates = []
+                for row in rows:
+                    parsed_data = LayoutIndex(row['layout']).extract()
+                    plaintiff, defendants = parsed_data['plaintiff'], parsed_data['defendants']
+                    updates.append((plaintiff, defendants, row['content_hash'], plaintiff, defendants))
+                
+                updated += database.executemany(update_sql, updates).rowcount
+                processed += len(rows)
+            
+            database.commit()
     
-    database.commit()
-    last_row_id = cursor.lastrowid
-    cursor.close()
+    if updated:
+        # Cached extraction results and responses hold the previous fields
+        extraction_cache().clear()
+        current_app.extensions['document_response_cache'].clear()
     
-    return last_row_id
\ No newline at end of file
+    return processed, updated
@@ -0,0 +1,172 @@
+"""Admission control of the upload endpoints
+
+Parse work is admitted by an AdmissionController weighted by request body size: uploads run while the
+bytes in flight fit in PARSE_CAPACITY, then wait in a bounded FIFO queue. When the queue is full, or
+an upload waited PARSE_QUEUE_TIMEOUT seconds, it is rejected with 429 and a Retry-After estimated
+from the recent throughput. Read endpoints never go through the controller, so a burst of uploads
+is turned away instead of holding every request thread and lock. Limits are per process.
+"""
+
+import functools
+import math
+import threading
+import time
+from collections import deque
+
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+from .metrics import ADMISSION_REJECTIONS, timed
+
+class AdmissionRejected(TooManyRequests):
+    """429 error returned to rejected uploads, with a Retry-After header
+
+    :param retry_after: seconds the client should wait before retrying
+    :param reason: 'queue_full' or 'timeout'
+    """
+    def __init__(self, retry_after, reason):
+        super().__init__('The server is busy parsing other uploads, retry in {} seconds.'.format(retry_after))
+        self.retry_after = retry_after
+        self.reason = reason
+
+    def get_headers(self, environ=None):
+        headers = super().get_headers(environ)
+        headers.append(('Retry-After', str(self.retry_after)))
+        return headers
+
+class AdmissionController:
+    """A size weighted semaphore with a bounded FIFO wait queue
+
+    :param capacity: total weight admitted at once, heavier requests are admitted alone
+    :param queue_size: maximum number of waiting requests
+    :param timeout: seconds a request waits before it is rejected (default: None, waits until admitted)
+    :param window: number of recent completions the throughput is estimated from (default: 32)
+    """
+    def __init__(self, capacity, queue_size, timeout=None, window=32):
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+        self.in_flight = 0
+        self.running = 0
+        self.__queue = deque()
+        # (weight, seconds) of recent completions
+        self.__completions = deque(maxlen=window)
+        self.__condition = threading.Condition()
+
+    def weight(self, size):
+        """Return the weight of a request body of size bytes, the capacity when it is unknown or larger"""
+        if size is None or size > self.capacity:
+            return self.capacity
+        return size
+
+    def throughput(self):
+        """Return the recent bytes per second of one admitted request, None before any completion"""
+        with self.__condition:
+            weight = sum(weight for weight, seconds in self.__completions)
+            seconds = sum(seconds for weight, seconds in self.__completions)
+        return weight / seconds if seconds > 0 else None
+
+    def retry_after(self):
+        """Return the seconds the admitted and queued work should take to drain, at least 1"""
+        throughput = self.throughput()
+        if throughput is None:
+            return 1
+
+        with self.__condition:
+            pending = self.in_flight + sum(ticket.weight for ticket in self.__queue)
+            running = max(self.running, 1)
+        return max(1, int(math.ceil(pending / (throughput * running))))
+
+    def __fits(self, weight):
+        return self.running == 0 or self.in_flight + weight <= self.capacity
+
+    def acquire(self, weight):
+        """Wait until weight is admitted, in arrival order, or raise AdmissionRejected"""
+        with self.__condition:
+            if not self.__queue and self.__fits(weight):
+                self.__admit(weight)
+                return
+
+            if len(self.__queue) >= self.queue_size:
+                reason = 'queue_full'
+            else:
+                ticket = _Ticket(weight)
+                self.__queue.append(ticket)
+                deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+
+                try:
+                    while not (self.__queue[0] is ticket and self.__fits(weight)):
+                        remaining = deadline - time.monotonic() if deadline is not None else None
+                        if remaining is not None and remaining <= 0:
+                            break
+                        self.__condition.wait(remaining)
+                    else:
+                        self.__admit(weight)
+                        return
+                finally:
+                    self.__queue.remove(ticket)
+                    # The next ticket may fit now
+                    self.__condition.notify_all()
+
+                reason = 'timeout'
+
+        ADMISSION_REJECTIONS.inc(reason)
+        raise AdmissionRejected(self.retry_after(), reason)
+
+    def __admit(self, weight):
+        self.in_flight += weight
+        self.running += 1
+
+    def release(self, weight, seconds):
+        """Release admitted weight and record how long its request took
+
+        :param weight: the weight passed to acquire
+        :param seconds: time the request spent admitted
+        """
+        with self.__condition:
+            self.in_flight -= weight
+            self.running -= 1
+            self.__completions.append((weight, seconds))
+            self.__condition.notify_all()
+
+    def stats(self):
+        """Return a dict of the admitted and waiting requests and weights"""
+        with self.__condition:
+            return {
+                'running': self.running,
+                'in_flight_bytes': self.in_flight,
+                'queued': len(self.__queue),
+                'queued_bytes': sum(ticket.weight for ticket in self.__queue),
+            }
+
+class _Ticket:
+    """Place of one waiting request in the queue"""
+    __slots__ = ('weight',)
+
+    def __init__(self, weight):
+        self.weight = weight
+
+def admitted(view):
+    """Decorator running a view once its request body is admitted by the app's AdmissionController"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        controller = current_app.extensions['admission']
+        if controller is None:
+            return view(*args, **kwargs)
+
+        weight = controller.weight(request.content_length)
+        with timed('admission.wait'):
+            controller.acquire(weight)
+
+        start = time.perf_counter()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            controller.release(weight, time.perf_counter() - start)
+
+    return wrapper
+
+def init_app(app):
+    capacity = app.config['PARSE_CAPACITY']
+    app.extensions['admission'] = None if capacity is None else AdmissionController(
+        capacity, app.config['PARSE_QUEUE_SIZE'], app.config['PARSE_QUEUE_TIMEOUT'])
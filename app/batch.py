@@ -0,0 +1,146 @@
+"""Helpers for the batch upload endpoint: archive expansion and parallel extraction"""
+
+import io
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.datastructures import FileStorage
+from .LegalMation import XmlParser
+from .compression import DecompressedSizeError
+
+ZIP_EXTENSIONS = ('.zip',)
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def read_batch_files(files, max_size=None):
+    """Return a list of (filename, bytes) tuples for uploaded files
+    
+    A single zip or tar archive is expanded into its member files. Members are read through a size
+    capped read, so an archive inflating past max_size raises DecompressedSizeError, like a compressed
+    xml file does.
+    
+    :param files: list of <werkzeug.datastructures.FileStorage> objects
+    :param max_size: maximum number of bytes of all archive members together (default: None, no limit)
+    """
+    if len(files) == 1:
+        filename = (files[0].filename or '').lower()
+        if filename.endswith(ZIP_EXTENSIONS):
+            return _read_zip(files[0].stream, max_size)
+        if filename.endswith(TAR_EXTENSIONS):
+            return _read_tar(files[0].stream, max_size)
+
+    return [(file.filename, file.read()) for file in files]
+
+class _MemberReader:
+    """Reads archive members while the total of their sizes stays within max_size"""
+
+    def __init__(self, max_size):
+        self.remaining = max_size
+
+    def read(self, fileobj, declared_size):
+        """Return the bytes of a member file object
+        
+        :param fileobj: file object of the member
+        :param declared_size: size of the member in the archive header, checked before anything is inflated
+        """
+        if self.remaining is None:
+            return fileobj.read()
+
+        if declared_size > self.remaining:
+            raise self.__error()
+
+        # One more byte than allowed tells a member larger than its header from one that fits exactly
+        data = fileobj.read(self.remaining + 1)
+        if len(data) > self.remaining:
+            raise self.__error()
+
+        self.remaining -= len(data)
+        return data
+
+    @staticmethod
+    def __error():
+        return DecompressedSizeError('Archive members are larger than the allowed size')
+
+def _read_zip(stream, max_size=None):
+    reader = _MemberReader(max_size)
+    with zipfile.ZipFile(io.BytesIO(stream.read())) as archive:
+        files = []
+        for info in archive.infolist():
+            if not info.is_dir():
+                with archive.open(info) as member:
+                    files.append((info.filename, reader.read(member, info.file_size)))
+        return files
+
+def _read_tar(stream, max_size=None):
+    reader = _MemberReader(max_size)
+    with tarfile.open(fileobj=io.BytesIO(stream.read()), mode='r:*') as archive:
+        return [(member.name, reader.read(archive.extractfile(member), member.size))
+                for member in archive.getmembers() if member.isfile()]
+
+def extract_file(filename, data, mode, page_budget=None, record_layout=False, max_size=None):
+    """Extract one file and return a (parsed_data, error) tuple
+    
+    Runs inside the process pool, so it only takes and returns picklable values.
+    
+    :param filename: string filename
+    :param data: bytes file content
+    :param mode: XmlParser extraction mode
+    :param page_budget: XmlParser page budget (default: None)
+    :param record_layout: add the recorded layout_index bytes to parsed_data as 'layout' (default: False)
+    :param max_size: XmlParser maximum decompressed size of compressed files (default: None)
+    """
+    try:
+        lm_xml_parser = XmlParser(FileStorage(io.BytesIO(data), filename=filename), mode=mode, page_budget=page_budget,
+                                  record_layout=record_layout, max_size=max_size)
+        parsed_data = lm_xml_parser.extract()
+        if record_layout:
+            parsed_data['layout'] = lm_xml_parser.layout
+        return parsed_data, None
+    except DecompressedSizeError:
+        return None, 'Decompressed file is too large.'
+    except IOError:
+        return None, 'Invalid xml file.'
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+def get_executor(max_workers):
+    """Return the process pool shared by all batch requests in this process
+    
+    :param max_workers: number of worker processes (None uses the number of CPUs)
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=max_workers)
+        return _executor
+
+def extract_files(files, mode, max_workers=None, page_budget=None, record_layout=False, max_size=None):
+    """Extract (filename, bytes) tuples in parallel and return (parsed_data, error) tuples in the same order
+    
+    :param files: list of (filename, bytes) tuples
+    :param mode: XmlParser extraction mode
+    :param max_workers: number of worker processes, 0 extracts in the calling process (default: None)
+    :param page_budget: XmlParser page budget (default: None)
+    :param record_layout: see extract_file (default: False)
+    :param max_size: see extract_file (default: None)
+    """
+    if not files:
+        return []
+
+    filenames = [filename for filename, data in files]
+    contents = [data for filename, data in files]
+    modes = [mode] * len(files)
+    page_budgets = [page_budget] * len(files)
+    record_layouts = [record_layout] * len(files)
+    max_sizes = [max_size] * len(files)
+
+    if max_workers == 0:
+        return list(map(extract_file, filenames, contents, modes, page_budgets, record_layouts, max_sizes))
+
+    return list(get_executor(max_workers).map(extract_file, filenames, contents, modes, page_budgets, record_layouts,
+                                              max_sizes))
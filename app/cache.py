@@ -0,0 +1,65 @@
+"""In-process caches used by the upload path"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Read uploads in 64KiB chunks when hashing them
+HASH_CHUNK_SIZE = 64 * 1024
+
+def hash_file(file_storage):
+    """Return the SHA-256 hex digest of an uploaded file and rewind it for the parser
+    
+    :param file_storage: <werkzeug.datastructures.FileStorage> object
+    """
+    digest = hashlib.sha256()
+    stream = file_storage.stream
+
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+
+    stream.seek(0)
+    return digest.hexdigest()
+
+def hash_bytes(data):
+    """Return the SHA-256 hex digest of in-memory file content
+    
+    :param data: bytes file content
+    """
+    return hashlib.sha256(data).hexdigest()
+
+class LRUCache:
+    """A bounded, thread-safe least recently used cache
+    
+    :param max_size: maximum number of entries kept in memory, 0 disables the cache
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key (marking it as recently used) or None"""
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            self.__entries.move_to_end(key)
+            return self.__entries[key]
+
+    def put(self, key, value):
+        """Store value for key, evicting the least recently used entry when full"""
+        if self.max_size <= 0:
+            return
+
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
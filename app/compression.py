@@ -0,0 +1,178 @@
+"""Compressed uploads and compressed json responses
+
+Uploads are accepted as `.xml.gz` / `.xml.zst` files, or with a `Content-Encoding: gzip` (or `zstd`)
+request body. Both are decompressed as a stream with a DecompressingReader: compressed files are read
+by lxml through it chunk by chunk, and encoded request bodies go through it into the multipart parser
+(see uploads.UploadRequest), so the whole document is never inflated in memory.
+
+Json responses larger than RESPONSE_COMPRESSION_MIN_SIZE, and streamed lists, are gzip compressed for
+clients sending `Accept-Encoding: gzip`. zstd support is optional, install the `zstd` extra to use it.
+"""
+
+import zlib
+
+from flask import current_app, request
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Upload filename extensions and the compression of each
+XML_EXTENSIONS = ('.xml', '.xml.gz', '.xml.zst')
+FILE_COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# Compressed bytes read from the underlying stream at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+# Response mimetypes worth compressing
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+
+class DecompressedSizeError(IOError):
+    """Raised when decompressed data grows past the allowed size"""
+
+def available(encoding):
+    """Return True if data compressed with an encoding ('gzip', 'zstd' or None) can be read"""
+    if encoding == 'zstd':
+        return zstandard is not None
+    return encoding in (None, 'gzip')
+
+def file_compression(filename):
+    """Return the compression of a file from its extension, 'gzip', 'zstd' or None
+
+    :param filename: string filename
+    """
+    for extension, encoding in FILE_COMPRESSIONS.items():
+        if (filename or '').lower().endswith(extension):
+            return encoding
+    return None
+
+def _decompressor(encoding, fileobj):
+    if encoding == 'gzip':
+        # 16 + MAX_WBITS reads the gzip header and trailer
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        # Each read returns at most the asked number of decompressed bytes, unlike decompressobj()
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_size=READ_CHUNK_SIZE)
+    raise ValueError('Unsupported compression: {}'.format(encoding))
+
+class DecompressingReader:
+    """Read-only file object decompressing another file object as it is read
+
+    Invalid compressed data raises IOError, so callers handle it like an unreadable xml file.
+
+    :param fileobj: file object of the compressed data
+    :param encoding: 'gzip' or 'zstd'
+    :param max_size: maximum number of decompressed bytes, more raises DecompressedSizeError (default: None, no limit)
+    """
+    def __init__(self, fileobj, encoding, max_size=None):
+        self.fileobj = fileobj
+        self.encoding = encoding
+        self.max_size = max_size
+        # Number of decompressed bytes returned so far
+        self.size = 0
+
+        self.__decompressor = _decompressor(encoding, fileobj)
+        self.__buffer = b''
+        # Compressed input left over by a bounded decompress call
+        self.__tail = b''
+        self.__eof = False
+
+    def readable(self):
+        return True
+
+    def __decompress(self):
+        # Both decompressors return at most READ_CHUNK_SIZE bytes at a time, so a small highly compressed
+        # chunk is checked against max_size as it inflates
+        if self.encoding == 'zstd':
+            data = self.__decompressor.read(READ_CHUNK_SIZE)
+            self.__eof = not data
+            return data
+
+        chunk = self.__tail or self.fileobj.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self.__eof = True
+            return self.__decompressor.flush()
+
+        data = self.__decompressor.decompress(chunk, READ_CHUNK_SIZE)
+        self.__tail = self.__decompressor.unconsumed_tail
+        return data
+
+    def __fill(self, size):
+        errors = (zlib.error, zstandard.ZstdError) if zstandard is not None else zlib.error
+
+        while not self.__eof and (size < 0 or len(self.__buffer) < size):
+            try:
+                data = self.__decompress()
+            except errors as e:
+                raise IOError('Invalid {} data: {}'.format(self.encoding, e))
+
+            if self.max_size is not None and self.size + len(self.__buffer) + len(data) > self.max_size:
+                raise DecompressedSizeError('Decompressed data is larger than {} bytes'.format(self.max_size))
+            self.__buffer += data
+
+        if self.__eof and self.encoding == 'gzip' and not self.__decompressor.eof:
+            raise IOError('Truncated gzip data')
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self.__fill(size)
+
+        if size < 0:
+            data, self.__buffer = self.__buffer, b''
+        else:
+            data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+
+        self.size += len(data)
+        return data
+
+def accepts_gzip():
+    """Return True if the current request accepts gzip encoded responses"""
+    return request.accept_encodings['gzip'] > 0
+
+def _gzip_compressor():
+    # A gzip header with no timestamp, so equal bodies compress to equal bytes
+    return zlib.compressobj(current_app.config['RESPONSE_COMPRESSION_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def _compress_chunks(chunks, compressor):
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compress_response(response):
+    """Gzip encode large json responses and streamed lists for clients accepting it"""
+    min_size = current_app.config['RESPONSE_COMPRESSION_MIN_SIZE']
+
+    if (min_size is None or response.status_code != 200 or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if not accepts_gzip():
+        return response
+
+    if response.is_streamed:
+        # Compress each chunk as it is generated, the list is never held in memory
+        response.response = _compress_chunks(response.response, _gzip_compressor())
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < min_size:
+            return response
+        compressor = _gzip_compressor()
+        response.set_data(compressor.compress(body) + compressor.flush())
+
+    response.content_encoding = 'gzip'
+
+    # The encoded bytes differ from the identity representation, so its validator becomes weak
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
+
+def init_app(app):
+    app.after_request(compress_response)
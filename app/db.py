@@ -1,18 +1,129 @@
 """NOTE: Database setup is copied from http://flask.pocoo.org/docs/1.0/tutorial/database/"""
 
+import itertools
+import os
 import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import click
-from flask import current_app, g
+from flask import current_app, g, jsonify
 from flask.cli import with_appcontext
 
+class ConnectionPool:
+    """A per-process pool of configured sqlite3 connections shared by all request threads
+    
+    Connections are opened with `check_same_thread=False` and only handed to one request at a time.
+    Up to DB_POOL_SIZE idle connections are kept, extra connections are closed when released.
+    
+    :param config: <flask.Config> object
+    :param database: string path of the database file (default: None, the DATABASE config)
+    """
+    def __init__(self, config, database=None):
+        self.database = database or config['DATABASE']
+        self.size = config['DB_POOL_SIZE']
+        self.journal_mode = config['DB_JOURNAL_MODE']
+        self.synchronous = config['DB_SYNCHRONOUS']
+        self.cache_size = int(config['DB_CACHE_SIZE'])
+        self.mmap_size = int(config['DB_MMAP_SIZE'])
+        self.busy_timeout = int(config['DB_BUSY_TIMEOUT'])
+
+        self.__pid = os.getpid()
+        self.__idle = deque()
+        self.__lock = threading.Lock()
+
+        # Usage counters
+        self.__in_use = 0
+        self.__created = 0
+        self.__reused = 0
+        self.__discarded = 0
+
+    def __connect(self):
+        """Open a new connection and apply the configured pragmas"""
+        db = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=self.busy_timeout / 1000.0,
+            check_same_thread=False
+        )
+        db.row_factory = sqlite3.Row
+
+        db.execute('PRAGMA journal_mode = {}'.format(self.journal_mode))
+        db.execute('PRAGMA synchronous = {}'.format(self.synchronous))
+        db.execute('PRAGMA cache_size = {:d}'.format(self.cache_size))
+        db.execute('PRAGMA mmap_size = {:d}'.format(self.mmap_size))
+        db.execute('PRAGMA busy_timeout = {:d}'.format(self.busy_timeout))
+
+        return db
+
+    def __check_pid(self):
+        """Drop connections inherited from a parent process, they must not be shared after fork"""
+        if self.__pid != os.getpid():
+            self.__pid = os.getpid()
+            self.__idle.clear()
+            self.__in_use = 0
+
+    def acquire(self):
+        """Return an idle connection or open a new one"""
+        db = None
+
+        with self.__lock:
+            self.__check_pid()
+            if self.__idle:
+                db = self.__idle.pop()
+                self.__reused += 1
+            else:
+                self.__created += 1
+            self.__in_use += 1
+
+        if db is None:
+            db = self.__connect()
+
+        return db
+
+    def release(self, db):
+        """Return a connection to the pool, closing it if the pool is full"""
+        # Never hand an unfinished transaction to the next request
+        db.rollback()
+
+        with self.__lock:
+            self.__check_pid()
+            self.__in_use = max(self.__in_use - 1, 0)
+            if len(self.__idle) < self.size:
+                self.__idle.append(db)
+                return
+            self.__discarded += 1
+
+        db.close()
+
+    def close(self):
+        """Close every idle connection"""
+        with self.__lock:
+            while self.__idle:
+                self.__idle.pop().close()
+
+    def stats(self):
+        """Return the pool size and usage counters"""
+        with self.__lock:
+            return {
+                'size': self.size,
+                'idle': len(self.__idle),
+                'in_use': self.__in_use,
+                'created': self.__created,
+                'reused': self.__reused,
+                'discarded': self.__discarded,
+            }
+
+def get_pool():
+    """Return the connection pool of the current app"""
+    return current_app.extensions['db_pool']
+
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = get_pool().acquire()
 
     return g.db
 
@@ -21,7 +132,174 @@ def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        get_pool().release(db)
+
+    shards = g.pop('shard_dbs', {})
+    for index, shard in shards.items():
+        current_app.extensions['db_shard_pools'][index].release(shard)
+
+def shard_paths(config):
+    """Return the database file of each document shard
+    
+    With DB_SHARDS 1 the documents are in the DATABASE file itself, otherwise each shard is a file next
+    to it, e.g. app-db-shard0.sqlite.
+    
+    :param config: <flask.Config> object
+    """
+    if config['DB_SHARDS'] <= 1:
+        return [config['DATABASE']]
+
+    root, extension = os.path.splitext(config['DATABASE'])
+    return ['{}-shard{}{}'.format(root, index, extension) for index in range(config['DB_SHARDS'])]
+
+def shard_count():
+    return len(current_app.extensions['db_shard_pools'])
+
+def get_shard(index):
+    """Return the connection of the current app context to a document shard
+    
+    :param index: int shard index
+    """
+    pool = current_app.extensions['db_shard_pools'][index]
+    if pool is get_pool():
+        return get_db()
+
+    shards = g.setdefault('shard_dbs', {})
+    if index not in shards:
+        shards[index] = pool.acquire()
+
+    return shards[index]
+
+def get_shards():
+    """Return the connections to every document shard, in shard order"""
+    return [get_shard(index) for index in range(shard_count())]
+
+def shard_for_id(row_id, shards):
+    """Return the shard index of a document id
+    
+    Shard i owns the ids i + 1, i + 1 + shards, i + 1 + 2 * shards..., see allocate_ids.
+    
+    :param row_id: int document id
+    :param shards: int number of shards
+    """
+    return (row_id - 1) % shards
+
+def next_shard_id(last_id, index, shards):
+    """Return the smallest id of a shard that is larger than last_id
+    
+    :param last_id: int id
+    :param index: int shard index
+    :param shards: int number of shards
+    """
+    return last_id + 1 + (index - last_id) % shards
+
+def allocate_ids(indexes):
+    """Return a new document id for each shard index, in order, each larger than every id allocated before
+    
+    The last id is kept in the document_sequence table of the DATABASE file, shared by every shard and
+    process, so ids increase across shards and keyset pagination sees new documents. With a single shard
+    this returns None ids, AUTOINCREMENT allocates them in the insert.
+    
+    :param indexes: list of int shard indexes, one per document
+    """
+    shards = shard_count()
+    if shards == 1:
+        return [None] * len(indexes)
+
+    database = get_db()
+    # Take the write lock before reading, so concurrent requests never get the same ids
+    database.execute('BEGIN IMMEDIATE')
+    try:
+        last_id = database.execute("SELECT last_id FROM document_sequence").fetchone()[0]
+        ids = []
+        for index in indexes:
+            last_id = next_shard_id(last_id, index, shards)
+            ids.append(last_id)
+        database.execute("UPDATE document_sequence SET last_id = ?", (last_id,))
+        database.commit()
+    finally:
+        database.rollback()
+    return ids
+
+def shard_of_document(document_id):
+    """Return the shard index of the shard holding a document id
+    
+    New ids belong to the shard they are inserted in, documents moved to the shard of their content hash by
+    `flask migrate-shards` are listed in the document_location table when that is another shard.
+    
+    :param document_id: int id
+    """
+    shards = shard_count()
+    if shards == 1:
+        return 0
+
+    row = get_db().execute("SELECT shard FROM document_location WHERE id = ?", (document_id,)).fetchone()
+    return row[0] if row is not None else shard_for_id(document_id, shards)
+
+# Spreads documents without a content hash over the shards
+_next_shard = itertools.count()
+
+def shard_for_hash(content_hash, shards):
+    """Return the shard index documents with a content hash are inserted in
+    
+    Documents with the same content share a shard, with their layout index.
+    
+    :param content_hash: string content hash, None picks the shards in turn
+    :param shards: int number of shards
+    """
+    if shards == 1:
+        return 0
+    if content_hash is None:
+        return next(_next_shard) % shards
+    # A stable hash, the same in every process
+    return zlib.crc32(content_hash.encode('utf8')) % shards
+
+_shard_executor = None
+_shard_executor_pid = None
+_shard_executor_lock = threading.Lock()
+
+def map_shards(function, items_by_shard):
+    """Call function(connection, shard index, items) for each shard with items, each shard in its own thread
+    
+    sqlite3 releases the GIL while it writes and syncs, so transactions on different shard files run in
+    parallel. A single shard runs in the calling thread with its app context connection.
+    Returns a dict of shard index to the function result.
+    
+    :param function: function(sqlite3 connection, int shard index, items)
+    :param items_by_shard: dict of shard index to the items of that shard
+    """
+    global _shard_executor, _shard_executor_pid
+
+    if len(items_by_shard) <= 1:
+        return {index: function(get_shard(index), index, items) for index, items in items_by_shard.items()}
+
+    pools = current_app.extensions['db_shard_pools']
+
+    def run(index, items):
+        database = pools[index].acquire()
+        try:
+            return function(database, index, items)
+        finally:
+            pools[index].release(database)
+
+    with _shard_executor_lock:
+        # Executor threads do not survive a fork
+        if _shard_executor is None or _shard_executor_pid != os.getpid():
+            _shard_executor = ThreadPoolExecutor(thread_name_prefix='db-shard')
+            _shard_executor_pid = os.getpid()
+        executor = _shard_executor
+
+    futures = {index: executor.submit(run, index, items) for index, items in items_by_shard.items()}
+    return {index: future.result() for index, future in futures.items()}
+
+def close_pools(app):
+    """Close the idle connections of the DATABASE pool and of every shard pool
+    
+    :param app: <flask.Flask> object
+    """
+    app.extensions['db_pool'].close()
+    for pool in app.extensions['db_shard_pools']:
+        pool.close()
 
 def init_db():
     db = get_db()
@@ -29,13 +307,200 @@ def init_db():
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
 
+    with current_app.open_resource('shard_schema.sql') as f:
+        shard_schema = f.read().decode('utf8')
+    for shard in get_shards():
+        shard.executescript(shard_schema)
+
+    # Cached extraction results and responses point at rows that no longer exist
+    for name in ('extraction_cache', 'document_response_cache'):
+        cache = current_app.extensions.get(name)
+        if cache is not None:
+            cache.clear()
+
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
     """Clear the existing data and create new tables."""
     init_db()
-    click.echo('Initialized the database.')
+    if shard_count() > 1:
+        click.echo('Initialized the database and {} document shards.'.format(shard_count()))
+    else:
+        click.echo('Initialized the database.')
+
+# Marks the part of shard_schema.sql that creates the full-text search index
+SEARCH_INDEX_MARKER = '-- Full-text search index'
+
+# Marks the part of schema.sql that creates the document id tables of a sharded database
+DOCUMENT_ID_MARKER = '-- Document id tables'
+
+def rebuild_search_index():
+    """Create the full-text search index of every shard if it is missing and fill it from its document table"""
+    with current_app.open_resource('shard_schema.sql') as f:
+        schema = f.read().decode('utf8')
+
+    for db in get_shards():
+        db.executescript(schema[schema.index(SEARCH_INDEX_MARKER):])
+        db.execute("INSERT INTO document_fts (document_fts) VALUES ('rebuild')")
+        db.commit()
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """Create the full-text search index and backfill it from existing documents."""
+    rebuild_search_index()
+    click.echo('Rebuilt the search index.')
+
+@click.command('import-dir')
+@click.argument('path', type=click.Path(exists=True, file_okay=False))
+@click.option('--batch-size', default=1000, show_default=True, help='Number of files written per transaction.')
+@click.option('--workers', type=int, default=None, help='Number of parser processes, 0 parses in this process (default: number of CPUs).')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint of a previous import of PATH.')
+@with_appcontext
+def import_dir_command(path, batch_size, workers, restart):
+    """Import the xml files of a directory tree, resuming after the last committed file."""
+    from .importer import DirectoryImport
+
+    directory_import = DirectoryImport(get_db(), path, current_app.config['XML_PARSER_MODE'],
+                                       page_budget=current_app.config['XML_PARSER_PAGE_BUDGET'],
+                                       batch_size=batch_size, max_workers=workers,
+                                       record_layout=current_app.config['LAYOUT_INDEX'])
+    if restart:
+        directory_import.clear_checkpoint()
+
+    def progress(directory_import):
+        click.echo('{0.done}/{0.total} files, {0.imported} imported, {0.skipped} skipped, {1} failed, '
+                   '{0.files_per_second:.1f} files/s'.format(directory_import, len(directory_import.failed)))
+
+    directory_import.run(progress)
+
+    for failed_path, error in directory_import.failed:
+        click.echo('Failed {}: {}'.format(failed_path, error), err=True)
+    click.echo('Imported {} of {} files.'.format(directory_import.imported, directory_import.total))
+
+@click.command('reextract')
+@with_appcontext
+def reextract_command():
+    """Re-extract every document with a stored layout index using the current extraction rules."""
+    from . import reextract_documents
+
+    started = time.time()
+    processed, updated = reextract_documents()
+    elapsed = time.time() - started
+
+    click.echo('Re-extracted {} layout indexes, updated {} documents in {:.1f}s ({:.1f} documents/s).'.format(
+        processed, updated, elapsed, processed / elapsed if elapsed > 0 else 0.0))
+
+def migrate_to_shards(drop_source=False):
+    """Copy the documents of the DATABASE file into the DB_SHARDS shard files and return the count per shard
+    
+    Documents keep their ids and go to the shard shard_for_hash routes their content to, with their
+    layout indexes, so uploads of the same content find them and re-extraction updates them. Documents
+    without a content hash go to the shard of their id. The document_location table lists the documents
+    whose id belongs to another shard, and the id sequence is moved past the largest migrated id.
+    Shards are filled in parallel, each in one transaction.
+    
+    :param drop_source: drop the document tables from the DATABASE file once every shard is committed (default: False)
+    """
+    shards = shard_count()
+    if shards <= 1:
+        raise ValueError('Set DB_SHARDS to the number of shards to migrate to')
+
+    source = get_db()
+    if source.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'document'").fetchone() is None:
+        raise ValueError('The database has no document table to migrate')
+
+    with current_app.open_resource('schema.sql') as f:
+        schema = f.read().decode('utf8')
+    with current_app.open_resource('shard_schema.sql') as f:
+        shard_schema = f.read().decode('utf8')
+
+    for index, shard in enumerate(get_shards()):
+        exists = shard.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'document'").fetchone()
+        if exists is not None and shard.execute("SELECT 1 FROM document LIMIT 1").fetchone() is not None:
+            raise ValueError('Shard {} already has documents'.format(index))
+
+    revision = source.execute("SELECT revision FROM document_revision").fetchone()[0]
+    source_path = get_pool().database
+
+    # The shard of each migrated document, as SQL over the source document table
+    shard_sql = "CASE WHEN content_hash IS NULL THEN (id - 1) % {0:d} ELSE shard_for_hash(content_hash, {0:d}) END".format(shards)
+
+    # Written before the shards, so a failed migration is run again from scratch
+    # A database created before sharding has no id tables yet
+    source.executescript(schema[schema.index(DOCUMENT_ID_MARKER):])
+    source.create_function('shard_for_hash', 2, shard_for_hash)
+    with source:
+        source.execute("DELETE FROM document_location")
+        source.execute(
+            "INSERT INTO document_location (id, shard) SELECT id, shard FROM"
+            " (SELECT id, {} AS shard FROM document) WHERE shard != (id - 1) % ?".format(shard_sql), (shards,))
+        source.execute(
+            "UPDATE document_sequence SET last_id = MAX(last_id, (SELECT IFNULL(MAX(id), 0) FROM document))")
+
+    def migrate(database, index, items):
+        database.executescript(shard_schema)
+        database.create_function('shard_for_hash', 2, shard_for_hash)
+        database.execute("ATTACH DATABASE ? AS source", (source_path,))
+        try:
+            # AUTOINCREMENT moves the shard's sqlite_sequence to its largest migrated id
+            cursor = database.execute(
+                "INSERT INTO document (id, filename, plaintiff, defendants, content_hash)"
+                " SELECT id, filename, plaintiff, defendants, content_hash FROM source.document"
+                " WHERE {} = ? ORDER BY id".format(shard_sql), (index,))
+            count = cursor.rowcount
+            database.execute(
+                "INSERT OR IGNORE INTO document_layout (content_hash, layout)"
+                " SELECT content_hash, layout FROM source.document_layout"
+                " WHERE content_hash IN (SELECT content_hash FROM main.document)")
+            database.execute("UPDATE document_revision SET revision = ?", (revision,))
+            database.commit()
+        finally:
+            database.rollback()
+            database.execute("DETACH DATABASE source")
+        return count
+
+    counts = map_shards(migrate, {index: None for index in range(shards)})
+
+    if drop_source:
+        source.executescript(
+            "DROP TABLE IF EXISTS document_fts; DROP TABLE IF EXISTS document;"
+            " DROP TABLE IF EXISTS document_layout; DROP TABLE IF EXISTS document_revision;")
+
+    for name in ('extraction_cache', 'document_response_cache'):
+        current_app.extensions[name].clear()
+
+    return [counts[index] for index in range(shards)]
+
+@click.command('migrate-shards')
+@click.option('--drop-source', is_flag=True, help='Drop the document tables from the DATABASE file once migrated.')
+@with_appcontext
+def migrate_shards_command(drop_source):
+    """Move the documents of a single file database into the DB_SHARDS shard files."""
+    try:
+        counts = migrate_to_shards(drop_source)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    click.echo('Migrated {} documents into {} shards ({}).'.format(
+        sum(counts), len(counts), ', '.join(str(count) for count in counts)))
+
+def pool_stats_view():
+    """Show the connection pool size and usage of this process"""
+    stats = get_pool().stats()
+    if shard_count() > 1:
+        stats['shards'] = [pool.stats() for pool in current_app.extensions['db_shard_pools']]
+    return jsonify(stats)
 
 def init_app(app):
+    pool = app.extensions['db_pool'] = ConnectionPool(app.config)
+    # With a single shard the documents share the DATABASE file and its connections
+    paths = shard_paths(app.config)
+    app.extensions['db_shard_pools'] = [pool] if len(paths) == 1 else [ConnectionPool(app.config, path) for path in paths]
     app.teardown_appcontext(close_db)
-    app.cli.add_command(init_db_command)
\ No newline at end of file
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(import_dir_command)
+    app.cli.add_command(reextract_command)
+    app.cli.add_command(migrate_shards_command)
+    app.add_url_rule('/db/pool', 'db_pool', pool_stats_view)
@@ -0,0 +1,199 @@
+"""Offline bulk import of a directory tree of xml files, used by `flask import-dir`"""
+
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.datastructures import FileStorage
+from . import db, insert_documents
+from .LegalMation import XmlParser
+from .cache import HASH_CHUNK_SIZE
+from .compression import XML_EXTENSIONS
+
+IMPORT_EXTENSIONS = XML_EXTENSIONS
+
+def find_files(directory):
+    """Return the relative paths of the importable files under a directory, in a stable order
+
+    Paths are sorted by their components, so a checkpoint path splits the list into done and to do.
+
+    :param directory: string path of the directory to scan
+    """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.lower().endswith(IMPORT_EXTENSIONS):
+                paths.append(os.path.relpath(os.path.join(dirpath, filename), directory))
+
+    return sorted(paths, key=path_key)
+
+def path_key(path):
+    """Sort key of a relative path: its components, so the files of each directory stay together"""
+    return path.split(os.sep)
+
+def hash_path(path):
+    """Return the SHA-256 hex digest of a file, read in chunks
+
+    :param path: string path of the file
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def extract_path(path, mode, page_budget=None, record_layout=False):
+    """Extract one file by path and return a (parsed_data, error) tuple
+
+    Runs inside the process pool, the file is opened there so only the path crosses processes.
+
+    :param path: string path of the file
+    :param mode: XmlParser extraction mode
+    :param page_budget: XmlParser page budget (default: None)
+    :param record_layout: add the recorded layout_index bytes to parsed_data as 'layout' (default: False)
+    """
+    try:
+        with open(path, 'rb') as fp:
+            lm_xml_parser = XmlParser(FileStorage(fp, filename=os.path.basename(path)), mode=mode, page_budget=page_budget,
+                                      record_layout=record_layout)
+            parsed_data = lm_xml_parser.extract()
+        if record_layout:
+            parsed_data['layout'] = lm_xml_parser.layout
+        return parsed_data, None
+    except IOError:
+        return None, 'Invalid xml file.'
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+class DirectoryImport:
+    """Import the xml files of a directory tree in transactions of batch_size files
+
+    Files are hashed in the calling process and skipped when their content hash is already in the
+    document table, the rest are extracted in a process pool. Documents and their layouts are inserted
+    with insert_documents, then the last file of the batch is committed to the import_checkpoint table,
+    so an interrupted import resumes after it. A batch interrupted between the two is imported again,
+    its files are then skipped as already known. Runs inside an app context.
+
+    :param database: sqlite3 connection to the DATABASE file, where the checkpoint is kept
+    :param directory: string path of the directory to import
+    :param mode: XmlParser extraction mode
+    :param page_budget: XmlParser page budget (default: None)
+    :param batch_size: number of files per transaction (default: 1000)
+    :param max_workers: number of worker processes, 0 extracts in the calling process (default: None)
+    :param record_layout: store a layout_index of each extracted file (default: False)
+    """
+    def __init__(self, database, directory, mode, page_budget=None, batch_size=1000, max_workers=None, record_layout=False):
+        self.database = database
+        self.directory = os.path.realpath(directory)
+        self.mode = mode
+        self.page_budget = page_budget
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.record_layout = record_layout
+
+        # Counters
+        self.total = 0
+        self.done = 0
+        self.imported = 0
+        self.skipped = 0
+        self.failed = []
+        self.started = None
+
+    def checkpoint(self):
+        """Return the last relative path committed by a previous import of this directory, or None"""
+        sql = "SELECT last_path FROM import_checkpoint WHERE directory = ?"
+        row = self.database.execute(sql, (self.directory,)).fetchone()
+        return row[0] if row is not None else None
+
+    def clear_checkpoint(self):
+        self.database.execute("DELETE FROM import_checkpoint WHERE directory = ?", (self.directory,))
+        self.database.commit()
+
+    def known_hashes(self):
+        """Return the set of content hashes already in the document table of every shard"""
+        sql = "SELECT content_hash FROM document WHERE content_hash IS NOT NULL"
+        return {row[0] for shard in db.get_shards() for row in shard.execute(sql)}
+
+    def pending_files(self):
+        """Return the relative paths that come after the checkpoint"""
+        paths = find_files(self.directory)
+        last_path = self.checkpoint()
+
+        if last_path is not None:
+            last_key = path_key(last_path)
+            paths = [path for path in paths if path_key(path) > last_key]
+
+        return paths
+
+    def run(self, progress=None):
+        """Import every pending file
+
+        :param progress: callable called with this DirectoryImport after each transaction (default: None)
+        """
+        paths = self.pending_files()
+        known = self.known_hashes()
+
+        self.total = len(paths)
+        self.started = time.time()
+
+        executor = None
+        if self.max_workers != 0:
+            executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+        try:
+            for start in range(0, len(paths), self.batch_size):
+                self.__import_batch(paths[start:start + self.batch_size], known, executor)
+                if progress is not None:
+                    progress(self)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def __import_batch(self, paths, known, executor):
+        # Hash first so known files are never parsed, duplicates within the import are skipped too
+        new_paths, new_hashes = [], []
+        for path in paths:
+            content_hash = hash_path(os.path.join(self.directory, path))
+            if content_hash in known:
+                self.skipped += 1
+            else:
+                known.add(content_hash)
+                new_paths.append(path)
+                new_hashes.append(content_hash)
+
+        full_paths = [os.path.join(self.directory, path) for path in new_paths]
+        modes = [self.mode] * len(full_paths)
+        page_budgets = [self.page_budget] * len(full_paths)
+        record_layouts = [self.record_layout] * len(full_paths)
+
+        if executor is None:
+            extracted = list(map(extract_path, full_paths, modes, page_budgets, record_layouts))
+        else:
+            extracted = list(executor.map(extract_path, full_paths, modes, page_budgets, record_layouts, chunksize=16))
+
+        documents = []
+        layouts = []
+        for path, content_hash, (parsed_data, error) in zip(new_paths, new_hashes, extracted):
+            if error is not None:
+                self.failed.append((path, error))
+                known.discard(content_hash)
+                continue
+            documents.append((path, parsed_data['plaintiff'], parsed_data['defendants'], content_hash))
+            if parsed_data.get('layout') is not None:
+                layouts.append((content_hash, parsed_data['layout']))
+
+        checkpoint_sql = "INSERT OR REPLACE INTO import_checkpoint (directory, last_path) VALUES (?, ?)"
+
+        # The checkpoint is only committed once every shard committed the documents it covers
+        insert_documents(documents, layouts)
+        with self.database:
+            self.database.execute(checkpoint_sql, (self.directory, paths[-1]))
+
+        self.imported += len(documents)
+        self.done += len(paths)
+
+    @property
+    def files_per_second(self):
+        elapsed = time.time() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
@@ -0,0 +1,207 @@
+"""Asynchronous ingest queue: uploads are spooled to disk and extracted by background workers"""
+
+import os
+import threading
+import uuid
+
+from . import db
+
+# Job statuses
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+def upload_size(file_storage):
+    """Return the size in bytes of an uploaded file without reading it
+    
+    :param file_storage: <werkzeug.datastructures.FileStorage> object
+    """
+    stream = file_storage.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+def spool_upload(file_storage, path):
+    """Write an uploaded file to path, hard linking it when the upload is already a file on disk
+    
+    :param file_storage: <werkzeug.datastructures.FileStorage> object
+    :param path: string destination path
+    """
+    stream = file_storage.stream
+    name = getattr(stream, 'name', None)
+
+    if isinstance(name, str) and os.path.isfile(name):
+        try:
+            stream.flush()
+            os.link(name, path)
+            return
+        except OSError:
+            # Different filesystem or no hard link support
+            pass
+
+    file_storage.save(path)
+
+class IngestQueue:
+    """A pool of background worker threads that extract spooled uploads recorded in the `job` table
+    
+    Workers are started by the first request when INGEST_ASYNC is on, or by the first submitted job.
+    They claim queued jobs from SQLite, so jobs left queued by a previous process are picked up as
+    well. On start, jobs left running for INGEST_STALE_JOB_TIMEOUT seconds, by a process that
+    crashed or was killed, are queued again.
+    
+    :param app: <flask.Flask> object
+    :param handler: function(filename, spool_path, content_hash) that extracts and inserts a document
+        and returns its id, called inside an app context
+    """
+    def __init__(self, app, handler):
+        self.app = app
+        self.handler = handler
+        self.spool_dir = app.config['INGEST_SPOOL_DIR']
+        self.workers = app.config['INGEST_WORKERS']
+        self.poll_interval = app.config['INGEST_POLL_INTERVAL']
+        self.stale_job_timeout = app.config['INGEST_STALE_JOB_TIMEOUT']
+
+        self.__threads = []
+        self.__pid = None
+        self.__lock = threading.Lock()
+        self.__condition = threading.Condition()
+        self.__stopped = threading.Event()
+
+        app.before_first_request(self.__start_async)
+
+    def __start_async(self):
+        if self.app.config['INGEST_ASYNC']:
+            self.start()
+
+    def submit(self, file_storage, content_hash=None):
+        """Spool an uploaded file to disk, record a queued job and return the job Row object
+        
+        :param file_storage: <werkzeug.datastructures.FileStorage> object
+        :param content_hash: string SHA-256 hex digest of the uploaded file (default: None)
+        """
+        os.makedirs(self.spool_dir, exist_ok=True)
+        spool_path = os.path.join(self.spool_dir, uuid.uuid4().hex + '.xml')
+        spool_upload(file_storage, spool_path)
+
+        sql = "INSERT INTO job (filename, spool_path, content_hash) VALUES (?, ?, ?)"
+
+        database = db.get_db()
+        cursor = database.cursor()
+        cursor.execute(sql, (file_storage.filename, spool_path, content_hash))
+        database.commit()
+        job_id = cursor.lastrowid
+        cursor.close()
+
+        self.start()
+        with self.__condition:
+            self.__condition.notify()
+
+        return find_job_by_id(job_id)
+
+    def start(self):
+        """Start the worker threads of this process if they are not running"""
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+            self.__pid = os.getpid()
+            self.__stopped.clear()
+
+            with self.app.app_context():
+                self.requeue_stale_jobs()
+
+            self.__threads = [
+                threading.Thread(target=self.__run, name='ingest-worker-{}'.format(i), daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self.__threads:
+                thread.start()
+
+    def requeue_stale_jobs(self):
+        """Queue again the running jobs not updated for stale_job_timeout seconds and return their number"""
+        if self.stale_job_timeout is None:
+            return 0
+
+        sql = ("UPDATE job SET status = ?, updated = CURRENT_TIMESTAMP "
+               "WHERE status = ? AND updated <= datetime('now', ?)")
+
+        database = db.get_db()
+        cursor = database.execute(sql, (JOB_QUEUED, JOB_RUNNING, '-{} seconds'.format(self.stale_job_timeout)))
+        database.commit()
+
+        if cursor.rowcount:
+            self.app.logger.warning('Queued %s stale ingest jobs again', cursor.rowcount)
+        return cursor.rowcount
+
+    def stop(self, timeout=None):
+        """Stop the worker threads, letting running jobs finish"""
+        with self.__lock:
+            self.__stopped.set()
+            with self.__condition:
+                self.__condition.notify_all()
+            for thread in self.__threads:
+                thread.join(timeout)
+            self.__threads = []
+            self.__pid = None
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            with self.app.app_context():
+                job = self.__claim()
+                if job is not None:
+                    self.__process(job)
+                    continue
+
+            with self.__condition:
+                self.__condition.wait(self.poll_interval)
+
+    def __claim(self):
+        """Mark the oldest queued job as running and return it, or None"""
+        database = db.get_db()
+
+        database.execute('BEGIN IMMEDIATE')
+        job = database.execute("SELECT * FROM job WHERE status = ? ORDER BY id LIMIT 1", (JOB_QUEUED,)).fetchone()
+        if job is not None:
+            database.execute("UPDATE job SET status = ?, updated = CURRENT_TIMESTAMP WHERE id = ?", (JOB_RUNNING, job['id']))
+        database.commit()
+
+        return job
+
+    def __process(self, job):
+        try:
+            document_id = self.handler(job['filename'], job['spool_path'], job['content_hash'])
+            update_job(job['id'], JOB_DONE, document_id=document_id)
+        except Exception as e:
+            self.app.logger.exception('Ingest job %s failed', job['id'])
+            update_job(job['id'], JOB_FAILED, error='Invalid xml file.' if isinstance(e, IOError) else str(e))
+        finally:
+            try:
+                os.remove(job['spool_path'])
+            except OSError:
+                pass
+
+def find_job_by_id(job_id):
+    """Find and return one job Row object
+    
+    :param job_id: int id
+    """
+    sql = "SELECT * FROM job WHERE id = ?"
+
+    database = db.get_db()
+    return database.execute(sql, (job_id,)).fetchone()
+
+def update_job(job_id, status, document_id=None, error=None):
+    """Set the status, document id and error of a job
+    
+    :param job_id: int id
+    :param status: one of JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+    :param document_id: int id of the extracted document (default: None)
+    :param error: string error message (default: None)
+    """
+    sql = "UPDATE job SET status = ?, document_id = ?, error = ?, updated = CURRENT_TIMESTAMP WHERE id = ?"
+
+    database = db.get_db()
+    database.execute(sql, (status, document_id, error, job_id))
+    database.commit()
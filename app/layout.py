@@ -0,0 +1,113 @@
+"""Caption extraction from <line> coordinates with vectorised numpy comparisons
+
+Used by the XmlParser 'geometric' mode. numpy is optional, install the `geometric` extra to use it.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# <line> attributes loaded for every <formatting> element, in CaptionLayout.coordinates column order
+LINE_COORDINATES = ('l', 't', 'r', 'b', 'baseline')
+
+def line_coordinate(value):
+    """Return a <line> attribute as a float, NaN if it is missing or not numeric"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def _first_after(indices, start):
+    """Return the first of the sorted indices greater than start, or None"""
+    if start is None:
+        return None
+    indices = indices[indices > start]
+    return int(indices[0]) if indices.size else None
+
+class CaptionLayout:
+    """The <formatting> elements of the caption pages, in document order, with their <line> geometry
+
+    `coordinates` is a (elements, len(LINE_COORDINATES)) float array, each element gets the coordinates
+    of its <line>. Anchors, zones and the left column are found with comparisons over whole arrays,
+    Python only touches the text of the selected elements.
+    """
+
+    def __init__(self):
+        self.texts = []
+        self.coordinates = np.empty((0, len(LINE_COORDINATES)))
+        self.__anchors = None
+
+    def add_page(self, page, line_tag, formatting_tag):
+        """Append the <formatting> elements of a <page> element
+
+        :param page: <page> lxml element
+        :param line_tag: namespaced <line> tag
+        :param formatting_tag: namespaced <formatting> tag
+        """
+        rows, texts = [], []
+
+        for line in page.iter(line_tag):
+            coordinates = [line_coordinate(line.get(name)) for name in LINE_COORDINATES]
+            for elem in line.iterchildren(formatting_tag):
+                rows.append(coordinates)
+                texts.append(elem.text or '')
+
+        if rows:
+            self.coordinates = np.concatenate((self.coordinates, np.array(rows, dtype=float)))
+            self.texts.extend(texts)
+            self.__anchors = None
+
+    def anchors(self):
+        """Return the (county, plaintiff, defendants bound, defendants end) element indices, None if not found
+
+        Same as the stream mode: the first 'COUNTY OF', then the first 'Plaintiff,' after it, then
+        the first element starting with 'Defendants' and the first 'Defendants.' after that.
+        """
+        if self.__anchors is None:
+            texts = np.array(self.texts, dtype=str)
+
+            county = np.flatnonzero(np.char.find(texts, 'COUNTY OF') >= 0)
+            first_county = int(county[0]) if county.size else None
+            plaintiff = _first_after(np.flatnonzero(np.char.startswith(texts, 'Plaintiff,')), first_county)
+            defendants_bound = _first_after(np.flatnonzero(np.char.startswith(texts, 'Defendants')), plaintiff)
+            defendants_end = _first_after(np.flatnonzero(np.char.startswith(texts, 'Defendants.')), plaintiff)
+
+            self.__anchors = first_county, plaintiff, defendants_bound, defendants_end
+
+        return self.__anchors
+
+    @property
+    def resolved(self):
+        """True once both zones are closed by their anchors"""
+        return self.anchors()[3] is not None
+
+    def zone(self, start, end, bound):
+        """Return the texts of the elements between two indices whose <line> starts left of the bound element's
+
+        :param start: index of the element opening the zone (exclusive)
+        :param end: index of the element closing the zone (exclusive)
+        :param bound: index of the element whose <line> left position bounds the left column
+        """
+        index = np.arange(len(self.texts))
+        left = self.coordinates[:, 0]
+
+        # NaN positions compare False, so elements of lines without @l are left out like in the dom mode
+        mask = (index > start) & (index < end) & (left < left[bound])
+
+        return [self.texts[i] for i in np.flatnonzero(mask)]
+
+    def zone_texts(self):
+        """Return the (plaintiff texts, defendants texts) lists"""
+        county, plaintiff, defendants_bound, defendants_end = self.anchors()
+
+        plaintiff_texts = []
+        if county is not None and plaintiff is not None:
+            plaintiff_texts = self.zone(county, plaintiff, plaintiff)
+
+        defendants_texts = []
+        if defendants_end is not None:
+            # Same as the dom mode, the first defendants element is always the 'vs.' or 'v.' text
+            defendants_texts = self.zone(plaintiff, defendants_end, defendants_bound)[1:]
+
+        return plaintiff_texts, defendants_texts
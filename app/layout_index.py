@@ -0,0 +1,151 @@
+"""Compact binary index of a document's caption pages, used to re-extract documents without their xml
+
+The index keeps every <formatting> element of the last MAX_PAGES pages the 'paged' mode read, with the
+coordinates of its <line>, in flat arrays. The walk stops on the page that resolves the caption, so
+these are the caption pages, and memory stays flat when the caption is far into the document or
+missing. It is stored zlib compressed in the document_layout table:
+
+    header      struct '<4sII': MAGIC, number of elements, number of text bytes
+    lines       array('I'), line number of each element
+    coordinates array('f'), layout.LINE_COORDINATES of each element's <line>, NaN when missing
+    lengths     array('I'), utf-8 byte length of each element's text
+    texts       the utf-8 texts, concatenated
+
+Arrays are stored little-endian.
+"""
+
+import struct
+import sys
+import zlib
+from array import array
+from collections import deque
+
+from . import rules
+from .layout import LINE_COORDINATES, line_coordinate
+
+MAGIC = b'LMX1'
+HEADER = struct.Struct('<4sII')
+
+# Number of last read pages a LayoutRecorder keeps
+MAX_PAGES = 3
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+class LayoutRecorder:
+    """Collects the <formatting> elements of the last parsed pages and serializes them with dumps()
+
+    Line numbers keep counting over the dropped pages, pages_dropped counts them.
+
+    :param max_pages: number of last pages kept (default: MAX_PAGES, None keeps every page)
+    """
+
+    def __init__(self, max_pages=MAX_PAGES):
+        # (lines, coordinates, lengths, texts) of each kept page
+        self.pages = deque(maxlen=max_pages)
+        self.pages_dropped = 0
+        self.__line_number = 0
+
+    def add_page(self, page, line_tag, formatting_tag):
+        """Append the <formatting> elements of a <page> element, dropping the oldest page once max_pages are kept
+
+        :param page: <page> lxml element
+        :param line_tag: namespaced <line> tag
+        :param formatting_tag: namespaced <formatting> tag
+        """
+        lines = array('I')
+        coordinates = array('f')
+        lengths = array('I')
+        texts = []
+
+        for line in page.iter(line_tag):
+            self.__line_number += 1
+            line_coordinates = [line_coordinate(line.get(name)) for name in LINE_COORDINATES]
+
+            for elem in line.iterchildren(formatting_tag):
+                text = (elem.text or '').encode('utf8')
+                lines.append(self.__line_number)
+                coordinates.extend(line_coordinates)
+                lengths.append(len(text))
+                texts.append(text)
+
+        if len(self.pages) == self.pages.maxlen:
+            self.pages_dropped += 1
+        self.pages.append((lines, coordinates, lengths, texts))
+
+    def dumps(self, level=6):
+        """Return the compressed index
+
+        :param level: zlib compression level (default: 6)
+        """
+        lines = array('I')
+        coordinates = array('f')
+        lengths = array('I')
+        for page_lines, page_coordinates, page_lengths, page_texts in self.pages:
+            lines.extend(page_lines)
+            coordinates.extend(page_coordinates)
+            lengths.extend(page_lengths)
+
+        texts = b''.join(text for page in self.pages for text in page[3])
+        data = b''.join((
+            HEADER.pack(MAGIC, len(lines), len(texts)),
+            _little_endian(lines).tobytes(),
+            _little_endian(coordinates).tobytes(),
+            _little_endian(lengths).tobytes(),
+            texts,
+        ))
+        return zlib.compress(data, level)
+
+class LayoutIndex:
+    """A decompressed layout index
+
+    :param data: bytes returned by LayoutRecorder.dumps
+    """
+    def __init__(self, data):
+        data = zlib.decompress(data)
+        magic, count, text_size = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('Invalid layout index')
+
+        offset = HEADER.size
+        self.lines, offset = self.__read_array(data, offset, 'I', count)
+        self.coordinates, offset = self.__read_array(data, offset, 'f', count * len(LINE_COORDINATES))
+        lengths, offset = self.__read_array(data, offset, 'I', count)
+
+        self.texts = []
+        for length in lengths:
+            self.texts.append(data[offset:offset + length].decode('utf8'))
+            offset += length
+
+    @staticmethod
+    def __read_array(data, offset, typecode, count):
+        values = array(typecode)
+        end = offset + values.itemsize * count
+        values.frombytes(data[offset:end])
+        return _little_endian(values), end
+
+    def __len__(self):
+        return len(self.texts)
+
+    def elements(self):
+        """Iterate over (line number, left position, text) tuples in document order, left is None when missing"""
+        width = len(LINE_COORDINATES)
+        for index, (line_number, text) in enumerate(zip(self.lines, self.texts)):
+            left = self.coordinates[index * width]
+            yield line_number, (left if left == left else None), text
+
+    def extract(self, fields=rules.DEFAULT_FIELDS):
+        """Run the extraction rules over the indexed elements and return the fields dict
+
+        :param fields: iterable of rules.RULES names (default: rules.DEFAULT_FIELDS)
+        """
+        matcher = rules.compile_rules(fields).matcher()
+
+        for line_number, left, text in self.elements():
+            if matcher.feed(line_number, left, text):
+                break
+
+        return matcher.results()
@@ -0,0 +1,210 @@
+"""In-process timing histograms and a Prometheus text /metrics endpoint
+
+Metrics are kept per process. Stage timings are recorded with `timed(stage)` around the hot paths of
+the upload endpoint, XmlParser and the database functions. When METRICS_STAGE_HEADER is enabled,
+the stages of each request are also returned in a `Server-Timing` response header.
+"""
+
+import bisect
+import threading
+import time
+
+from flask import Response, current_app, g, has_app_context, request
+
+# Histogram bucket upper bounds in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+class Histogram:
+    """A thread-safe histogram family with fixed buckets
+    
+    :param name: metric name
+    :param help: metric description
+    :param labelnames: tuple of label names
+    :param buckets: tuple of increasing bucket upper bounds (default: DEFAULT_BUCKETS)
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.__series = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        """Record a value for the given label values"""
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.__lock:
+            series = self.__series.get(labels)
+            if series is None:
+                series = self.__series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        """Return a snapshot of {labels: (bucket counts, sum, count)}"""
+        with self.__lock:
+            return {labels: (list(series[0]), series[1], series[2]) for labels, series in self.__series.items()}
+
+    def expose(self):
+        lines = []
+        for labels, (counts, total, count) in sorted(self.samples().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labelnames, labels, ('le', le)), cumulative))
+            lines.append('{}_sum{} {!r}'.format(self.name, _format_labels(self.labelnames, labels), total))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labelnames, labels), count))
+        return lines
+
+class Counter:
+    """A thread-safe counter family
+    
+    :param name: metric name
+    :param help: metric description
+    :param labelnames: tuple of label names
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def expose(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{}{} {!r}'.format(self.name, _format_labels(self.labelnames, labels), value) for labels, value in values]
+
+class Gauge(Counter):
+    """A thread-safe gauge family, set to the current value before each scrape"""
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+class Registry:
+    """A collection of metric families rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self.__metrics = []
+
+    def register(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.__metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    'lm_stage_duration_seconds', 'Time spent in each upload, parse and database stage', ('stage',)))
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'lm_request_duration_seconds', 'Time spent handling each request', ('endpoint', 'method')))
+REQUESTS = REGISTRY.register(Counter(
+    'lm_requests_total', 'Number of handled requests', ('endpoint', 'method', 'status')))
+DB_POOL_CONNECTIONS = REGISTRY.register(Gauge(
+    'lm_db_pool_connections', 'SQLite connection pool size and usage of this process', ('state',)))
+ADMISSION_REQUESTS = REGISTRY.register(Gauge(
+    'lm_admission_requests', 'Uploads admitted (running) and waiting (queued) for parse capacity in this process', ('state',)))
+ADMISSION_BYTES = REGISTRY.register(Gauge(
+    'lm_admission_bytes', 'Request body bytes admitted (running) and waiting (queued) for parse capacity', ('state',)))
+ADMISSION_REJECTIONS = REGISTRY.register(Counter(
+    'lm_admission_rejections_total', 'Uploads rejected with 429 because the wait queue was full or the wait timed out',
+    ('reason',)))
+
+class timed:
+    """Context manager that records the time spent in a stage
+    
+    :param stage: string stage name, e.g. 'parse.load'
+    """
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        STAGE_DURATION.observe(elapsed, self.stage)
+
+        # Keep the breakdown of the current request for the Server-Timing header
+        if has_app_context():
+            timings = g.get('stage_timings')
+            if timings is not None:
+                timings.append((self.stage, elapsed))
+        return False
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.stage_timings = []
+
+def _finish_request(response):
+    start = g.pop('request_start', None)
+    if start is None:
+        return response
+
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_DURATION.observe(time.perf_counter() - start, endpoint, request.method)
+    REQUESTS.inc(endpoint, request.method, str(response.status_code))
+
+    timings = g.pop('stage_timings', None)
+    if current_app.config['METRICS_STAGE_HEADER'] and timings:
+        response.headers['Server-Timing'] = ', '.join(
+            '{};dur={:.3f}'.format(stage, elapsed * 1000) for stage, elapsed in timings)
+
+    return response
+
+def metrics_view():
+    """Show the metrics of this process in the Prometheus text format"""
+    pool = current_app.extensions.get('db_pool')
+    if pool is not None:
+        for state, value in pool.stats().items():
+            DB_POOL_CONNECTIONS.set(value, state)
+
+    admission = current_app.extensions.get('admission')
+    if admission is not None:
+        stats = admission.stats()
+        ADMISSION_REQUESTS.set(stats['running'], 'running')
+        ADMISSION_REQUESTS.set(stats['queued'], 'queued')
+        ADMISSION_BYTES.set(stats['in_flight_bytes'], 'running')
+        ADMISSION_BYTES.set(stats['queued_bytes'], 'queued')
+
+    return Response(REGISTRY.expose(), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
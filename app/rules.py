@@ -0,0 +1,341 @@
+"""Declarative extraction rules, compiled into one matcher that fills every field in a single pass
+
+A Rule describes a field as data: the anchors opening and closing its zone, the anchor whose <line>
+left position bounds its column, and how the selected text is cleaned up. compile_rules() combines
+the anchors of all active rules into one regular expression, so each <formatting> element is searched
+once for any anchor, and a RuleMatcher walks the elements of a document in order. Elements matching
+no anchor only go to the rules whose zone is open.
+"""
+
+import itertools
+import re
+from collections import deque
+
+# Splits off text that follows 2 or more whitespaces (the right side of the document)
+WHITESPACE_SPLITTER = re.compile(r'\s{2}')
+
+class Rule:
+    """Declaration of one extracted field
+
+    Anchors are regular expressions searched in the text of each <formatting> element.
+
+    :param name: field name, the key of the extracted text
+    :param start: anchor opening the zone after its first match (default: None, the zone opens at the first element)
+    :param end: anchor closing the zone at its first match after start (default: None, the zone runs to the end)
+    :param bound: anchor whose first match from start on gives the column bound, the left position
+        of its <line> (default: None, no column bound)
+    :param right_of_bound: keep elements right of the bound instead of left of it (default: False)
+    :param include_start: keep the element matching start in the zone (default: False)
+    :param match: regular expression one element of a <line> must contain for the line to be kept (default: None, keep all)
+    :param skip: number of leading kept elements to drop (default: 0)
+    :param lines: number of <line> elements to keep (default: None, no limit)
+    :param keep: 'first' or 'last' lines when lines is set (default: 'first')
+    :param split_column: strip the text after 2 or more whitespaces of each element (default: False)
+    :param separator: string joining the kept texts of one <line> (default: ' ')
+    :param line_separator: string joining the kept texts of different <line> elements (default: None, the separator)
+    :param pattern: regular expression applied to the joined text, its first group is the field value (default: None)
+    :param required: the walk may stop only once this rule is resolved (default: True)
+    """
+    def __init__(self, name, start=None, end=None, bound=None, right_of_bound=False, include_start=False, match=None,
+                 skip=0, lines=None, keep='first', split_column=False, separator=' ', line_separator=None, pattern=None,
+                 required=True):
+        if keep not in ('first', 'last'):
+            raise ValueError('Invalid keep value: {}'.format(keep))
+
+        self.name = name
+        self.start = start
+        self.end = end
+        self.bound = bound
+        self.right_of_bound = right_of_bound
+        self.include_start = include_start
+        self.match = re.compile(match) if match is not None else None
+        self.skip = skip
+        self.lines = lines
+        self.keep = keep
+        self.split_column = split_column
+        self.separator = separator
+        self.line_separator = line_separator if line_separator is not None else separator
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        self.required = required
+
+    def anchors(self):
+        return [anchor for anchor in (self.start, self.end, self.bound) if anchor is not None]
+
+# Built-in rules. Plaintiff and defendants give the same output as the dom mode XPath queries.
+RULES = {
+    'plaintiff': Rule(
+        'plaintiff', start=r'COUNTY OF', end=r'^Plaintiff,', bound=r'^Plaintiff,', split_column=True),
+    'defendants': Rule(
+        # The first defendants element is always the 'vs.' or 'v.' text
+        'defendants', start=r'^Plaintiff,', end=r'^Defendants\.', bound=r'^Defendants', skip=1, split_column=True),
+    'case_number': Rule(
+        # The number is the first line right of the 'Case No.:' / 'CASE NUMBER:' label
+        'case_number', start=r'(?i:\bcase\s+n(?:o\b|umber))', bound=r'(?i:\bcase\s+n(?:o\b|umber))',
+        right_of_bound=True, lines=1, separator='', pattern=r'^\W*(.*?)\W*$', required=False),
+    'court': Rule(
+        # Filing stamps also mention the court, the caption's court line is the last one before the county
+        'court', end=r'COUNTY OF', match=r'COURT OF', lines=1, keep='last', required=False),
+    'county': Rule(
+        'county', start=r'COUNTY OF', include_start=True, lines=1, pattern=r'COUNTY OF\s+(.*?)\W*$',
+        required=False),
+    'attorneys': Rule(
+        # Lines left of the caption with a word or a phone number, which skips the line numbers in the margin,
+        # short OCR noise and the date and time line of the filing stamp
+        'attorneys', end=r'(?i:attorneys? for)|COURT OF', bound=r'COUNTY OF',
+        match=r'^(?!\s*\d{1,2}-[A-Za-z]{3}-\d{4}\s+\d{1,2}:\d{2}\s*$).*?(?:[^\W\d_]{2}|\d{3}\D{1,3}\d{4})',
+        separator='', line_separator='\n', required=False),
+}
+
+# Fields extracted when none are asked for
+DEFAULT_FIELDS = ('plaintiff', 'defendants')
+
+class CompiledRules:
+    """A set of rules with their anchors combined into one regular expression
+
+    :param rules: list of Rule objects
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        patterns = []
+        for rule in self.rules:
+            for anchor in rule.anchors():
+                if anchor not in patterns:
+                    patterns.append(anchor)
+
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        # Most elements match no anchor at all and are rejected by this single search
+        self.any_anchor = re.compile('|'.join('(?:{})'.format(pattern) for pattern in patterns)) if patterns else None
+        # Per rule, the index in self.patterns of its start, end and bound anchors
+        self.anchor_indexes = [
+            tuple(patterns.index(anchor) if anchor is not None else None for anchor in (rule.start, rule.end, rule.bound))
+            for rule in self.rules
+        ]
+
+    def matching(self, text):
+        """Return the set of pattern indexes matching a text"""
+        if self.any_anchor is None or self.any_anchor.search(text) is None:
+            return ()
+        return {index for index, pattern in enumerate(self.patterns) if pattern.search(text)}
+
+    def matcher(self):
+        """Return a new RuleMatcher for one document"""
+        return RuleMatcher(self)
+
+_compiled_rules = {}
+
+def compile_rules(fields=DEFAULT_FIELDS):
+    """Return the CompiledRules of built-in rules, compiled once per combination of fields
+
+    :param fields: iterable of RULES names (default: DEFAULT_FIELDS)
+    """
+    fields = tuple(fields)
+
+    compiled = _compiled_rules.get(fields)
+    if compiled is None:
+        unknown = [field for field in fields if field not in RULES]
+        if unknown:
+            raise ValueError('Unknown extraction fields: {}'.format(', '.join(unknown)))
+        compiled = _compiled_rules[fields] = CompiledRules(RULES[field] for field in fields)
+
+    return compiled
+
+# Rule states
+WAITING = 0
+OPEN = 1
+CLOSED = 2
+
+class _RuleState:
+    """Progress of one rule over one document"""
+
+    def __init__(self, rule, anchor_indexes):
+        self.rule = rule
+        self.start, self.end, self.bound_anchor = anchor_indexes
+        self.state = WAITING if rule.start is not None else OPEN
+        self.bound = None
+        self.bound_found = rule.bound is None
+        # Finished <line> groups of (line number, left position, text) tuples that may be selected. With
+        # a 'last' lines limit and no column bound or skip to apply later, only the last lines are kept.
+        if rule.lines is not None and rule.keep == 'last' and rule.bound is None and rule.skip == 0:
+            self.candidate_lines = deque(maxlen=rule.lines)
+        else:
+            self.candidate_lines = []
+        # Elements of the <line> being added, and whether one of them matches rule.match
+        self.current_line = []
+        self.current_line_number = None
+        self.current_line_matches = rule.match is None
+        # With a known bound, a 'first' lines limit closes the zone as soon as it is reached
+        self.limits_first_lines = rule.lines is not None and rule.keep == 'first' and rule.match is None
+        self.kept_lines = 0
+        self.last_line = None
+
+    @property
+    def resolved(self):
+        return self.state == CLOSED and self.bound_found
+
+    def feed(self, line_number, left, text, matched):
+        """Consume an element matching the anchor indexes in matched"""
+        if self.state == WAITING:
+            if self.start not in matched:
+                return
+            self.state = OPEN
+            self.__find_bound(left, matched)
+            if self.rule.include_start:
+                self.add(line_number, left, text)
+            return
+
+        self.__find_bound(left, matched)
+
+        if self.state == OPEN:
+            if self.end is not None and self.end in matched:
+                self.state = CLOSED
+            else:
+                self.add(line_number, left, text)
+
+    def __find_bound(self, left, matched):
+        if not self.bound_found and self.bound_anchor in matched:
+            self.bound = left
+            self.bound_found = True
+
+    def add(self, line_number, left, text):
+        """Add an element to the open zone, elements matching no anchor are only fed here
+
+        Return True when a 'first' lines limit closed the zone.
+        """
+        if self.state != OPEN:
+            return False
+
+        if self.limits_first_lines and self.bound_found:
+            if not self.__in_column(left):
+                return False
+            if line_number != self.last_line:
+                if self.kept_lines == self.rule.lines:
+                    self.state = CLOSED
+                    return True
+                self.kept_lines += 1
+                self.last_line = line_number
+
+        if line_number != self.current_line_number:
+            self.__finish_line()
+            self.current_line_number = line_number
+        if not self.current_line_matches and self.rule.match.search(text):
+            self.current_line_matches = True
+        self.current_line.append((line_number, left, text))
+        return False
+
+    def __finish_line(self):
+        # A line without any element matching rule.match is never selected, whatever its column
+        if self.current_line and self.current_line_matches:
+            self.candidate_lines.append(self.current_line)
+        self.current_line = []
+        self.current_line_matches = self.rule.match is None
+
+    @property
+    def candidates(self):
+        """(line number, left position, text) tuples collected so far"""
+        return [candidate for line in itertools.chain(self.candidate_lines, [self.current_line]) for candidate in line]
+
+    def __in_column(self, left):
+        if self.rule.bound is None:
+            return True
+        if left is None or self.bound is None:
+            return False
+        return left > self.bound if self.rule.right_of_bound else left < self.bound
+
+    def value(self):
+        """Return the field text from the candidates collected so far"""
+        rule = self.rule
+
+        if rule.start is not None and self.state == WAITING:
+            return ''
+        # Like the dom mode, a zone must be closed by its end anchor
+        if rule.end is not None and self.state != CLOSED:
+            return ''
+
+        candidates = [candidate for candidate in self.candidates if self.__in_column(candidate[1])]
+
+        if rule.match is not None:
+            line_numbers = {line_number for line_number, left, text in candidates if rule.match.search(text)}
+            candidates = [candidate for candidate in candidates if candidate[0] in line_numbers]
+
+        candidates = candidates[rule.skip:]
+
+        if rule.lines is not None:
+            line_numbers = sorted({line_number for line_number, left, text in candidates})
+            line_numbers = line_numbers[:rule.lines] if rule.keep == 'first' else line_numbers[-rule.lines:]
+            candidates = [candidate for candidate in candidates if candidate[0] in line_numbers]
+
+        lines = []
+        last_line = None
+        for line_number, left, text in candidates:
+            if rule.split_column:
+                text = WHITESPACE_SPLITTER.split(text, 1)[0]
+            if line_number != last_line:
+                lines.append([])
+                last_line = line_number
+            lines[-1].append(text)
+
+        value = rule.line_separator.join(rule.separator.join(texts) for texts in lines)
+
+        if rule.pattern is not None:
+            match = rule.pattern.search(value)
+            value = match.group(1) if match is not None else ''
+
+        return value
+
+class RuleMatcher:
+    """Walks the <formatting> elements of one document in order and fills every rule's field
+
+    :param compiled: CompiledRules object
+    """
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.states = [_RuleState(rule, indexes) for rule, indexes in zip(compiled.rules, compiled.anchor_indexes)]
+        self.required = [state for state in self.states if state.rule.required] or self.states
+
+        self.__line = None
+        self.__line_number = 0
+        self.__dispatch()
+
+    def __dispatch(self):
+        # Elements matching no anchor only change the open zones
+        self.__unresolved = [state for state in self.states if not state.resolved]
+        self.__open = [state for state in self.__unresolved if state.state == OPEN]
+        self.__done = all(state.resolved for state in self.required)
+
+    @property
+    def done(self):
+        """True once every required rule is resolved"""
+        return self.__done
+
+    def feed(self, line, left, text):
+        """Consume one <formatting> element, return True once every required rule is resolved
+
+        :param line: the element's <line> or any other value identifying it, used to tell lines apart
+        :param left: left position (@l) of the element's <line>
+        :param text: text of the element
+        """
+        if line != self.__line:
+            # Keeping a reference to the current line keeps lxml from reusing its proxy for another line
+            self.__line = line
+            self.__line_number += 1
+
+        matched = self.compiled.matching(text)
+
+        if matched:
+            # Anchors open and close zones and find bounds, so matching elements go to every unresolved rule
+            for state in self.__unresolved:
+                state.feed(self.__line_number, left, text, matched)
+            self.__dispatch()
+        else:
+            closed = False
+            for state in self.__open:
+                closed |= state.add(self.__line_number, left, text)
+            if closed:
+                self.__dispatch()
+
+        return self.__done
+
+    def results(self):
+        """Return a dict of field name to extracted text"""
+        return {state.rule.name: state.value() for state in self.states}
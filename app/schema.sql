@@ -1,8 +1,46 @@
-DROP TABLE IF EXISTS document;
+-- Tables of the DATABASE file, the document tables are in shard_schema.sql
 
-CREATE TABLE document (
+DROP TABLE IF EXISTS job;
+
+CREATE TABLE job (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     filename TEXT NOT NULL,
-    plaintiff TEXT NOT NULL,
-    defendants TEXT NOT NULL
-);
\ No newline at end of file
+    spool_path TEXT NOT NULL,
+    content_hash TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    -- Not a foreign key, the document may be in another shard file
+    document_id INTEGER,
+    error TEXT,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX job_status ON job (status);
+
+DROP TABLE IF EXISTS import_checkpoint;
+
+-- Last file committed by `flask import-dir` for each imported directory
+CREATE TABLE import_checkpoint (
+    directory TEXT PRIMARY KEY,
+    last_path TEXT NOT NULL,
+    updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+DROP TABLE IF EXISTS document_sequence;
+DROP TABLE IF EXISTS document_location;
+
+-- Document id tables
+-- Statements from here on are also run by `flask migrate-shards` and must be safe to run again
+
+-- Last document id allocated in any shard, see db.allocate_ids
+CREATE TABLE IF NOT EXISTS document_sequence (
+    last_id INTEGER NOT NULL
+);
+
+INSERT INTO document_sequence (last_id) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM document_sequence);
+
+-- Shard of the documents `flask migrate-shards` moved to another shard than the one owning their id
+CREATE TABLE IF NOT EXISTS document_location (
+    id INTEGER PRIMARY KEY,
+    shard INTEGER NOT NULL
+);
@@ -0,0 +1,62 @@
+"""Fast JSON serialization of document rows that bypasses flask-restplus marshalling
+
+The restplus models stay the source of truth for the Swagger documentation and for field order.
+The fast path builds plain dicts straight from sqlite3.Row tuples with the column order computed once
+per result set and encodes them with the fastest installed JSON library (orjson, then ujson, then json).
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+if orjson is not None:
+    JSON_ENCODER = 'orjson'
+
+    def dumps(obj):
+        """Return obj encoded as json bytes"""
+        return orjson.dumps(obj)
+elif ujson is not None:
+    JSON_ENCODER = 'ujson'
+
+    def dumps(obj):
+        """Return obj encoded as json bytes"""
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf8')
+else:
+    JSON_ENCODER = 'json'
+
+    def dumps(obj):
+        """Return obj encoded as json bytes"""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+
+def rows_to_dicts(rows, model_fields):
+    """Convert sqlite3.Row objects to dicts with the fields of a restplus model, in model order
+    
+    Fields that were not selected are left out, like a restplus mask. The column positions are looked
+    up once from the first row and reused for every other row.
+    
+    :param rows: iterable of sqlite3.Row objects that all come from one query
+    :param model_fields: restplus model (or any sequence of field names)
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return []
+
+    row_keys = first.keys()
+    columns = [(name, row_keys.index(name)) for name in model_fields if name in row_keys]
+
+    documents = [{name: first[index] for name, index in columns}]
+    documents.extend({name: row[index] for name, index in columns} for row in rows)
+    return documents
+
+def row_to_dict(row, model_fields):
+    """Convert one sqlite3.Row object to a dict with the fields of a restplus model, in model order"""
+    return rows_to_dicts([row], model_fields)[0]
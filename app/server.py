@@ -0,0 +1,111 @@
+"""Production server: runs the app under gunicorn's pre-fork worker model
+
+The app is created once in the master process, together with the compiled parser state, and the
+workers are forked from it so they share that memory copy-on-write. Workers open their own SQLite
+connections: the master closes its pools before forking and db.ConnectionPool, like the ingest and
+group commit threads, starts over in each new process. Install with the `server` extra
+and run `lm-server` (see `lm-server --help`), server settings default to the SERVER_* config values.
+"""
+
+import argparse
+import gc
+import multiprocessing
+
+from . import create_app, db
+from .LegalMation import precompile
+
+# Command line option -> config key
+SERVER_OPTIONS = {
+    'bind': 'SERVER_BIND',
+    'workers': 'SERVER_WORKERS',
+    'threads': 'SERVER_THREADS',
+    'timeout': 'SERVER_TIMEOUT',
+    'graceful_timeout': 'SERVER_GRACEFUL_TIMEOUT',
+    'max_requests': 'SERVER_MAX_REQUESTS',
+    'max_requests_jitter': 'SERVER_MAX_REQUESTS_JITTER',
+}
+
+def server_options(config, overrides=None):
+    """Return the gunicorn settings dict for an app config
+
+    :param config: <flask.Config> object
+    :param overrides: dict of SERVER_OPTIONS keys to values that take precedence, None values are ignored (default: None)
+    """
+    options = {name: config[key] for name, key in SERVER_OPTIONS.items()}
+    options.update({name: value for name, value in (overrides or {}).items() if value is not None})
+
+    if not options['workers']:
+        options['workers'] = multiprocessing.cpu_count() * 2 + 1
+
+    # Threaded workers only when more than one thread per worker is asked for
+    options['worker_class'] = 'gthread' if options['threads'] > 1 else 'sync'
+    options['preload_app'] = True
+
+    return options
+
+def preload(app):
+    """Prepare the master process before the workers are forked
+
+    Compiles the parser state of the XML_PARSER_MODE config: the extraction rules, shared by every
+    thread, and in 'dom' mode the XPath expressions (reused by the main thread of sync workers,
+    threaded workers compile their own per thread). Then it closes the connections opened while
+    loading so no SQLite handle crosses a fork, and moves everything allocated so far out of the
+    garbage collector's reach so the collector does not touch (and copy) the shared pages in each worker.
+
+    :param app: <flask.Flask> object
+    """
+    precompile(app.config['XML_PARSER_MODE'])
+
+    db.close_pools(app)
+
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+def worker_exit(app):
+    """Flush queued writes and release the worker's resources before it exits
+
+    :param app: <flask.Flask> object
+    """
+    app.extensions['ingest_queue'].stop()
+    app.extensions['group_commit_writer'].stop()
+    db.close_pools(app)
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog='lm-server', description='Run the app with a pre-fork multi-process server.')
+    parser.add_argument('--bind', help='address to listen on, HOST:PORT or unix:PATH')
+    parser.add_argument('--workers', type=int, help='number of worker processes (0 uses 2 * CPUs + 1)')
+    parser.add_argument('--threads', type=int, help='number of request threads per worker')
+    parser.add_argument('--timeout', type=int, help='seconds a silent worker is given before it is killed and restarted')
+    parser.add_argument('--graceful-timeout', type=int, help='seconds workers get to finish their requests on restart')
+    parser.add_argument('--max-requests', type=int, help='restart a worker after this many requests (0 disables it)')
+    parser.add_argument('--max-requests-jitter', type=int, help='random extra requests added to --max-requests per worker')
+    return parser.parse_args(args)
+
+def main(args=None):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("lm-server requires gunicorn, install it with `pip install app[server]`")
+
+    class Server(BaseApplication):
+        def __init__(self, app, options):
+            self.application = app
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for name, value in self.options.items():
+                self.cfg.set(name, value)
+
+            # Lifecycle hooks, see http://docs.gunicorn.org/en/stable/settings.html#server-hooks
+            self.cfg.set('worker_exit', lambda server, worker: worker_exit(self.application))
+
+        def load(self):
+            return self.application
+
+    app = create_app()
+    options = server_options(app.config, vars(parse_args(args)))
+    preload(app)
+
+    Server(app, options).run()
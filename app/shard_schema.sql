@@ -0,0 +1,59 @@
+-- Document tables, created in the DATABASE file or in each of the DB_SHARDS shard files.
+-- Ids are allocated by insert_document, see db.allocate_ids.
+
+DROP TABLE IF EXISTS document_fts;
+DROP TABLE IF EXISTS document;
+
+CREATE TABLE document (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL,
+    plaintiff TEXT NOT NULL,
+    defendants TEXT NOT NULL,
+    content_hash TEXT
+);
+
+CREATE INDEX document_content_hash ON document (content_hash);
+
+DROP TABLE IF EXISTS document_layout;
+
+-- Compressed layout_index of the caption pages of each extracted content hash, see `flask reextract`
+CREATE TABLE document_layout (
+    content_hash TEXT PRIMARY KEY,
+    layout BLOB NOT NULL
+);
+
+DROP TABLE IF EXISTS document_revision;
+
+-- Counts changes to extracted fields of existing documents, part of the document list ETag
+CREATE TABLE document_revision (
+    revision INTEGER NOT NULL
+);
+
+INSERT INTO document_revision (revision) VALUES (0);
+
+CREATE TRIGGER document_revision_update AFTER UPDATE OF plaintiff, defendants ON document BEGIN
+    UPDATE document_revision SET revision = revision + 1;
+END;
+
+-- Full-text search index
+-- Statements from here on are also run by `flask rebuild-search-index` and must be safe to run again
+
+CREATE VIRTUAL TABLE IF NOT EXISTS document_fts USING fts5 (
+    plaintiff,
+    defendants,
+    content='document',
+    content_rowid='id'
+);
+
+CREATE TRIGGER IF NOT EXISTS document_fts_insert AFTER INSERT ON document BEGIN
+    INSERT INTO document_fts (rowid, plaintiff, defendants) VALUES (new.id, new.plaintiff, new.defendants);
+END;
+
+CREATE TRIGGER IF NOT EXISTS document_fts_delete AFTER DELETE ON document BEGIN
+    INSERT INTO document_fts (document_fts, rowid, plaintiff, defendants) VALUES ('delete', old.id, old.plaintiff, old.defendants);
+END;
+
+CREATE TRIGGER IF NOT EXISTS document_fts_update AFTER UPDATE OF plaintiff, defendants ON document BEGIN
+    INSERT INTO document_fts (document_fts, rowid, plaintiff, defendants) VALUES ('delete', old.id, old.plaintiff, old.defendants);
+    INSERT INTO document_fts (rowid, plaintiff, defendants) VALUES (new.id, new.plaintiff, new.defendants);
+END;
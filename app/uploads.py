@@ -0,0 +1,59 @@
+"""Request class that decides where multipart uploads are buffered"""
+
+import tempfile
+from io import BytesIO
+
+from flask import Request, current_app
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.formparser import FormDataParser
+from . import compression
+
+class DecodingFormDataParser(FormDataParser):
+    """Parses a request body sent with a Content-Encoding, decompressing it as it is read
+
+    The Content-Length counts the encoded bytes, so the decoded body is parsed without one and
+    max_content_length bounds the decoded size instead.
+
+    :param content_encoding: 'gzip' or 'zstd'
+    """
+    def __init__(self, content_encoding, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.content_encoding = content_encoding
+
+    def parse(self, stream, mimetype, content_length, options=None):
+        stream = compression.DecompressingReader(stream, self.content_encoding, self.max_content_length)
+        try:
+            return super().parse(stream, mimetype, None, options)
+        except compression.DecompressedSizeError:
+            raise RequestEntityTooLarge()
+        except IOError as e:
+            raise BadRequest('Invalid request body: {}'.format(e))
+
+class UploadRequest(Request):
+    """Buffers small uploads in memory and spools large ones to a named file on disk, once
+
+    Uploads whose request body is larger than UPLOAD_SPOOL_THRESHOLD bytes are written to a named
+    temporary file in UPLOAD_SPOOL_DIR, so XmlParser can hand lxml the filename and libxml2 reads it
+    natively. Smaller uploads stay in a BytesIO and are parsed from the in-memory bytes.
+    Bodies larger than MAX_CONTENT_LENGTH are rejected with 413 before they are buffered.
+
+    Bodies sent with `Content-Encoding: gzip` (or `zstd`) are decompressed while the multipart parser
+    reads them. Their decoded size is unknown up front, so their files are always spooled.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is None or total_content_length > current_app.config['UPLOAD_SPOOL_THRESHOLD']:
+            return tempfile.NamedTemporaryFile('wb+', suffix='.upload', dir=current_app.config['UPLOAD_SPOOL_DIR'])
+        return BytesIO()
+
+    def make_form_data_parser(self):
+        encoding = (self.content_encoding or 'identity').strip().lower()
+        if encoding == 'identity':
+            return super().make_form_data_parser()
+
+        if encoding == 'x-gzip':
+            encoding = 'gzip'
+        if encoding not in compression.FILE_COMPRESSIONS.values() or not compression.available(encoding):
+            raise UnsupportedMediaType('Unsupported Content-Encoding: {}'.format(self.content_encoding))
+
+        return DecodingFormDataParser(encoding, self._get_file_stream, self.charset, self.encoding_errors,
+                                      self.max_form_memory_size, self.max_content_length, self.parameter_storage_class)
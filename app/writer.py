@@ -0,0 +1,121 @@
+"""Write-behind group commit: inserts from concurrent requests share one transaction"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from . import db
+
+# Queue item that tells the writer thread to flush and exit
+_STOP = object()
+
+class GroupCommitWriter:
+    """Background threads that execute queued write statements and commit them in groups
+    
+    A group is flushed when INSERT_GROUP_MAX_ROWS statements are pending or INSERT_GROUP_MAX_DELAY_MS
+    milliseconds have passed since the first one was queued. Every caller gets a Future with the
+    lastrowid of its own statement. If a group fails, its statements are retried one transaction each
+    so only the failing statement reports an error. Each document shard has its own queue and thread,
+    so shards commit in parallel.
+    
+    :param app: <flask.Flask> object
+    """
+    def __init__(self, app):
+        self.app = app
+        self.max_rows = app.config['INSERT_GROUP_MAX_ROWS']
+        self.max_delay = app.config['INSERT_GROUP_MAX_DELAY_MS'] / 1000.0
+
+        # Shard index -> (queue, thread)
+        self.__shards = {}
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def submit(self, sql, params, shard=0):
+        """Queue a write statement and return a <concurrent.futures.Future> of its lastrowid
+        
+        :param sql: string sql statement
+        :param params: tuple of statement parameters
+        :param shard: int index of the document shard to write to (default: 0)
+        """
+        future = Future()
+        self.start(shard).put((sql, params, future))
+        return future
+
+    def execute(self, sql, params, shard=0):
+        """Queue a write statement and wait for its lastrowid"""
+        return self.submit(sql, params, shard).result()
+
+    def start(self, shard=0):
+        """Start the writer thread of a shard in this process if it is not running and return its queue"""
+        with self.__lock:
+            if self.__pid != os.getpid():
+                # Threads do not survive a fork
+                if self.__pid is None:
+                    atexit.register(self.stop)
+                self.__pid = os.getpid()
+                self.__shards = {}
+
+            if shard not in self.__shards:
+                shard_queue = queue.Queue()
+                thread = threading.Thread(target=self.__run, args=(shard, shard_queue),
+                                          name='group-commit-writer-{}'.format(shard), daemon=True)
+                thread.start()
+                self.__shards[shard] = (shard_queue, thread)
+
+            return self.__shards[shard][0]
+
+    def stop(self, timeout=None):
+        """Flush every queued statement and stop the writer threads"""
+        with self.__lock:
+            if self.__pid != os.getpid():
+                return
+            for shard_queue, thread in self.__shards.values():
+                shard_queue.put(_STOP)
+            for shard_queue, thread in self.__shards.values():
+                thread.join(timeout)
+            self.__shards = {}
+
+    def __run(self, shard, shard_queue):
+        stopping = False
+
+        while not stopping:
+            item = shard_queue.get()
+            if item is _STOP:
+                break
+
+            group = [item]
+            deadline = time.time() + self.max_delay
+
+            while len(group) < self.max_rows:
+                try:
+                    item = shard_queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                group.append(item)
+
+            with self.app.app_context():
+                self.__flush(group, shard)
+
+    def __flush(self, group, shard):
+        database = db.get_shard(shard)
+
+        try:
+            row_ids = [database.execute(sql, params).lastrowid for sql, params, future in group]
+            database.commit()
+        except Exception as e:
+            database.rollback()
+            if len(group) > 1:
+                for item in group:
+                    self.__flush([item], shard)
+            else:
+                group[0][2].set_exception(e)
+            return
+
+        for (sql, params, future), row_id in zip(group, row_ids):
+            future.set_result(row_id)
@@ -0,0 +1,52 @@
+"""Benchmark: GET /documents/ with flask-restplus marshalling and with the fast serializer
+
+Usage::
+
+    python benchmarks/bench_serializer.py [--documents 20000] [--requests 10]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from app import create_app, insert_documents
+from app.db import init_db
+from app.serializers import JSON_ENCODER
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--documents', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=10)
+    args = parser.parse_args()
+
+    db_fd, db_path = tempfile.mkstemp()
+    app = create_app({'TESTING': True, 'DATABASE': db_path})
+    client = app.test_client()
+
+    with app.app_context():
+        init_db()
+        insert_documents([
+            ('{}.xml'.format(i), 'ANGELO ANGELES, an individual,',
+             'HILL-ROM COMPANY, INC., an Indiana ) corporation; and DOES 1 through 100, inclusive, )', str(i))
+            for i in range(args.documents)
+        ])
+
+    print('{} documents, json encoder: {}'.format(args.documents, JSON_ENCODER))
+    print('{:<16} {:>14} {:>14}'.format('serializer', 'ms/request', 'documents/s'))
+
+    for name, fast in [('marshal', False), ('fast', True)]:
+        app.config['FAST_SERIALIZER'] = fast
+        start = time.perf_counter()
+        for i in range(args.requests):
+            rv = client.get('/documents/')
+            assert rv.status_code == 200
+        elapsed = (time.perf_counter() - start) / args.requests
+        print('{:<16} {:>14.1f} {:>14,.0f}'.format(name, elapsed * 1000, args.documents / elapsed))
+
+    app.extensions['db_pool'].close()
+    os.close(db_fd)
+    os.unlink(db_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Benchmark: SQL statements and latency per upload with and without the read-after-write SELECT
+
+Usage::
+
+    python benchmarks/bench_upload_queries.py [--uploads 500] [--rounds 5]
+
+Compares `insert_document`, which returns the persisted record built from the inserted values plus
+lastrowid, against the previous `insert_document` followed by `find_document_by_id` and against
+INSERT ... RETURNING. Every path does the same work as an upload (timing, id allocation and the layout
+index insert) and only differs in how the record is read. Rounds of each path are interleaved and the
+median round is reported.
+"""
+
+import argparse
+import itertools
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from app import INSERT_DOCUMENT_SQL, INSERT_LAYOUT_SQL, create_app, find_document_by_id, insert_document
+from app import db
+from app.db import get_db, init_db
+from app.metrics import timed
+
+# Stands in for the compressed layout_index stored with each upload
+LAYOUT = os.urandom(2048)
+
+def insert_then_select(filename, plaintiff, defendants, content_hash=None, layout=None):
+    """The previous upload path: insert, commit, then read the row back"""
+    document = insert_document(filename, plaintiff, defendants, content_hash, layout)
+    return dict(find_document_by_id(document['id']))
+
+def insert_returning(filename, plaintiff, defendants, content_hash=None, layout=None):
+    """insert_document reading the row back in the insert statement (SQLite 3.35+)"""
+    shard = db.shard_for_hash(content_hash, db.shard_count())
+    database = db.get_shard(shard)
+
+    with timed('db.insert_document'):
+        row_id, = db.allocate_ids([shard])
+        cursor = database.cursor()
+        cursor.execute(INSERT_DOCUMENT_SQL + " RETURNING *", (row_id, filename, plaintiff, defendants, content_hash))
+        document = dict(cursor.fetchone())
+        if layout is not None and content_hash is not None:
+            cursor.execute(INSERT_LAYOUT_SQL, (content_hash, layout))
+
+        database.commit()
+        cursor.close()
+
+    return document
+
+def count_queries(statements):
+    """Return the number of INSERT and SELECT statements in a list of traced statements
+
+    Since Python 3.11 the trace callback reports each trigger sub-statement with the expanded text of
+    the statement that fired it, so the FTS index trigger repeats the INSERT. Consecutive equal
+    statements are counted once, and SQLite's internal '--' sub-statements are ignored.
+    """
+    statements = itertools.groupby(statement for statement in statements if not statement.startswith('--'))
+    return sum(1 for statement, repeats in statements if statement.split()[0].upper() in ('INSERT', 'SELECT'))
+
+def run(flask_app, insert, uploads, offset):
+    """Return (statements per upload, microseconds per upload) for an insert function"""
+    statements = []
+
+    with flask_app.app_context():
+        database = get_db()
+        database.set_trace_callback(lambda statement: statements.append(statement))
+
+        start = time.perf_counter()
+        for i in range(offset, offset + uploads):
+            insert('{}.xml'.format(i), 'ANGELO ANGELES, an individual,', 'HILL-ROM COMPANY, INC.', str(i), LAYOUT)
+        elapsed = time.perf_counter() - start
+
+        database.set_trace_callback(None)
+
+    return count_queries(statements) / float(uploads), elapsed / uploads * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uploads', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    db_fd, db_path = tempfile.mkstemp()
+    flask_app = create_app({'TESTING': True, 'DATABASE': db_path})
+
+    with flask_app.app_context():
+        init_db()
+
+    print('SQLite {}'.format(sqlite3.sqlite_version))
+    print('{:<32} {:>16} {:>16}'.format('insert path', 'queries/upload', 'us/upload'))
+
+    inserts = [('insert + find_document_by_id', insert_then_select), ('insert_document', insert_document)]
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        inserts.append(('insert ... returning', insert_returning))
+
+    # The table grows by the same number of rows for each path, so no path runs on a smaller table
+    results = {name: [] for name, insert in inserts}
+    offset = 0
+    for round_index in range(args.rounds):
+        for name, insert in inserts:
+            results[name].append(run(flask_app, insert, args.uploads, offset))
+            offset += args.uploads
+
+    for name, insert in inserts:
+        queries = results[name][0][0]
+        latency = statistics.median(latency for queries, latency in results[name])
+        print('{:<32} {:>16.1f} {:>16.1f}'.format(name, queries, latency))
+
+    flask_app.extensions['db_pool'].close()
+    os.close(db_fd)
+    os.unlink(db_path)
+
+if __name__ == '__main__':
+    main()
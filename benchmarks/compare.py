@@ -0,0 +1,45 @@
+"""Compare two benchmarks/run.py result files
+
+Usage::
+
+    python benchmarks/compare.py old.json new.json
+"""
+
+import argparse
+import json
+
+def change(old, new):
+    return (new - old) / old * 100 if old else float('nan')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('old')
+    parser.add_argument('new')
+    args = parser.parse_args()
+
+    with open(args.old) as fp:
+        old = json.load(fp)
+    with open(args.new) as fp:
+        new = json.load(fp)
+
+    print('{} -> {}'.format(old['meta'].get('commit'), new['meta'].get('commit')))
+
+    old_parser = {(result['pages'], result['mode']): result for result in old.get('parser', [])}
+    for result in new.get('parser', []):
+        previous = old_parser.get((result['pages'], result['mode']))
+        if previous is None:
+            continue
+        print('parser  pages={:<5} mode={:<8} time {:+7.1f}%  peak rss {:+7.1f}%'.format(
+            result['pages'], result['mode'],
+            change(previous['seconds'], result['seconds']),
+            change(previous['peak_rss_kib'], result['peak_rss_kib'])))
+
+    for name, result in sorted(new.get('endpoints', {}).items()):
+        previous = old.get('endpoints', {}).get(name)
+        if previous is None:
+            continue
+        print('endpoint {:<7} requests/s {:+7.1f}%'.format(
+            name, change(previous['requests_per_second'], result['requests_per_second'])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""Benchmark suite for XmlParser and the REST endpoints on synthetic ABBYY documents
+
+Usage::
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --pages 2,50,300 --modes paged,index,stream --skip-endpoints
+    python benchmarks/compare.py old.json new.json
+
+Parser results report the median `XmlParser.extract()` time, xml elements per second and the peak
+RSS growth of a fresh process extracting the document. Endpoint results report requests per second
+for `/documents/upload` and `/documents/` through the Flask test client.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+
+from lxml import etree
+from werkzeug.datastructures import FileStorage
+
+from app import create_app
+from app.db import init_db
+from app.LegalMation import XmlParser
+from synthetic import generate
+
+def extract(data, mode):
+    """Extract an in-memory document and return the parsed texts"""
+    return XmlParser(FileStorage(io.BytesIO(data), filename='synthetic.xml'), mode=mode).extract()
+
+def _status_kib(field):
+    """Return a KiB field of /proc/self/status, such as 'VmHWM'"""
+    with open('/proc/self/status') as fp:
+        for line in fp:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+def _reset_peak_rss():
+    """Reset this process's VmHWM to its current RSS, return False where /proc does not support it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_child(path, mode, results):
+    """Runs in a spawned process: report the peak RSS growth (KiB) while extracting the file at path
+
+    On Linux ru_maxrss is kept across fork and exec, so the child starts with the parent's peak, which
+    the timing loop already raised. The peak is read from VmHWM instead, reset once the data is loaded.
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+
+    if _reset_peak_rss():
+        baseline = _status_kib('VmHWM')
+        extract(data, mode)
+        results.put(_status_kib('VmHWM') - baseline)
+    else:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        extract(data, mode)
+        results.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline)
+
+def peak_rss(data, mode):
+    """Return the peak RSS growth in KiB of a fresh process extracting data"""
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(data)
+
+    try:
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        process = context.Process(target=_peak_rss_child, args=(path, mode, results))
+        process.start()
+        growth = results.get()
+        process.join()
+        return growth
+    finally:
+        os.unlink(path)
+
+def bench_parser(pages, modes, repeat, dom_max_pages, anchor_page):
+    results = []
+
+    for page_count in pages:
+        data, expected, elements = generate(pages=page_count, anchor_page=min(anchor_page, page_count - 1))
+
+        for mode in modes:
+            if mode == 'dom' and page_count > dom_max_pages:
+                continue
+
+            timings = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                parsed = extract(data, mode)
+                timings.append(time.perf_counter() - start)
+
+            if parsed != expected:
+                raise AssertionError('{} mode extracted {!r}, expected {!r}'.format(mode, parsed, expected))
+
+            seconds = statistics.median(timings)
+            result = {
+                'pages': page_count,
+                'mode': mode,
+                'bytes': len(data),
+                'elements': elements,
+                'seconds': seconds,
+                'elements_per_second': elements / seconds,
+                'peak_rss_kib': peak_rss(data, mode),
+            }
+            results.append(result)
+            print('parser  pages={pages:<5} mode={mode:<8} {seconds:9.4f}s {elements_per_second:14,.0f} elements/s '
+                  '{peak_rss_kib:9,d} KiB peak'.format(**result))
+
+    return results
+
+def bench_endpoints(uploads, pages, mode):
+    """Return requests per second for uploads and list requests through the Flask test client"""
+    db_fd, db_path = tempfile.mkstemp()
+    app = create_app({'TESTING': True, 'DATABASE': db_path, 'XML_PARSER_MODE': mode})
+    client = app.test_client()
+
+    with app.app_context():
+        init_db()
+
+    # Every document gets a different caption, so uploads are not served by the extraction cache
+    documents = [generate(pages=pages, document_id=i)[0] for i in range(uploads)]
+
+    start = time.perf_counter()
+    for i, data in enumerate(documents):
+        rv = client.post('/documents/upload', data={'file': (io.BytesIO(data), '{}.xml'.format(i))})
+        if rv.status_code != 200:
+            raise AssertionError('upload failed with {}'.format(rv.status_code))
+    upload_seconds = time.perf_counter() - start
+
+    list_requests = 20
+    start = time.perf_counter()
+    for i in range(list_requests):
+        client.get('/documents/')
+    list_seconds = time.perf_counter() - start
+
+    app.extensions['db_pool'].close()
+    os.close(db_fd)
+    os.unlink(db_path)
+
+    results = {
+        'upload': {'requests': uploads, 'pages': pages, 'seconds': upload_seconds,
+                   'requests_per_second': uploads / upload_seconds},
+        'list': {'requests': list_requests, 'documents': uploads, 'seconds': list_seconds,
+                 'requests_per_second': list_requests / list_seconds},
+    }
+    for name, result in sorted(results.items()):
+        print('endpoint {:<7} {:9.4f}s {:10,.1f} requests/s'.format(name, result['seconds'], result['requests_per_second']))
+
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', default='2,20,100', help='comma separated page counts (default: 2,20,100)')
+    parser.add_argument('--modes', default=','.join(XmlParser.MODES), help='comma separated XmlParser modes')
+    parser.add_argument('--anchor-page', type=int, default=0, help='page index of the caption (default: 0)')
+    parser.add_argument('--repeat', type=int, default=5, help='extractions per measurement (default: 5)')
+    parser.add_argument('--dom-max-pages', type=int, default=20, help='skip the quadratic dom mode above this size')
+    parser.add_argument('--uploads', type=int, default=200, help='documents uploaded by the endpoint benchmark')
+    parser.add_argument('--upload-pages', type=int, default=2, help='pages per uploaded document')
+    parser.add_argument('--skip-endpoints', action='store_true')
+    parser.add_argument('--output', help='write machine readable results to this json file')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'lxml': '.'.join(map(str, etree.LXML_VERSION)),
+            'sqlite': sqlite3.sqlite_version,
+        },
+        'parser': bench_parser([int(pages) for pages in args.pages.split(',')], args.modes.split(','),
+                               args.repeat, args.dom_max_pages, args.anchor_page),
+    }
+    if not args.skip_endpoints:
+        results['endpoints'] = bench_endpoints(args.uploads, args.upload_pages, args.modes.split(',')[0])
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Synthetic ABBYY FineReader10 documents for benchmarks
+
+Documents follow the structure of tests/A.xml, B.xml and C.xml:
+<document>/<page>/<block>/<region>+<text>/<par>/<line>/<formatting>, with a caption (the 'COUNTY OF',
+'Plaintiff,' and 'Defendants.' anchors, a left party column and a right case column) placed on a
+configurable page and block among filler body text.
+"""
+
+from xml.sax.saxutils import escape
+
+NAMESPACE = 'http://www.abbyy.com/FineReader_xml/FineReader10-schema-v1.xml'
+
+PAGE_WIDTH = 2555
+PAGE_HEIGHT = 3532
+LINE_HEIGHT = 48
+
+FILLER_TEXT = (
+    'The defendant is informed and believes, and thereon alleges that each of the parties named herein',
+    'acted within the course and scope of such agency and employment at all times mentioned in this',
+    'complaint, and that the damages claimed exceed the jurisdictional minimum of this court.',
+)
+
+def _formatting(text, bold=False):
+    return '<formatting lang="EnglishUnitedStates" ff="Times New Roman" fs="12."{}>{}</formatting>'.format(
+        ' bold="1"' if bold else '', escape(text))
+
+def _line(left, top, text, width=900, bold=False):
+    return '<line baseline="{b}" l="{l}" t="{t}" r="{r}" b="{b}">{f}</line>'.format(
+        l=left, t=top, r=left + width, b=top + LINE_HEIGHT - 8, f=_formatting(text, bold))
+
+def _block(lines, left, top, right):
+    bottom = top + LINE_HEIGHT * max(len(lines), 1)
+    return (
+        '<block blockType="Text" l="{l}" t="{t}" r="{r}" b="{b}">'
+        '<region><rect l="{l}" t="{t}" r="{r}" b="{b}"/></region>'
+        '<text><par lineSpacing="1330">{lines}</par></text>'
+        '</block>\n'
+    ).format(l=left, t=top, r=right, b=bottom, lines=''.join(lines))
+
+def caption(document_id=0, parties=2):
+    """Return (list of caption <block> strings, expected {'plaintiff', 'defendants'} dict)
+    
+    :param document_id: int, varies the party names so generated documents have different content
+    :param parties: number of lines in each of the plaintiff and defendants zones
+    """
+    top = 1200
+    plaintiff_lines = ['PLAINTIFF NUMBER {} LINE {},'.format(document_id, i) for i in range(parties)]
+    defendants_lines = ['DEFENDANT CORPORATION {} LINE {};'.format(document_id, i) for i in range(parties)]
+
+    county = [_line(761, top, 'COUNTY OF LOS ANGELES, CENTRAL DISTRICT', width=1180, bold=True)]
+
+    left_column = []
+    row = top + 2 * LINE_HEIGHT
+    for text in plaintiff_lines:
+        # Right side text after 2 or more spaces must be stripped by the parser
+        left_column.append(_line(302, row, text + '    )'))
+        row += LINE_HEIGHT
+    left_column.append(_line(616, row, 'Plaintiff,', width=170))
+    row += LINE_HEIGHT
+    left_column.append(_line(302, row, 'vs.', width=60))
+    row += LINE_HEIGHT
+    for text in defendants_lines:
+        left_column.append(_line(302, row, text + '    )'))
+        row += LINE_HEIGHT
+    left_column.append(_line(616, row, 'Defendants.', width=200))
+
+    right_column = [
+        _line(1286, top + 2 * LINE_HEIGHT, 'Case No.: BC{:06d}'.format(document_id), width=600),
+        _line(1286, top + 3 * LINE_HEIGHT, 'COMPLAINT FOR DAMAGES', width=600, bold=True),
+    ]
+
+    blocks = [
+        _block(county, 746, top, 1960),
+        _block(left_column, 290, top + 2 * LINE_HEIGHT, 1050),
+        _block(right_column, 1286, top + 2 * LINE_HEIGHT, 2400),
+    ]
+    expected = {'plaintiff': ' '.join(plaintiff_lines), 'defendants': ' '.join(defendants_lines)}
+
+    return blocks, expected
+
+def filler_block(index, lines_per_block):
+    """Return a <block> string of body text lines"""
+    top = 200 + (index % 40) * LINE_HEIGHT
+    lines = [
+        _line(316, top + i * LINE_HEIGHT, FILLER_TEXT[(index + i) % len(FILLER_TEXT)], width=1270)
+        for i in range(lines_per_block)
+    ]
+    return _block(lines, 300, top, 1600)
+
+def generate(pages=2, blocks_per_page=20, lines_per_block=4, anchor_page=0, anchor_block=2, document_id=0, parties=2):
+    """Return (xml bytes, expected {'plaintiff', 'defendants'} dict, number of xml elements)
+    
+    :param pages: number of <page> elements
+    :param blocks_per_page: number of filler <block> elements per page
+    :param lines_per_block: number of <line> elements per filler block
+    :param anchor_page: page index that holds the caption
+    :param anchor_block: filler block index the caption is placed after on that page
+    :param document_id: int, varies the caption text so documents have different content hashes
+    :param parties: number of lines in each of the plaintiff and defendants zones
+    """
+    if not 0 <= anchor_page < pages:
+        raise ValueError('anchor_page must be between 0 and pages - 1')
+
+    caption_blocks, expected = caption(document_id, parties)
+
+    # document + pages + blocks (block, region, rect, text, par) + lines (line, formatting)
+    elements = 1 + pages + 5 * (pages * blocks_per_page + len(caption_blocks))
+    elements += 2 * (pages * blocks_per_page * lines_per_block + 1 + (2 * parties + 3) + 2)
+
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n',
+        '<document xmlns="{}" version="1.0" producer="" languages="">\n'.format(NAMESPACE),
+    ]
+    for page in range(pages):
+        parts.append('<page width="{}" height="{}" resolution="300" originalCoords="1">\n'.format(PAGE_WIDTH, PAGE_HEIGHT))
+        for block in range(blocks_per_page):
+            if page == anchor_page and block == anchor_block:
+                parts.extend(caption_blocks)
+            parts.append(filler_block(page * blocks_per_page + block, lines_per_block))
+        if page == anchor_page and anchor_block >= blocks_per_page:
+            parts.extend(caption_blocks)
+        parts.append('</page>\n')
+    parts.append('</document>\n')
+
+    return ''.join(parts).encode('utf8'), expected, elements
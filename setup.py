@@ -30,5 +30,26 @@ setup(
             'pytest',
             'coverage',
         ],
+        # Faster json encoding when FAST_SERIALIZER is enabled
+        'fast': [
+            'orjson',
+        ],
+        # XmlParser 'geometric' extraction mode
+        'geometric': [
+            'numpy',
+        ],
+        # .xml.zst uploads and zstd encoded request bodies
+        'zstd': [
+            'zstandard',
+        ],
+        # Pre-fork production server, see app.server
+        'server': [
+            'gunicorn',
+        ],
+    },
+    entry_points={
+        'console_scripts': [
+            'lm-server = app.server:main',
+        ],
     },
 )
@@ -1,17 +1,23 @@
+import glob
 import os
+import shutil
 import tempfile
 
 import pytest
 from app import create_app
-from app.db import get_db, init_db
+from app.db import close_pools, get_db, init_db
 
 @pytest.fixture
 def app():
     db_fd, db_path = tempfile.mkstemp()
+    spool_dir = tempfile.mkdtemp()
 
     app = create_app({
         'TESTING': True,
         'DATABASE': db_path,
+        'INGEST_SPOOL_DIR': spool_dir,
+        'UPLOAD_SPOOL_DIR': spool_dir,
+        'INGEST_POLL_INTERVAL': 0.05,
     })
 
     with app.app_context():
@@ -19,8 +25,13 @@ def app():
 
     yield app
 
+    app.extensions['ingest_queue'].stop()
+    app.extensions['group_commit_writer'].stop()
+    close_pools(app)
     os.close(db_fd)
-    os.unlink(db_path)
+    for path in [db_path] + glob.glob(db_path + '-shard*'):
+        os.unlink(path)
+    shutil.rmtree(spool_dir)
 
 
 @pytest.fixture
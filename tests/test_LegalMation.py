@@ -1,9 +1,12 @@
 """Unit Test for LegalMation.XmlParser"""
 
+import gzip
+import io
 import os
+import tracemalloc
 
 import pytest
-from app import LegalMation
+from app import LegalMation, compression
 from werkzeug.datastructures import FileStorage
 from lxml import etree
 
@@ -159,4 +162,207 @@ def test_xml_parser_get_parsed_defendants_after_extract(xml_parser):
     """
     xml_parser.extract()
     parsed_texts = xml_parser.get_parsed_texts()
-    assert parsed_texts['defendants'] == 'HILL-ROM COMPANY, INC., an Indiana ) corporation; and DOES 1 through 100, inclusive, )'
\ No newline at end of file
+    assert parsed_texts['defendants'] == 'HILL-ROM COMPANY, INC., an Indiana ) corporation; and DOES 1 through 100, inclusive, )'
+
+def test_xml_parser_invalid_mode(xml_file):
+    """
+    GIVEN a LegalMation.XmlParser
+    AND a valid xml file
+    WHEN a new XmlParser is created with an unknown mode
+    THEN a ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        LegalMation.XmlParser(xml_file, mode='HELLO WORLD')
+
+def test_xml_parser_geometric_mode_without_numpy(xml_file, monkeypatch):
+    """
+    GIVEN numpy is not installed
+    WHEN a new XmlParser is created in 'geometric' mode
+    THEN a ValueError is raised
+    """
+    monkeypatch.setattr('app.layout.np', None)
+
+    with pytest.raises(ValueError):
+        LegalMation.XmlParser(xml_file, mode='geometric')
+
+@pytest.mark.parametrize('file_name', ['A.xml', 'B.xml', 'C.xml'])
+@pytest.mark.parametrize('mode', ['stream', 'index', 'paged', 'geometric'])
+def test_xml_parser_mode_matches_dom_mode(file_name, mode):
+    """
+    GIVEN a LegalMation.XmlParser in each extraction mode
+    AND a LegalMation.XmlParser in 'dom' mode
+    WHEN the extract method is called on both with the same xml file
+    THEN both return the same dictionary
+    """
+    if mode == 'geometric':
+        pytest.importorskip('numpy')
+    path = os.path.join(os.path.dirname(__file__), file_name)
+
+    with open(path, 'rb') as fp:
+        expected = LegalMation.XmlParser(FileStorage(fp, filename=file_name), mode='dom').extract()
+
+    with open(path, 'rb') as fp:
+        actual = LegalMation.XmlParser(FileStorage(fp, filename=file_name), mode=mode).extract()
+
+    assert actual == expected
+
+def multi_page_xml(pages_before, pages_after):
+    """Return A.xml with empty pages inserted before and copies of its page appended after the caption page"""
+    with open(VALID_XML_FILE, 'rb') as fp:
+        data = fp.read()
+
+    start, end = data.index(b'<page '), data.rindex(b'</page>') + len(b'</page>')
+    page = data[start:end]
+    empty_page = b'<page width="2555" height="3532" resolution="300" originalCoords="1"></page>'
+
+    return data[:start] + empty_page * pages_before + page + page * pages_after + data[end:]
+
+@pytest.mark.parametrize('mode', ['paged', 'geometric'])
+def test_xml_parser_paged_mode_stops_after_caption_page(mode):
+    """
+    GIVEN a LegalMation.XmlParser in 'paged' or 'geometric' mode
+    AND a xml file with many pages after the caption page
+    WHEN the extract method is called
+    THEN the same dictionary as for the single page file is returned
+    AND only the pages up to the caption page are read
+    """
+    with open(VALID_XML_FILE, 'rb') as fp:
+        expected = LegalMation.XmlParser(FileStorage(fp, filename='A.xml'), mode='dom').extract()
+
+    if mode == 'geometric':
+        pytest.importorskip('numpy')
+
+    data = multi_page_xml(1, 50)
+
+    lm_xml_parser = LegalMation.XmlParser(FileStorage(io.BytesIO(data), filename='A.xml'), mode=mode)
+
+    assert lm_xml_parser.extract() == expected
+    assert lm_xml_parser.pages_read == 2
+
+def test_xml_parser_paged_mode_page_budget():
+    """
+    GIVEN a LegalMation.XmlParser in 'paged' mode with a page budget
+    AND a xml file with the caption on its third page
+    WHEN the extract method is called
+    THEN no texts are returned when the budget ends before the caption page
+    AND the texts are returned when the caption page is within the budget
+    """
+    data = multi_page_xml(2, 0)
+
+    lm_xml_parser = LegalMation.XmlParser(FileStorage(io.BytesIO(data), filename='A.xml'), mode='paged', page_budget=2)
+
+    assert lm_xml_parser.extract() == {'plaintiff': '', 'defendants': ''}
+    assert lm_xml_parser.pages_read == 2
+
+    lm_xml_parser = LegalMation.XmlParser(FileStorage(io.BytesIO(data), filename='A.xml'), mode='paged', page_budget=3)
+
+    assert lm_xml_parser.extract()['plaintiff']
+    assert lm_xml_parser.pages_read == 3
+
+def test_compiled_xpaths_are_reused():
+    """
+    GIVEN the LegalMation.compiled_xpaths registry
+    WHEN the compiled expressions are requested twice for the same namespace
+    THEN the same etree.XPath objects are returned
+    AND a different namespace gets its own etree.XPath objects
+    """
+    namespace = 'http://www.abbyy.com/FineReader_xml/FineReader10-schema-v1.xml'
+    xpaths = LegalMation.compiled_xpaths(namespace)
+
+    assert all(isinstance(xpath, etree.XPath) for xpath in xpaths.values())
+    assert LegalMation.compiled_xpaths(namespace) is xpaths
+    assert LegalMation.compiled_xpaths('HELLO WORLD') is not xpaths
+
+@pytest.mark.parametrize('mode', LegalMation.XmlParser.MODES)
+def test_xml_parser_in_memory_file(mode):
+    """
+    GIVEN a LegalMation.XmlParser
+    AND a xml file buffered in memory
+    WHEN the extract method is called
+    THEN the same dictionary as for the file on disk is returned
+    """
+    if mode == 'geometric':
+        pytest.importorskip('numpy')
+
+    with open(VALID_XML_FILE, 'rb') as fp:
+        data = fp.read()
+        fp.seek(0)
+        expected = LegalMation.XmlParser(FileStorage(fp, filename='A.xml'), mode=mode).extract()
+
+    actual = LegalMation.XmlParser(FileStorage(io.BytesIO(data), filename='A.xml'), mode=mode).extract()
+
+    assert actual == expected
+
+@pytest.mark.parametrize('mode', LegalMation.XmlParser.MODES)
+def test_xml_parser_gzip_file(mode):
+    """
+    GIVEN a LegalMation.XmlParser
+    AND a gzip compressed '.xml.gz' file
+    WHEN the extract method is called
+    THEN the file is decompressed while it is parsed
+    AND the same dictionary as for the xml file is returned
+    """
+    if mode == 'geometric':
+        pytest.importorskip('numpy')
+
+    with open(VALID_XML_FILE, 'rb') as fp:
+        data = fp.read()
+        fp.seek(0)
+        expected = LegalMation.XmlParser(FileStorage(fp, filename='A.xml'), mode=mode).extract()
+
+    file = FileStorage(io.BytesIO(gzip.compress(data)), filename='A.xml.gz')
+    actual = LegalMation.XmlParser(file, mode=mode).extract()
+
+    assert actual == expected
+
+def test_xml_parser_gzip_file_max_size():
+    """
+    GIVEN a LegalMation.XmlParser with a max_size smaller than the decompressed file
+    WHEN the extract method is called
+    THEN a DecompressedSizeError is raised
+    """
+    with open(VALID_XML_FILE, 'rb') as fp:
+        file = FileStorage(io.BytesIO(gzip.compress(fp.read())), filename='A.xml.gz')
+
+    with pytest.raises(compression.DecompressedSizeError):
+        LegalMation.XmlParser(file, mode='dom', max_size=1024).extract()
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_decompressing_reader_bounds_inflated_chunks(encoding):
+    """
+    GIVEN 64 MB of data compressed to a few KB
+    WHEN it is read through a compression.DecompressingReader with a max_size of 1 MB
+    THEN a DecompressedSizeError is raised
+    AND no more than a few chunks are ever inflated in memory
+    """
+    data = b'\0' * (64 * 1024 * 1024)
+    if encoding == 'zstd':
+        zstandard = pytest.importorskip('zstandard')
+        compressed = zstandard.ZstdCompressor().compress(data)
+    else:
+        compressed = gzip.compress(data)
+    del data
+
+    reader = compression.DecompressingReader(io.BytesIO(compressed), encoding, max_size=1024 * 1024)
+
+    tracemalloc.start()
+    try:
+        with pytest.raises(compression.DecompressedSizeError):
+            while reader.read(compression.READ_CHUNK_SIZE):
+                pass
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert peak < 8 * 1024 * 1024
+
+def test_xml_parser_zstd_file_without_zstandard(monkeypatch):
+    """
+    GIVEN zstandard is not installed
+    WHEN a new XmlParser is created with a '.xml.zst' file
+    THEN an IOError is raised
+    """
+    monkeypatch.setattr('app.compression.zstandard', None)
+
+    with pytest.raises(IOError):
+        LegalMation.XmlParser(FileStorage(io.BytesIO(b''), filename='A.xml.zst'))
@@ -0,0 +1,148 @@
+"""Unit Test for app.admission"""
+
+import os
+import threading
+import time
+
+import pytest
+from app import create_app
+from app.admission import AdmissionController, AdmissionRejected
+from app.metrics import ADMISSION_REJECTIONS
+
+def test_admission_within_capacity():
+    """
+    GIVEN an AdmissionController
+    WHEN requests whose weights fit in its capacity are acquired
+    THEN they are all admitted at once
+    AND releasing them frees the capacity
+    """
+    controller = AdmissionController(100, queue_size=0)
+    controller.acquire(60)
+    controller.acquire(40)
+
+    assert controller.stats() == {'running': 2, 'in_flight_bytes': 100, 'queued': 0, 'queued_bytes': 0}
+
+    controller.release(60, 0.1)
+    controller.release(40, 0.1)
+    assert controller.stats()['running'] == 0
+
+def test_admission_heavy_request_runs_alone():
+    """
+    GIVEN an idle AdmissionController
+    WHEN a request heavier than its capacity is acquired
+    THEN it is admitted with the capacity as weight
+    """
+    controller = AdmissionController(100, queue_size=0)
+
+    assert controller.weight(1000) == 100
+    assert controller.weight(None) == 100
+    controller.acquire(controller.weight(1000))
+    assert controller.stats()['in_flight_bytes'] == 100
+
+def test_admission_queue_full():
+    """
+    GIVEN a full AdmissionController with no wait queue
+    WHEN another request is acquired
+    THEN AdmissionRejected is raised with a Retry-After estimated from the recent throughput
+    """
+    controller = AdmissionController(100, queue_size=0)
+    controller.acquire(50)
+    controller.release(50, 1.0)
+    controller.acquire(100)
+
+    with pytest.raises(AdmissionRejected) as excinfo:
+        controller.acquire(10)
+
+    # 100 bytes in flight at 50 bytes per second
+    assert excinfo.value.retry_after == 2
+    assert excinfo.value.reason == 'queue_full'
+    assert ('Retry-After', '2') in excinfo.value.get_headers()
+
+def test_admission_queue_timeout():
+    """
+    GIVEN a full AdmissionController with a wait timeout
+    WHEN another request is acquired and nothing is released
+    THEN AdmissionRejected is raised once the timeout expires
+    AND the request leaves the queue
+    """
+    controller = AdmissionController(100, queue_size=1, timeout=0.05)
+    controller.acquire(100)
+
+    with pytest.raises(AdmissionRejected) as excinfo:
+        controller.acquire(10)
+
+    assert excinfo.value.reason == 'timeout'
+    assert controller.stats()['queued'] == 0
+
+def test_admission_queue_order():
+    """
+    GIVEN a full AdmissionController
+    WHEN requests wait in its queue
+    THEN they are admitted in arrival order as capacity is released
+    """
+    controller = AdmissionController(100, queue_size=2, timeout=5)
+    controller.acquire(100)
+    admitted = []
+
+    def acquire(name, weight):
+        controller.acquire(weight)
+        admitted.append(name)
+
+    threads = []
+    for name, weight in [('first', 80), ('second', 10)]:
+        thread = threading.Thread(target=acquire, args=(name, weight))
+        thread.start()
+        threads.append(thread)
+        while controller.stats()['queued'] < len(threads):
+            time.sleep(0.001)
+
+    # The second request fits next to the running one but waits behind the first
+    assert admitted == []
+    controller.release(100, 0.1)
+    for thread in threads:
+        thread.join()
+
+    assert admitted == ['first', 'second']
+    assert controller.stats()['in_flight_bytes'] == 90
+
+def test_upload_rejected_when_busy(app, client):
+    """
+    GIVEN a client
+    AND the parse capacity is taken and the PARSE_QUEUE_SIZE config is 0
+    WHEN the client uploads a xml file
+    THEN a 429 code with a `Retry-After` header is returned
+    AND read endpoints are still served
+    AND the rejection and queue depth are reported in '/metrics'
+    WHEN the capacity is released
+    THEN the upload is accepted
+    """
+    controller = app.extensions['admission']
+    controller.queue_size = 0
+    controller.acquire(controller.capacity)
+    rejections = ADMISSION_REJECTIONS.value('queue_full')
+
+    rv = upload_file(client, 'A.xml')
+    assert rv.status_code == 429
+    assert int(rv.headers['Retry-After']) >= 1
+    assert client.get('/documents/').status_code == 200
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'lm_admission_rejections_total{reason="queue_full"} %d' % (rejections + 1) in text
+    assert 'lm_admission_requests{state="queued"} 0' in text
+    assert 'lm_admission_requests{state="running"} 1' in text
+
+    controller.release(controller.capacity, 0.1)
+    assert upload_file(client, 'A.xml').status_code == 200
+    assert controller.stats()['running'] == 0
+
+def test_admission_disabled(app):
+    """
+    GIVEN the PARSE_CAPACITY config is None
+    WHEN the app is created
+    THEN no AdmissionController is used
+    """
+    assert create_app({'TESTING': True, 'DATABASE': app.config['DATABASE'], 'PARSE_CAPACITY': None}).extensions['admission'] is None
+
+def upload_file(client, file_name):
+    path = os.path.join(os.path.dirname(__file__), file_name)
+    return client.post('/documents/upload', data={'file': (open(path, 'rb'), file_name)})
@@ -1,6 +1,19 @@
+import gzip
+import io
+import itertools
+import json
 import os
+import shutil
+import tarfile
+import time
+import zipfile
 
 import pytest
+from lxml import etree
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
+from app import create_app, find_document_by_id, insert_document
+from app.db import close_pools, get_db
 
 def test_no_route(client):
     """
@@ -122,10 +135,723 @@ def test_upload_with_valid_file(client):
     assert data['defendants'] == 'HILL-ROM COMPANY, INC., an Indiana ) corporation; and DOES 1 through 100, inclusive, )'
     assert data['plaintiff'] == 'ANGELO ANGELES, an individual,'
 
+def test_upload_same_file_reuses_extraction(app, client, monkeypatch):
+    """
+    GIVEN a client
+    AND a xml file is uploaded
+    WHEN the client uploads the same xml file again
+    THEN the xml file is not parsed again
+    AND a new document with the same extracted values is returned
+    """
+    first = upload_file(client, 'A.xml').get_json()
+
+    def fail_extract(self):
+        raise AssertionError('XmlParser.extract should not be called')
+
+    monkeypatch.setattr('app.LegalMation.XmlParser.extract', fail_extract)
+    rv = upload_file(client, 'A.xml')
+    assert rv.status_code == 200
+
+    second = rv.get_json()
+    assert second['id'] != first['id']
+    assert second['plaintiff'] == first['plaintiff']
+    assert second['defendants'] == first['defendants']
+
+def test_upload_returns_the_stored_document_ids(client):
+    """
+    GIVEN a client
+    WHEN the client uploads a xml file twice and then other xml files
+    THEN each returned document equals the one found by its id
+    """
+    for file_name in ('A.xml', 'A.xml', 'B.xml', 'C.xml'):
+        document = upload_file(client, file_name).get_json()
+
+        assert document['filename'] == file_name
+        assert client.get('/documents/{}'.format(document['id'])).get_json() == document
+
+def test_upload_same_file_returns_existing_document(app, client):
+    """
+    GIVEN a client
+    AND the UPLOAD_DEDUPLICATION config is set to 'existing'
+    AND a xml file is uploaded
+    WHEN the client uploads the same xml file again
+    THEN the existing document is returned
+    AND no new document is inserted
+    """
+    app.config['UPLOAD_DEDUPLICATION'] = 'existing'
+
+    first = upload_file(client, 'A.xml').get_json()
+    second = upload_file(client, 'A.xml').get_json()
+
+    assert second == first
+    assert len(client.get('/documents/').get_json()) == 1
+
+def test_upload_cache_falls_back_to_database(app, client):
+    """
+    GIVEN a client
+    AND a xml file is uploaded
+    AND the in-process extraction cache is cleared
+    WHEN the client uploads the same xml file again
+    THEN the extracted values are found by content hash in the database
+    """
+    app.config['UPLOAD_DEDUPLICATION'] = 'existing'
+
+    first = upload_file(client, 'A.xml').get_json()
+    app.extensions['extraction_cache'].clear()
+    second = upload_file(client, 'A.xml').get_json()
+
+    assert second == first
+
+def test_upload_spooled_to_disk(app, client, monkeypatch):
+    """
+    GIVEN a client
+    AND the UPLOAD_SPOOL_THRESHOLD config is 0
+    WHEN the client makes a POST request to '/documents/upload' with 'A.xml' file
+    THEN lxml parses the spooled upload by its filename
+    AND the extracted document is returned
+    """
+    app.config['UPLOAD_SPOOL_THRESHOLD'] = 0
+    sources = []
+    iterparse = etree.iterparse
+
+    def recording_iterparse(source, *args, **kwargs):
+        sources.append(source)
+        return iterparse(source, *args, **kwargs)
+
+    monkeypatch.setattr('app.LegalMation.etree.iterparse', recording_iterparse)
+
+    rv = upload_file(client, 'A.xml')
+    assert rv.status_code == 200
+    assert rv.get_json()['plaintiff'] == 'ANGELO ANGELES, an individual,'
+    assert len(sources) == 1 and isinstance(sources[0], str)
+
+def test_upload_too_large(app, client):
+    """
+    GIVEN a client
+    AND the MAX_CONTENT_LENGTH config is smaller than 'A.xml'
+    WHEN the client makes a POST request to '/documents/upload' with 'A.xml' file
+    THEN a 413 error code is returned
+    """
+    app.config['MAX_CONTENT_LENGTH'] = 1024
+
+    rv = upload_file(client, 'A.xml')
+    assert rv.status_code == 413
+
+def test_upload_gzip_file(client):
+    """
+    GIVEN a client
+    WHEN the client makes a POST request to '/documents/upload' with a gzip compressed 'A.xml.gz' file
+    THEN the file is decompressed into the parser
+    AND the extracted document is returned
+    """
+    rv = upload_gzip_file(client, 'A.xml')
+    assert rv.status_code == 200
+    assert rv.get_json() == {
+        'id': 1,
+        'filename': 'A.xml.gz',
+        'plaintiff': 'ANGELO ANGELES, an individual,',
+        'defendants': upload_file(client, 'A.xml').get_json()['defendants']
+    }
+
+def test_upload_invalid_gzip_file(client):
+    """
+    GIVEN a client
+    WHEN the client makes a POST request to '/documents/upload' with a '.xml.gz' file that is not gzip data
+    THEN a 400 error code is returned
+    """
+    files = {'file': (io.BytesIO(b'HELLO WORLD!' * 100), 'A.xml.gz')}
+    rv = client.post('/documents/upload', data=files)
+    assert rv.status_code == 400
+
+@pytest.mark.parametrize('spool_threshold', [512 * 1024, 0])
+def test_upload_gzip_file_too_large(app, client, spool_threshold):
+    """
+    GIVEN a client
+    AND the MAX_CONTENT_LENGTH config is smaller than 'A.xml' but larger than 'A.xml.gz'
+    WHEN the client makes a POST request to '/documents/upload' with the 'A.xml.gz' file
+    THEN a 413 error code is returned
+    """
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024
+    app.config['UPLOAD_SPOOL_THRESHOLD'] = spool_threshold
+
+    rv = upload_gzip_file(client, 'A.xml')
+    assert rv.status_code == 413
+
+def test_upload_gzip_encoded_body(client):
+    """
+    GIVEN a client
+    WHEN the client makes a POST request to '/documents/upload' with a gzip encoded body and `Content-Encoding: gzip`
+    THEN the body is decompressed while it is parsed
+    AND the extracted document is returned
+    """
+    expected = upload_file(client, 'A.xml').get_json()
+
+    rv = post_encoded_file(client, 'A.xml', 'gzip')
+    assert rv.status_code == 200
+    assert rv.get_json() == dict(expected, id=2)
+
+def test_upload_gzip_encoded_body_too_large(app, client):
+    """
+    GIVEN a client
+    AND the MAX_CONTENT_LENGTH config is smaller than 'A.xml' but larger than the compressed body
+    WHEN the client makes a POST request to '/documents/upload' with a gzip encoded body
+    THEN a 413 error code is returned
+    """
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024
+
+    rv = post_encoded_file(client, 'A.xml', 'gzip')
+    assert rv.status_code == 413
+
+def test_upload_unsupported_content_encoding(client):
+    """
+    GIVEN a client
+    WHEN the client makes a POST request to '/documents/upload' with `Content-Encoding: br`
+    THEN a 415 error code is returned
+    """
+    rv = post_encoded_file(client, 'A.xml', 'br')
+    assert rv.status_code == 415
+
+def test_documents_gzip_response(app, client):
+    """
+    GIVEN a client
+    AND 2 xml files are uploaded
+    AND the RESPONSE_COMPRESSION_MIN_SIZE config is 0
+    WHEN the client lists the documents with `Accept-Encoding: gzip`
+    THEN a gzip encoded list with a weak `ETag` is returned
+    AND listing again with that `ETag` returns a 304 code
+    WHEN the client lists the documents without `Accept-Encoding`
+    THEN an uncompressed list is returned
+    """
+    app.config['RESPONSE_COMPRESSION_MIN_SIZE'] = 0
+    upload_file(client, 'A.xml')
+    upload_file(client, 'B.xml')
+
+    for url in ['/documents/', '/documents/?stream=true']:
+        identity = client.get(url)
+        rv = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert rv.status_code == 200
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in rv.headers['Vary']
+        assert gzip.decompress(rv.get_data()) == identity.get_data()
+        assert 'Content-Encoding' not in identity.headers
+
+        etag = rv.headers['ETag']
+        assert etag == 'W/' + identity.headers['ETag']
+        assert client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag}).status_code == 304
+
+def test_small_responses_are_not_compressed(client):
+    """
+    GIVEN a client
+    AND a xml file is uploaded
+    WHEN the client gets the document with `Accept-Encoding: gzip`
+    THEN the response is smaller than RESPONSE_COMPRESSION_MIN_SIZE and is not compressed
+    """
+    upload_file(client, 'A.xml')
+
+    rv = client.get('/documents/1', headers={'Accept-Encoding': 'gzip'})
+    assert rv.status_code == 200
+    assert 'Content-Encoding' not in rv.headers
+    assert rv.get_json()['id'] == 1
+
+def test_search_documents(client):
+    """
+    GIVEN a client
+    AND 'A.xml', 'B.xml' and 'C.xml' files are uploaded
+    WHEN the client makes a GET request to '/documents/search?q=hill-rom company'
+    THEN a json list with only the 'A.xml' document is returned
+    """
+    for name in ['A.xml', 'B.xml', 'C.xml']:
+        upload_file(client, name)
+
+    rv = client.get('/documents/search?q=hill-rom company')
+    assert rv.status_code == 200
+
+    results = rv.get_json()
+    assert [result['filename'] for result in results] == ['A.xml']
+    assert 'rank' in results[0]
+
+def test_search_documents_by_field(client):
+    """
+    GIVEN a client
+    AND 'A.xml' and 'C.xml' files are uploaded
+    WHEN the client searches for 'individual' in the defendants field
+    THEN an empty json list is returned
+    WHEN the client searches for 'individual' in the plaintiff field
+    THEN both documents are returned
+    """
+    upload_file(client, 'A.xml')
+    upload_file(client, 'C.xml')
+
+    assert client.get('/documents/search?q=individual&field=defendants').get_json() == []
+
+    results = client.get('/documents/search?q=individual&field=plaintiff').get_json()
+    assert sorted(result['filename'] for result in results) == ['A.xml', 'C.xml']
+
+def test_search_documents_pagination(client):
+    """
+    GIVEN a client
+    AND 'A.xml' and 'C.xml' files are uploaded
+    WHEN the client searches for 'individual' one document at a time
+    THEN each page has a different document
+    """
+    upload_file(client, 'A.xml')
+    upload_file(client, 'C.xml')
+
+    first = client.get('/documents/search?q=individual&limit=1').get_json()
+    second = client.get('/documents/search?q=individual&limit=1&offset=1').get_json()
+
+    assert len(first) == 1 and len(second) == 1
+    assert first[0]['id'] != second[0]['id']
+
+def test_search_documents_without_query(client):
+    """
+    GIVEN a client
+    WHEN the client makes a GET request to '/documents/search' without a query
+    THEN a 400 error code is returned
+    """
+    assert client.get('/documents/search').status_code == 400
+    assert client.get('/documents/search?q=%20').status_code == 400
+
+def test_document_conditional_get(client):
+    """
+    GIVEN a client
+    AND a xml file is uploaded
+    WHEN the client makes a GET request to '/documents/1'
+    THEN an `ETag` and a `Cache-Control` header are returned
+    WHEN the client makes the request again with the ETag in `If-None-Match`
+    THEN a 304 code with no body is returned
+    """
+    upload_file(client, 'A.xml')
+
+    rv = client.get('/documents/1')
+    assert rv.status_code == 200
+    assert rv.headers['ETag']
+    assert 'max-age=' in rv.headers['Cache-Control']
+
+    rv = client.get('/documents/1', headers={'If-None-Match': rv.headers['ETag']})
+    assert rv.status_code == 304
+    assert rv.data == b''
+
+def test_document_response_cache(app, client, monkeypatch):
+    """
+    GIVEN a client
+    AND a xml file is uploaded
+    AND the document is read once
+    WHEN the client reads the document again
+    THEN the database is not queried
+    AND the same json object is returned
+    """
+    upload_file(client, 'A.xml')
+    first = client.get('/documents/1').get_json()
+
+    def fail_find_document_by_id(row_id):
+        raise AssertionError('find_document_by_id should not be called')
+
+    monkeypatch.setattr('app.find_document_by_id', fail_find_document_by_id)
+    assert client.get('/documents/1').get_json() == first
+
+def test_documents_etag_changes_on_insert(client):
+    """
+    GIVEN a client
+    AND a xml file is uploaded
+    WHEN the client lists the documents with the previous `ETag` in `If-None-Match`
+    THEN a 304 code is returned
+    WHEN another xml file is uploaded
+    THEN the list is returned again with a new `ETag`
+    """
+    upload_file(client, 'A.xml')
+    etag = client.get('/documents/').headers['ETag']
+
+    assert client.get('/documents/', headers={'If-None-Match': etag}).status_code == 304
+
+    upload_file(client, 'B.xml')
+    rv = client.get('/documents/', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+    assert len(rv.get_json()) == 2
+
+def test_reextract_document(app, client):
+    """
+    GIVEN a client
+    AND a xml file is uploaded
+    AND its stored plaintiff no longer matches the extraction rules
+    WHEN the client makes a POST request to '/documents/1/reextract'
+    THEN the document is extracted again from its layout index
+    AND the document list gets a new `ETag`
+    """
+    document = upload_file(client, 'A.xml').get_json()
+    etag = client.get('/documents/').headers['ETag']
+    assert client.get('/documents/1').get_json() == document
+
+    with app.app_context():
+        database = get_db()
+        database.execute("UPDATE document SET plaintiff = 'HELLO WORLD' WHERE id = 1")
+        database.commit()
+
+    rv = client.post('/documents/1/reextract')
+    assert rv.status_code == 200
+    assert rv.get_json() == document
+    assert client.get('/documents/1').get_json() == document
+    assert client.get('/documents/', headers={'If-None-Match': etag}).status_code == 200
+
+def test_document_cache_follows_updates_from_other_processes(app, client):
+    """
+    GIVEN a client of one app
+    AND a client of a second app on the same database, as in another worker process
+    AND a xml file is uploaded and read through the second client
+    WHEN the first client re-extracts the document after its stored fields changed
+    THEN the second client returns the updated document with a new `ETag`
+    AND documents with a layout index are cached for DOCUMENT_LAYOUT_CACHE_MAX_AGE seconds
+    """
+    other_app = create_app({'TESTING': True, 'DATABASE': app.config['DATABASE']})
+    other_client = other_app.test_client()
+
+    document = upload_file(client, 'A.xml').get_json()
+    rv = other_client.get('/documents/1')
+    assert rv.get_json() == document
+    assert rv.cache_control.max_age == app.config['DOCUMENT_LAYOUT_CACHE_MAX_AGE']
+
+    with app.app_context():
+        database = get_db()
+        database.execute("UPDATE document SET plaintiff = 'HELLO WORLD' WHERE id = 1")
+        database.commit()
+
+    rv = other_client.get('/documents/1')
+    assert rv.get_json()['plaintiff'] == 'HELLO WORLD'
+    etag = rv.headers['ETag']
+
+    assert client.post('/documents/1/reextract').status_code == 200
+    rv = other_client.get('/documents/1', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.get_json() == document
+
+    other_app.extensions['group_commit_writer'].stop()
+    close_pools(other_app)
+
+def test_reextract_document_without_layout(app, client):
+    """
+    GIVEN a client
+    AND a document inserted without a layout index
+    WHEN the client makes a POST request to its '/reextract' route
+    THEN a 409 code is returned
+    WHEN the client makes a POST request to the '/reextract' route of a missing document
+    THEN a 404 code is returned
+    """
+    with app.app_context():
+        insert_document('A.xml', 'ANGELO ANGELES', 'HILL-ROM', 'HELLO WORLD')
+
+    assert client.post('/documents/1/reextract').status_code == 409
+    assert client.post('/documents/2/reextract').status_code == 404
+
+@pytest.mark.parametrize('url', ['/documents/', '/documents/?fields=filename', '/documents/?after_id=1&limit=1', '/documents/2'])
+def test_fast_serializer_matches_marshalling(app, client, url):
+    """
+    GIVEN a client
+    AND 'A.xml' and 'B.xml' files are uploaded
+    WHEN the client makes the same GET request with the FAST_SERIALIZER config disabled and enabled
+    THEN the same json is returned
+    """
+    upload_file(client, 'A.xml')
+    upload_file(client, 'B.xml')
+
+    expected = client.get(url)
+
+    app.config['FAST_SERIALIZER'] = True
+    app.extensions['document_response_cache'].clear()
+    actual = client.get(url)
+
+    assert actual.status_code == expected.status_code == 200
+    assert actual.get_json() == expected.get_json()
+    assert actual.headers.get('Link') == expected.headers.get('Link')
+
+def test_batch_upload_with_no_files(client):
+    """
+    GIVEN a client
+    WHEN the client makes a POST request to '/documents/batch' with no files
+    THEN a 400 error code is returned
+    """
+    rv = client.post('/documents/batch')
+    assert rv.status_code == 400
+    assert b'No file part' in rv.data
+
+def test_batch_upload_with_files(app, client):
+    """
+    GIVEN a client
+    WHEN the client makes a POST request to '/documents/batch' with 'A.xml', 'B.xml', 'C.xml' and 'A.txt' files
+    THEN a json list with one result per file is returned
+    AND the xml files are inserted
+    AND the text file has an error
+    """
+    app.config['BATCH_MAX_WORKERS'] = 2
+
+    file_names = ['A.xml', 'B.xml', 'C.xml', 'A.txt']
+    files = {'files': [(open(os.path.join(os.path.dirname(__file__), name), 'rb'), name) for name in file_names]}
+    rv = client.post('/documents/batch', data=files)
+    assert rv.status_code == 200
+
+    results = rv.get_json()
+    assert [result['filename'] for result in results] == file_names
+    assert [result['document']['id'] for result in results[:3]] == [1, 2, 3]
+    assert results[0]['document']['plaintiff'] == 'ANGELO ANGELES, an individual,'
+    assert results[3]['document'] is None
+    assert results[3]['error'] == 'Invalid xml file.'
+
+    assert client.get('/documents/3').get_json() == results[2]['document']
+
+def test_batch_upload_with_zip_archive(app, client):
+    """
+    GIVEN a client
+    WHEN the client makes a POST request to '/documents/batch' with a zip archive of 'A.xml' and 'B.xml'
+    THEN a json list with one inserted document per archived file is returned
+    """
+    app.config['BATCH_MAX_WORKERS'] = 0
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        for name in ['A.xml', 'B.xml']:
+            zip_file.write(os.path.join(os.path.dirname(__file__), name), name)
+    archive.seek(0)
+
+    rv = client.post('/documents/batch', data={'files': (archive, 'documents.zip')})
+    assert rv.status_code == 200
+
+    results = rv.get_json()
+    assert [result['filename'] for result in results] == ['A.xml', 'B.xml']
+    assert all(result['error'] is None for result in results)
+    assert len(client.get('/documents/').get_json()) == 2
+
+@pytest.mark.parametrize('archive_name', ['documents.zip', 'documents.tar.gz'])
+def test_batch_upload_with_too_large_archive_member(app, client, archive_name):
+    """
+    GIVEN a client
+    AND a MAX_CONTENT_LENGTH config of 20000 bytes
+    WHEN the client makes a POST request to '/documents/batch' with a small archive of a 5 MB file
+    THEN a 413 error code is returned
+    AND no document is inserted
+    """
+    app.config['MAX_CONTENT_LENGTH'] = 20000
+    app.config['BATCH_MAX_WORKERS'] = 0
+    data = b' ' * (5 * 1024 * 1024)
+
+    archive = io.BytesIO()
+    if archive_name.endswith('.zip'):
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('A.xml', data)
+    else:
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar_file:
+            info = tarfile.TarInfo('A.xml')
+            info.size = len(data)
+            tar_file.addfile(info, io.BytesIO(data))
+    archive.seek(0)
+
+    rv = client.post('/documents/batch', data={'files': (archive, archive_name)})
+    assert rv.status_code == 413
+    assert client.get('/documents/').get_json() == []
+
+def test_documents_keyset_pagination(client):
+    """
+    GIVEN a client
+    AND 3 xml files are uploaded
+    WHEN the client makes a GET request to '/documents/?after_id=1&limit=1'
+    THEN a json list with only the document with id 2 is returned
+    AND a `Link` header points to the next page
+    """
+    for name in ['A.xml', 'B.xml', 'C.xml']:
+        upload_file(client, name)
+
+    rv = client.get('/documents/?after_id=1&limit=1')
+    assert rv.status_code == 200
+    assert [document['id'] for document in rv.get_json()] == [2]
+    assert 'after_id=2&limit=1' in rv.headers['Link']
+
+    rv = client.get('/documents/?after_id=2&limit=5')
+    assert [document['id'] for document in rv.get_json()] == [3]
+    assert 'Link' not in rv.headers
+
+def test_documents_fields_projection(client):
+    """
+    GIVEN a client
+    AND a xml file is uploaded
+    WHEN the client makes a GET request to '/documents/?fields=filename'
+    THEN a json list with only the `id` and `filename` values is returned
+    """
+    upload_file(client, 'A.xml')
+
+    rv = client.get('/documents/?fields=filename')
+    assert rv.status_code == 200
+    assert rv.get_json() == [{'id': 1, 'filename': 'A.xml'}]
+
+def test_documents_invalid_fields_projection(client):
+    """
+    GIVEN a client
+    WHEN the client makes a GET request to '/documents/?fields=content'
+    THEN a 400 error code is returned
+    """
+    rv = client.get('/documents/?fields=content')
+    assert rv.status_code == 400
+
+def test_documents_stream(client):
+    """
+    GIVEN a client
+    AND 2 xml files are uploaded
+    WHEN the client makes a GET request to '/documents/?stream=true'
+    THEN newline delimited json documents are returned
+    """
+    upload_file(client, 'A.xml')
+    upload_file(client, 'B.xml')
+
+    rv = client.get('/documents/?stream=true&fields=filename')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'application/x-ndjson'
+
+    lines = rv.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == [{'id': 1, 'filename': 'A.xml'}, {'id': 2, 'filename': 'B.xml'}]
+
+def test_upload_async(app, client):
+    """
+    GIVEN a client
+    AND the INGEST_ASYNC config is enabled
+    WHEN the client makes a POST request to '/documents/upload' with 'A.xml' file
+    THEN a 202 code and a queued job are returned
+    AND the job is eventually done
+    AND the job's document has the extracted values
+    """
+    app.config['INGEST_ASYNC'] = True
+    app.config['INGEST_SYNC_THRESHOLD'] = 0
+
+    rv = upload_file(client, 'A.xml')
+    assert rv.status_code == 202
+
+    job = rv.get_json()
+    assert job['status'] in ('queued', 'running', 'done')
+    assert rv.headers['Location'].endswith('/documents/jobs/{}'.format(job['id']))
+
+    job = wait_for_job(client, job['id'])
+    assert job['status'] == 'done'
+
+    document = client.get('/documents/{}'.format(job['document_id'])).get_json()
+    assert document['plaintiff'] == 'ANGELO ANGELES, an individual,'
+    assert os.listdir(app.config['INGEST_SPOOL_DIR']) == []
+
+def test_upload_async_failed_job(app, client):
+    """
+    GIVEN a client
+    AND the INGEST_ASYNC config is enabled
+    WHEN the client uploads a xml file that is not well formed
+    THEN the job eventually fails with an error
+    """
+    app.config['INGEST_ASYNC'] = True
+    app.config['INGEST_SYNC_THRESHOLD'] = 0
+
+    rv = client.post('/documents/upload', data={'file': (io.BytesIO(b'<document>'), 'broken.xml')})
+    assert rv.status_code == 202
+
+    job = wait_for_job(client, rv.get_json()['id'])
+    assert job['status'] == 'failed'
+    assert job['error']
+
+def test_upload_async_small_file_is_synchronous(app, client):
+    """
+    GIVEN a client
+    AND the INGEST_ASYNC config is enabled
+    AND the INGEST_SYNC_THRESHOLD config is larger than 'A.xml'
+    WHEN the client makes a POST request to '/documents/upload' with 'A.xml' file
+    THEN the extracted document is returned
+    """
+    app.config['INGEST_ASYNC'] = True
+    app.config['INGEST_SYNC_THRESHOLD'] = 10 * 1024 * 1024
+
+    rv = upload_file(client, 'A.xml')
+    assert rv.status_code == 200
+    assert rv.get_json()['plaintiff'] == 'ANGELO ANGELES, an individual,'
+
+def test_queued_jobs_are_picked_up_on_first_request(app, client):
+    """
+    GIVEN a client
+    AND the INGEST_ASYNC config is enabled
+    AND a job left queued by a previous process
+    AND a job left running by a process that crashed
+    AND a job running in another process
+    WHEN the client makes its first request
+    THEN the queued and the stale running jobs are eventually done without a new upload
+    AND the recently updated running job is left alone
+    """
+    app.config['INGEST_ASYNC'] = True
+
+    sql = ("INSERT INTO job (filename, spool_path, status, updated) "
+           "VALUES ('A.xml', ?, ?, datetime('now', ?))")
+    with app.app_context():
+        database = get_db()
+        for i, (status, age) in enumerate([('queued', '-0 seconds'), ('running', '-1 hour'), ('running', '-0 seconds')]):
+            spool_path = os.path.join(app.config['INGEST_SPOOL_DIR'], '{}.xml'.format(i))
+            shutil.copy(os.path.join(os.path.dirname(__file__), 'A.xml'), spool_path)
+            database.execute(sql, (spool_path, status, age))
+        database.commit()
+
+    assert wait_for_job(client, 1)['status'] == 'done'
+    assert wait_for_job(client, 2)['status'] == 'done'
+    assert client.get('/documents/jobs/3').get_json()['status'] == 'running'
+
+def test_job_with_wrong_id(client):
+    """
+    GIVEN a client
+    WHEN the client makes a GET request to '/documents/jobs/1'
+    THEN a 404 error is returned
+    """
+    rv = client.get('/documents/jobs/1')
+    assert rv.status_code == 404
+
+def wait_for_job(client, job_id, timeout=5):
+    """Polls '/documents/jobs/<job_id>' until the job is done or failed"""
+    deadline = time.time() + timeout
+    while True:
+        job = client.get('/documents/jobs/{}'.format(job_id)).get_json()
+        if job['status'] in ('done', 'failed') or time.time() > deadline:
+            return job
+        time.sleep(0.05)
+
+def test_insert_document_returns_persisted_record(app):
+    """
+    GIVEN an app
+    WHEN insert_document is called
+    THEN the returned dictionary equals the persisted document row
+    AND only the INSERT statement is executed
+    """
+    statements = []
+
+    with app.app_context():
+        get_db().set_trace_callback(lambda statement: statements.append(statement))
+        document = insert_document('A.xml', 'plaintiff', 'defendants', 'hash')
+        get_db().set_trace_callback(None)
+
+        assert document == dict(find_document_by_id(document['id']))
+
+    # Python 3.11+ reports each trigger sub-statement with the expanded text of the statement that fired it
+    queries = [statement for statement, repeats in itertools.groupby(statement for statement in statements
+                                                                     if not statement.startswith('--'))]
+    assert [statement.split()[0] for statement in queries if statement.split()[0] in ('INSERT', 'SELECT')] == ['INSERT']
+
 def upload_file(client, file_name):
     """Uploads a xml file by requesting a POST request to '/documents/uploads'"""
     path = os.path.join(os.path.dirname(__file__), file_name)
     files = {'file': (open(path, 'rb'), file_name)}
     rv = client.post('/documents/upload', data=files)
     
-    return rv
\ No newline at end of file
+    return rv
+def upload_gzip_file(client, file_name):
+    """Uploads a gzip compressed xml file as '<file_name>.gz'"""
+    path = os.path.join(os.path.dirname(__file__), file_name)
+    with open(path, 'rb') as fp:
+        files = {'file': (io.BytesIO(gzip.compress(fp.read())), file_name + '.gz')}
+    
+    return client.post('/documents/upload', data=files)
+
+def post_encoded_file(client, file_name, content_encoding):
+    """Uploads a xml file in a multipart body compressed with gzip and sent with a `Content-Encoding` header"""
+    path = os.path.join(os.path.dirname(__file__), file_name)
+    with open(path, 'rb') as fp:
+        boundary, body = encode_multipart({'file': FileStorage(io.BytesIO(fp.read()), filename=file_name)})
+    
+    return client.post('/documents/upload', data=gzip.compress(body),
+                       content_type='multipart/form-data; boundary={}'.format(boundary),
+                       headers={'Content-Encoding': content_encoding})
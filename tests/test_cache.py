@@ -0,0 +1,47 @@
+"""Unit Test for app.cache"""
+
+import hashlib
+import io
+
+from app.cache import LRUCache, hash_file
+from werkzeug.datastructures import FileStorage
+
+def test_lru_cache_evicts_least_recently_used():
+    """
+    GIVEN a LRUCache with a max size of 2
+    WHEN 3 entries are stored after reading the first one
+    THEN the least recently used entry is evicted
+    """
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+def test_lru_cache_disabled():
+    """
+    GIVEN a LRUCache with a max size of 0
+    WHEN an entry is stored
+    THEN nothing is cached
+    """
+    cache = LRUCache(0)
+    cache.put('a', 1)
+
+    assert cache.get('a') is None
+
+def test_hash_file_rewinds_stream():
+    """
+    GIVEN a FileStorage object
+    WHEN hash_file is called
+    THEN the SHA-256 hex digest of its content is returned
+    AND the stream is rewound to the start
+    """
+    file = FileStorage(io.BytesIO(b'<document />'), filename='A.xml')
+
+    assert hash_file(file) == hashlib.sha256(b'<document />').hexdigest()
+    assert file.read() == b'<document />'
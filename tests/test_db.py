@@ -1,12 +1,16 @@
 '''Database tests are copied from http://flask.pocoo.org/docs/1.0/tutorial/tests/#database'''
 '''Adding this just to make sure that app/db.py has 100% test coverage'''
 
+import os
 import sqlite3
 
 import pytest
-from app.db import get_db
+from app.db import get_db, get_pool
 
 def test_get_close_db(app):
+    # Without idle connections to keep, the pool closes the connection on teardown
+    app.extensions['db_pool'].size = 0
+
     with app.app_context():
         db = get_db()
         assert db is get_db()
@@ -16,6 +20,30 @@ def test_get_close_db(app):
 
     assert 'closed' 
 
+def test_get_db_reuses_pooled_connection(app):
+    with app.app_context():
+        db = get_db()
+
+    with app.app_context():
+        assert get_db() is db
+        assert get_pool().stats()['in_use'] == 1
+
+    stats = app.extensions['db_pool'].stats()
+    assert stats['in_use'] == 0
+    assert stats['reused'] >= 1
+
+def test_get_db_pragmas(app):
+    with app.app_context():
+        db = get_db()
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert db.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+
+def test_pool_stats_route(client):
+    rv = client.get('/db/pool')
+    assert rv.status_code == 200
+    assert rv.get_json()['size'] == 8
+
 def test_init_db_command(runner, monkeypatch):
     class Recorder(object):
         called = False
@@ -26,4 +54,74 @@ def test_init_db_command(runner, monkeypatch):
     monkeypatch.setattr('app.db.init_db', fake_init_db)
     result = runner.invoke(args=['init-db'])
     assert 'Initialized' in result.output
-    assert Recorder.called
\ No newline at end of file
+    assert Recorder.called
+
+def test_rebuild_search_index_command(app, runner):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO document (filename, plaintiff, defendants) VALUES ('A.xml', 'ANGELO ANGELES', 'HILL-ROM')")
+        db.commit()
+
+        # Simulate a database created before the search index existed
+        db.executescript('DROP TABLE document_fts')
+
+    result = runner.invoke(args=['rebuild-search-index'])
+    assert 'Rebuilt' in result.output
+
+    with app.app_context():
+        rows = get_db().execute("SELECT rowid FROM document_fts WHERE document_fts MATCH 'angeles'").fetchall()
+        assert [row[0] for row in rows] == [1]
+
+def make_import_dir(tmpdir):
+    tests_dir = os.path.dirname(__file__)
+    for name, target in (('A.xml', 'a/A.xml'), ('B.xml', 'b/B.xml'), ('C.xml', 'b/c/C.xml'), ('A.xml', 'copy/A.xml')):
+        tmpdir.join(target).write_binary(open(os.path.join(tests_dir, name), 'rb').read(), ensure=True)
+    tmpdir.join('b/broken.xml').write('<document>')
+    tmpdir.join('notes.txt').write('not imported')
+    return str(tmpdir)
+
+def test_import_dir_command(app, runner, tmpdir):
+    path = make_import_dir(tmpdir)
+
+    result = runner.invoke(args=['import-dir', path, '--workers', '0', '--batch-size', '2'])
+    assert 'Imported 3 of 5 files.' in result.output
+    assert '1 skipped, 1 failed' in result.output
+    assert 'files/s' in result.output
+
+    with app.app_context():
+        rows = get_db().execute('SELECT filename, plaintiff FROM document ORDER BY id').fetchall()
+        assert [row['filename'] for row in rows] == [
+            os.path.join('a', 'A.xml'), os.path.join('b', 'B.xml'), os.path.join('b', 'c', 'C.xml')]
+        assert rows[0]['plaintiff'] == 'ANGELO ANGELES, an individual,'
+
+    # Resumes after the checkpoint, nothing is left to import
+    result = runner.invoke(args=['import-dir', path, '--workers', '0'])
+    assert 'Imported 0 of 0 files.' in result.output
+
+    # Without the checkpoint every known content hash is skipped
+    result = runner.invoke(args=['import-dir', path, '--workers', '0', '--restart'])
+    assert 'Imported 0 of 5 files.' in result.output
+    assert '4 skipped' in result.output
+
+def test_import_dir_command_process_pool(app, runner, tmpdir):
+    path = make_import_dir(tmpdir)
+
+    result = runner.invoke(args=['import-dir', path, '--workers', '2'])
+    assert 'Imported 3 of 5 files.' in result.output
+
+def test_reextract_command(app, client, runner):
+    path = os.path.join(os.path.dirname(__file__), 'A.xml')
+    client.post('/documents/upload', data={'file': (open(path, 'rb'), 'A.xml')})
+    client.post('/documents/upload', data={'file': (open(path, 'rb'), 'A copy.xml')})
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE document SET defendants = 'HELLO WORLD'")
+        db.commit()
+
+    result = runner.invoke(args=['reextract'])
+    assert 'Re-extracted 1 layout indexes, updated 2 documents' in result.output
+
+    with app.app_context():
+        rows = get_db().execute('SELECT defendants FROM document').fetchall()
+        assert all(row['defendants'].startswith('HILL-ROM COMPANY') for row in rows)
@@ -0,0 +1,123 @@
+"""Unit Test for the layout index"""
+
+import io
+import os
+import zlib
+
+import pytest
+from app import LegalMation, layout_index
+from app.layout_index import LayoutIndex, LayoutRecorder
+from lxml import etree
+from werkzeug.datastructures import FileStorage
+
+ALL_FIELDS = ('plaintiff', 'defendants', 'case_number', 'court', 'county', 'attorneys')
+
+@pytest.mark.parametrize('file_name', ['A.xml', 'B.xml', 'C.xml'])
+def test_layout_index_extract(file_name):
+    """
+    GIVEN a LegalMation.XmlParser recording its layout
+    WHEN the extract method is called
+    THEN the layout index is much smaller than the xml file
+    AND extracting from the layout index gives the same fields
+    """
+    path = os.path.join(os.path.dirname(__file__), file_name)
+
+    with open(path, 'rb') as fp:
+        lm_xml_parser = LegalMation.XmlParser(FileStorage(fp, filename=file_name), fields=ALL_FIELDS, record_layout=True)
+        expected = lm_xml_parser.extract()
+
+    assert len(lm_xml_parser.layout) * 5 < os.path.getsize(path)
+    assert LayoutIndex(lm_xml_parser.layout).extract(ALL_FIELDS) == expected
+
+def test_layout_index_keeps_the_last_pages():
+    """
+    GIVEN xml documents with many pages before the caption page or without a caption
+    WHEN LegalMation.XmlParser extracts them recording the layout
+    THEN the layout index only holds the last layout_index.MAX_PAGES pages read
+    AND extracting from it gives the same fields
+    """
+    filler_lines = len(list(filler_page().iter('{%s}formatting' % LegalMation.NAMESPACE)))
+    short = extract_with_layout(paged_document(filler_pages=layout_index.MAX_PAGES - 1))
+    expected = extract_with_layout(paged_document(filler_pages=300))
+
+    assert len(LayoutIndex(expected.layout)) == len(LayoutIndex(short.layout))
+    assert LayoutIndex(expected.layout).extract() == expected.extract()
+
+    missing = extract_with_layout(paged_document(filler_pages=300, caption=False))
+    assert len(LayoutIndex(missing.layout)) == layout_index.MAX_PAGES * filler_lines
+
+def test_layout_index_not_stored_without_the_caption_start(monkeypatch):
+    """
+    GIVEN a xml document whose caption spans two pages
+    AND layout_index.MAX_PAGES set to 1
+    WHEN LegalMation.XmlParser extracts it recording the layout
+    THEN no layout index is kept, as it would not give the same fields
+    """
+    document = paged_document(filler_pages=0, split_block=8)
+    assert extract_with_layout(document).layout is not None
+
+    monkeypatch.setattr(layout_index, 'MAX_PAGES', 1)
+    lm_xml_parser = extract_with_layout(document)
+
+    assert lm_xml_parser.layout is None
+    assert lm_xml_parser.extract()['plaintiff'] == 'ANGELO ANGELES, an individual,'
+
+def test_layout_index_round_trip():
+    """
+    GIVEN a LayoutRecorder with no pages
+    WHEN it is serialized and read back
+    THEN an empty LayoutIndex is returned
+    AND invalid data is rejected
+    """
+    index = LayoutIndex(LayoutRecorder().dumps())
+
+    assert len(index) == 0
+    assert index.extract() == {'plaintiff': '', 'defendants': ''}
+
+    with pytest.raises(ValueError):
+        LayoutIndex(zlib.compress(b'HELLO WORLD!'))
+
+def test_layout_not_recorded_by_default():
+    """
+    GIVEN a LegalMation.XmlParser
+    WHEN the extract method is called without record_layout
+    THEN no layout is kept
+    """
+    path = os.path.join(os.path.dirname(__file__), 'A.xml')
+
+    with open(path, 'rb') as fp:
+        lm_xml_parser = LegalMation.XmlParser(FileStorage(fp, filename='A.xml'))
+        lm_xml_parser.extract()
+
+    assert lm_xml_parser.layout is None
+
+def paged_document(filler_pages, caption=True, split_block=None):
+    """Return A.xml with filler pages before its caption page, which is split into two pages before split_block"""
+    root = etree.parse(os.path.join(os.path.dirname(__file__), 'A.xml')).getroot()
+    page = root[0]
+    root.remove(page)
+
+    for i in range(filler_pages):
+        root.append(filler_page())
+    if caption:
+        root.append(page)
+    if caption and split_block is not None:
+        second = etree.SubElement(root, page.tag, page.attrib)
+        second.extend(page[split_block:])
+
+    return etree.tostring(root)
+
+def filler_page():
+    """Return a <page> element of 20 lines without any anchor"""
+    namespace = '{%s}' % LegalMation.NAMESPACE
+    page = etree.Element(namespace + 'page')
+    par = etree.SubElement(etree.SubElement(etree.SubElement(page, namespace + 'block'), namespace + 'text'), namespace + 'par')
+    for i in range(20):
+        line = etree.SubElement(par, namespace + 'line', l='300', t=str(100 + i * 50), r='1600', b=str(140 + i * 50))
+        etree.SubElement(line, namespace + 'formatting').text = 'Lorem ipsum dolor sit amet {}'.format(i)
+    return page
+
+def extract_with_layout(document):
+    lm_xml_parser = LegalMation.XmlParser(FileStorage(io.BytesIO(document), filename='A.xml'), record_layout=True)
+    lm_xml_parser.extract()
+    return lm_xml_parser
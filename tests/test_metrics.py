@@ -0,0 +1,79 @@
+"""Unit Test for app.metrics"""
+
+import os
+
+from app.metrics import Histogram, timed
+
+def test_histogram_expose():
+    """
+    GIVEN a Histogram
+    WHEN values are observed
+    THEN cumulative buckets, the sum and the count are exposed
+    """
+    histogram = Histogram('test_seconds', 'Test', ('stage',), buckets=(0.1, 1.0))
+    histogram.observe(0.05, 'a')
+    histogram.observe(0.5, 'a')
+    histogram.observe(5, 'a')
+
+    assert histogram.expose() == [
+        'test_seconds_bucket{stage="a",le="0.1"} 1',
+        'test_seconds_bucket{stage="a",le="1.0"} 2',
+        'test_seconds_bucket{stage="a",le="+Inf"} 3',
+        'test_seconds_sum{stage="a"} 5.55',
+        'test_seconds_count{stage="a"} 3',
+    ]
+
+def test_metrics_endpoint(client):
+    """
+    GIVEN a client
+    AND a xml file is uploaded
+    WHEN the client makes a GET request to '/metrics'
+    THEN the parse, database and request timings are returned in the Prometheus text format
+    """
+    upload_file(client, 'A.xml')
+
+    rv = client.get('/metrics')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/plain'
+
+    text = rv.get_data(as_text=True)
+    assert '# TYPE lm_stage_duration_seconds histogram' in text
+    for stage in ('upload.multipart', 'upload.hash', 'parse.paged', 'db.insert_document'):
+        assert 'lm_stage_duration_seconds_count{stage="%s"}' % stage in text
+    assert 'lm_requests_total{endpoint="documents_upload_document",method="POST",status="200"}' in text
+    assert 'lm_db_pool_connections{state="size"}' in text
+
+def test_stage_timing_header(app, client):
+    """
+    GIVEN a client
+    AND the METRICS_STAGE_HEADER config is enabled
+    WHEN the client uploads a xml file
+    THEN a `Server-Timing` header with the stage breakdown is returned
+    """
+    app.config['METRICS_STAGE_HEADER'] = True
+
+    rv = upload_file(client, 'A.xml')
+    assert 'parse.paged;dur=' in rv.headers['Server-Timing']
+    assert 'db.insert_document;dur=' in rv.headers['Server-Timing']
+
+def test_stage_timing_header_disabled(client):
+    """
+    GIVEN a client
+    WHEN the client uploads a xml file
+    THEN no `Server-Timing` header is returned
+    """
+    rv = upload_file(client, 'A.xml')
+    assert 'Server-Timing' not in rv.headers
+
+def test_timed_outside_app_context():
+    """
+    GIVEN no app context
+    WHEN a stage is timed
+    THEN no exception is raised
+    """
+    with timed('test.stage'):
+        pass
+
+def upload_file(client, file_name):
+    path = os.path.join(os.path.dirname(__file__), file_name)
+    return client.post('/documents/upload', data={'file': (open(path, 'rb'), file_name)})
@@ -0,0 +1,139 @@
+"""Unit Test for the extraction rules"""
+
+import os
+
+import pytest
+from app import LegalMation, rules
+from werkzeug.datastructures import FileStorage
+from lxml import etree
+
+ALL_FIELDS = ('plaintiff', 'defendants', 'case_number', 'court', 'county', 'attorneys')
+
+def extract(file_name, mode='paged', fields=ALL_FIELDS):
+    path = os.path.join(os.path.dirname(__file__), file_name)
+    with open(path, 'rb') as fp:
+        return LegalMation.XmlParser(FileStorage(fp, filename=file_name), mode=mode, fields=fields).extract()
+
+@pytest.mark.parametrize('mode', LegalMation.XmlParser.RULE_MODES)
+def test_builtin_rules(mode):
+    """
+    GIVEN a LegalMation.XmlParser asked for every built-in field
+    WHEN the extract method is called
+    THEN every field is filled from a single pass over the document
+    AND plaintiff and defendants are the same as in the dom mode
+    """
+    for file_name in ('A.xml', 'B.xml', 'C.xml'):
+        parsed = extract(file_name, mode)
+        expected = extract(file_name, 'dom', rules.DEFAULT_FIELDS)
+
+        assert parsed['plaintiff'] == expected['plaintiff']
+        assert parsed['defendants'] == expected['defendants']
+
+    parsed = extract('A.xml', mode)
+    assert parsed['case_number'] == 'B C 6 4 8 7 4 4'
+    assert parsed['court'] == 'SUPERIOR COURT OF CALIFORNIA'
+    assert parsed['county'] == 'LOS ANGELES, CENTRAL DISTRICT'
+    assert parsed['attorneys'].split('\n')[:2] == ['LAW OFFICES OF C. JOE SAYAS, JR.', 'C. JOE SAYAS, JR. (Bar No. 122397)']
+
+    parsed = extract('B.xml', mode)
+    assert parsed['case_number'] == 'RG18897005'
+    assert parsed['county'] == 'ALAMEDA'
+    assert parsed['attorneys'].split('\n')[:2] == ['ARTHUR W. LAZEAR (SB 083603)', '(arthur@iazearmack.com)']
+    assert parsed['attorneys'].split('\n')[-1] == 'fax: 510-545-4226'
+
+    parsed = extract('C.xml', mode)
+    assert parsed['case_number'] == ''
+    assert parsed['court'] == 'SUPERIOR COURT OF THE STATE OF CALIFORNIA'
+    assert parsed['county'] == 'LOS ANGELES'
+    assert parsed['attorneys'].split('\n')[:3] == ['Seung Yang [SBN 249857] V ! X ! U H \\i n L',
+                                                   'Allen V. Feghali [SBN 301080]    "', 'MOON & YANG, APC']
+
+def test_default_fields():
+    """
+    GIVEN a LegalMation.XmlParser without fields
+    WHEN the extract method is called
+    THEN only plaintiff and defendants are returned
+    """
+    assert sorted(extract('A.xml', fields=None)) == ['defendants', 'plaintiff']
+
+def test_compile_rules_is_cached():
+    """
+    GIVEN the rules.compile_rules function
+    WHEN the same fields are compiled twice
+    THEN the same CompiledRules object is returned
+    AND each distinct anchor is compiled once
+    """
+    compiled = rules.compile_rules(('plaintiff', 'defendants'))
+
+    assert rules.compile_rules(['plaintiff', 'defendants']) is compiled
+    assert len(compiled.patterns) == 4
+
+def test_unknown_field():
+    """
+    GIVEN an unknown field name
+    WHEN a LegalMation.XmlParser is created with it
+    THEN a ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        extract('A.xml', fields=('plaintiff', 'HELLO WORLD'))
+
+def test_extra_fields_need_a_rule_mode():
+    """
+    GIVEN a mode that does not evaluate the rules
+    WHEN a LegalMation.XmlParser is created with fields other than plaintiff and defendants
+    THEN a ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        extract('A.xml', mode='index')
+
+def test_custom_rule():
+    """
+    GIVEN a rule declared as data
+    WHEN a document is walked with its compiled matcher
+    THEN the field is extracted from the zone between its anchors
+    """
+    compiled = rules.CompiledRules([rules.Rule('claims', start=r'COMPLAINT FOR', end=r'^Defendants\.', bound=r'COMPLAINT FOR',
+                                               right_of_bound=True, match=r'\w', separator='', line_separator=' ')])
+    matcher = compiled.matcher()
+
+    path = os.path.join(os.path.dirname(__file__), 'A.xml')
+    namespace = '{%s}' % LegalMation.NAMESPACE
+    for elem in etree.parse(path).getroot().iter(namespace + 'formatting'):
+        line = elem.getparent()
+        if matcher.feed(line, float(line.get('l')), elem.text or ''):
+            break
+
+    assert matcher.results() == {'claims': '1. 2.'}
+
+def test_last_lines_rule_keeps_only_its_last_lines():
+    """
+    GIVEN the 'court' rule, which keeps the last line matching 'COURT OF' before its end anchor
+    WHEN many lines, some of them matching, are fed before the end anchor
+    THEN only the last matching line and the line being fed are buffered
+    AND the extracted court is the last one before the end anchor
+    """
+    matcher = rules.compile_rules(('court',)).matcher()
+    court = matcher.states[0]
+
+    for line in range(1000):
+        matcher.feed(line, 10.0, 'FILED BY THE COURT OF APPEAL' if line % 10 == 0 else 'filler')
+        assert len(court.candidates) <= 2
+    matcher.feed('caption', 10.0, 'SUPERIOR COURT OF CALIFORNIA')
+    matcher.feed('county', 10.0, 'COUNTY OF LOS ANGELES')
+
+    assert matcher.results() == {'court': 'SUPERIOR COURT OF CALIFORNIA'}
+
+def test_lines_without_a_match_are_not_buffered():
+    """
+    GIVEN the 'attorneys' rule, which only keeps lines with a word or a phone number
+    WHEN the line numbers of the margin are fed before the attorney lines
+    THEN the line numbers are not buffered
+    """
+    matcher = rules.compile_rules(('attorneys',)).matcher()
+    attorneys = matcher.states[0]
+
+    for line in range(1000):
+        matcher.feed(line, 10.0, str(line))
+    matcher.feed('name', 20.0, 'JANE DOE')
+
+    assert [text for line, left, text in attorneys.candidates] == ['JANE DOE']
@@ -0,0 +1,73 @@
+"""Unit Test for the production server helpers"""
+
+import gc
+import os
+
+from app import rules, server
+from app.db import get_db
+
+def test_server_options(app):
+    """
+    GIVEN an app config
+    WHEN the server options are built with command line overrides
+    THEN the overrides take precedence over the SERVER_* config
+    AND a threaded worker is used for more than one thread per worker
+    AND the app is preloaded before forking
+    """
+    app.config['SERVER_WORKERS'] = 3
+
+    options = server.server_options(app.config, {'threads': 4, 'max_requests': None})
+
+    assert options['workers'] == 3
+    assert options['threads'] == 4
+    assert options['worker_class'] == 'gthread'
+    assert options['max_requests'] == app.config['SERVER_MAX_REQUESTS']
+    assert options['preload_app'] is True
+
+def test_server_options_default_workers(app):
+    """
+    GIVEN an app config with SERVER_WORKERS set to 0
+    WHEN the server options are built
+    THEN the number of workers is derived from the number of CPUs
+    AND sync workers are used
+    """
+    options = server.server_options(app.config)
+
+    assert options['workers'] == os.cpu_count() * 2 + 1
+    assert options['worker_class'] == 'sync'
+
+def test_preload_closes_connections(app):
+    """
+    GIVEN an app with idle pooled connections
+    WHEN the master process is prepared for forking
+    THEN no connection is left open for the workers to inherit
+    """
+    with app.app_context():
+        get_db().execute('SELECT 1')
+
+    assert app.extensions['db_pool'].stats()['idle'] == 1
+
+    try:
+        server.preload(app)
+    finally:
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+    assert app.extensions['db_pool'].stats()['idle'] == 0
+
+def test_preload_compiles_parser_mode(app, monkeypatch):
+    """
+    GIVEN an app in the default 'paged' XML_PARSER_MODE
+    WHEN the master process is prepared for forking
+    THEN the extraction rules the mode evaluates are compiled before the workers are forked
+    """
+    monkeypatch.setattr(rules, '_compiled_rules', {})
+    assert app.config['XML_PARSER_MODE'] == 'paged'
+
+    try:
+        server.preload(app)
+    finally:
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+    assert rules.DEFAULT_FIELDS in rules._compiled_rules
@@ -0,0 +1,248 @@
+"""Unit Test for the sharded document storage"""
+
+import os
+import shutil
+import tempfile
+
+import pytest
+from app import create_app, find_document_by_id, insert_document, insert_documents, reextract_documents
+from app.db import close_pools, get_shards, init_db, migrate_to_shards, shard_for_hash, shard_for_id, shard_paths
+
+SHARDS = 3
+
+@pytest.fixture
+def database():
+    directory = tempfile.mkdtemp()
+    yield os.path.join(directory, 'app-db.sqlite')
+    shutil.rmtree(directory)
+
+@pytest.fixture
+def sharded_app(database):
+    app = make_app(database, SHARDS)
+
+    with app.app_context():
+        init_db()
+
+    yield app
+
+    close_app(app)
+
+@pytest.fixture
+def sharded_client(sharded_app):
+    return sharded_app.test_client()
+
+def test_init_db_creates_shards(sharded_app, database):
+    """
+    GIVEN an app with the DB_SHARDS config set to 3
+    WHEN the database is initialized
+    THEN a document table is created in 3 files next to the DATABASE file
+    """
+    paths = shard_paths(sharded_app.config)
+
+    assert paths == [os.path.join(os.path.dirname(database), 'app-db-shard{}.sqlite'.format(i)) for i in range(SHARDS)]
+    assert all(os.path.exists(path) for path in paths)
+
+    result = sharded_app.test_cli_runner().invoke(args=['init-db'])
+    assert 'Initialized the database and 3 document shards.' in result.output
+
+def test_insert_document_routes_ids(sharded_app):
+    """
+    GIVEN an app with 3 shards
+    WHEN documents are inserted
+    THEN each document id routes to the shard it was inserted in
+    AND the document is found by id
+    """
+    with sharded_app.app_context():
+        documents = [insert_document('{}.xml'.format(i), 'plaintiff', 'defendants', 'hash{}'.format(i)) for i in range(12)]
+
+        shards = get_shards()
+        for document in documents:
+            shard = shards[shard_for_id(document['id'], SHARDS)]
+            assert shard.execute('SELECT filename FROM document WHERE id = ?', (document['id'],)).fetchone() is not None
+            assert dict(find_document_by_id(document['id'])) == document
+
+        assert len({document['id'] for document in documents}) == 12
+        assert sum(shard.execute('SELECT COUNT(*) FROM document').fetchone()[0] for shard in shards) == 12
+
+def test_insert_documents_in_parallel(sharded_app):
+    """
+    GIVEN an app with 3 shards
+    WHEN many documents are inserted at once
+    THEN they are returned in order with the ids they were stored with
+    """
+    values = [('{}.xml'.format(i), 'plaintiff {}'.format(i), 'defendants', 'hash{}'.format(i)) for i in range(20)]
+
+    with sharded_app.app_context():
+        documents = insert_documents(values)
+
+        assert [document['filename'] for document in documents] == [value[0] for value in values]
+        for document in documents:
+            assert dict(find_document_by_id(document['id'])) == document
+
+def test_documents_are_listed_in_id_order(sharded_app, sharded_client):
+    """
+    GIVEN a client of an app with 3 shards
+    AND documents in every shard
+    WHEN the client lists and pages through the documents
+    THEN the documents of every shard are returned in id order
+    """
+    with sharded_app.app_context():
+        ids = sorted(insert_document('{}.xml'.format(i), 'plaintiff', 'defendants', 'hash{}'.format(i))['id']
+                     for i in range(10))
+
+    assert [document['id'] for document in sharded_client.get('/documents/').get_json()] == ids
+
+    paged = []
+    url = '/documents/?limit=4'
+    while url:
+        rv = sharded_client.get(url)
+        paged.extend(document['id'] for document in rv.get_json())
+        url = rv.headers['Link'][1:rv.headers['Link'].index('>')] if 'Link' in rv.headers else None
+    assert paged == ids
+
+    lines = sharded_client.get('/documents/?stream=true&fields=id').get_data(as_text=True).splitlines()
+    assert len(lines) == 10
+
+def test_sharded_upload_returns_the_stored_ids(sharded_app, sharded_client):
+    """
+    GIVEN a client of an app with 3 shards
+    WHEN the client uploads xml files, with their layout index, some of them twice
+    THEN each returned document equals the one found by its id
+    """
+    for group_commit in (False, True):
+        sharded_app.config['INSERT_GROUP_COMMIT'] = group_commit
+
+        for file_name in ('A.xml', 'A.xml', 'B.xml', 'C.xml', 'B.xml'):
+            document = upload_file(sharded_client, file_name).get_json()
+
+            assert document['filename'] == file_name
+            assert sharded_client.get('/documents/{}'.format(document['id'])).get_json() == document
+
+def test_ids_increase_across_shards(sharded_app, sharded_client):
+    """
+    GIVEN a client of an app with 3 shards
+    AND documents inserted into one shard only
+    WHEN a document is inserted into another shard
+    THEN its id is larger than every id before it
+    AND it is listed after the previous largest id
+    """
+    hashes = ['hash{}'.format(i) for i in range(50)]
+    skewed = [content_hash for content_hash in hashes if shard_for_hash(content_hash, SHARDS) == 0]
+    other = next(content_hash for content_hash in hashes if shard_for_hash(content_hash, SHARDS) == 1)
+
+    with sharded_app.app_context():
+        for content_hash in skewed:
+            insert_document('skewed.xml', 'plaintiff', 'defendants', content_hash)
+        batch = insert_documents([('batch.xml', 'plaintiff', 'defendants', content_hash) for content_hash in skewed])
+        last_id = max(document['id'] for document in sharded_client.get('/documents/').get_json())
+        assert last_id == batch[-1]['id']
+
+        document = insert_document('other.xml', 'plaintiff', 'defendants', other)
+        assert document['id'] > last_id
+        assert document['id'] < last_id + SHARDS
+
+    rv = sharded_client.get('/documents/?after_id={}'.format(last_id))
+    assert [document['filename'] for document in rv.get_json()] == ['other.xml']
+
+def test_sharded_upload_and_search(sharded_client):
+    """
+    GIVEN a client of an app with 3 shards
+    WHEN the client uploads xml files and searches them
+    THEN results from every shard are merged by rank
+    AND the document list gets a new `ETag` after each upload
+    """
+    etag = sharded_client.get('/documents/').headers['ETag']
+    for file_name in ('A.xml', 'B.xml', 'C.xml'):
+        assert upload_file(sharded_client, file_name).status_code == 200
+        rv = sharded_client.get('/documents/', headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        etag = rv.headers['ETag']
+
+    results = sharded_client.get('/documents/search?q=angeles').get_json()
+    assert [result['filename'] for result in results] == ['A.xml']
+
+    everything = sharded_client.get('/documents/search?q=inc').get_json()
+    paged = sharded_client.get('/documents/search?q=inc&limit=1&offset=1').get_json()
+    assert paged == everything[1:2]
+
+def test_sharded_group_commit(sharded_app):
+    """
+    GIVEN an app with 3 shards and the INSERT_GROUP_COMMIT config enabled
+    WHEN documents are inserted
+    THEN each shard's writer commits its documents
+    """
+    sharded_app.config['INSERT_GROUP_COMMIT'] = True
+
+    with sharded_app.app_context():
+        documents = [insert_document('{}.xml'.format(i), 'plaintiff', 'defendants', 'hash{}'.format(i)) for i in range(9)]
+        sharded_app.extensions['group_commit_writer'].stop()
+
+        for document in documents:
+            assert dict(find_document_by_id(document['id'])) == document
+
+def test_migrate_to_shards(database):
+    """
+    GIVEN a single file database with documents
+    WHEN it is migrated to 3 shards
+    THEN every document keeps its id and is found by it
+    AND every document is in the shard of its content hash, with its layout index
+    AND new documents get larger ids
+    AND documents are re-extracted from the layout indexes moved with them
+    """
+    app = make_app(database, 1)
+    with app.app_context():
+        init_db()
+    client = app.test_client()
+    expected = [upload_file(client, file_name).get_json() for file_name in ('A.xml', 'B.xml', 'C.xml', 'A.xml')]
+    close_app(app)
+
+    app = make_app(database, SHARDS)
+    result = app.test_cli_runner().invoke(args=['migrate-shards', '--drop-source'])
+    assert 'Migrated 4 documents into 3 shards' in result.output
+
+    with app.app_context():
+        for document in expected:
+            assert dict(find_document_by_id(document['id']), content_hash=None) == dict(document, content_hash=None)
+
+        for index, shard in enumerate(get_shards()):
+            for row in shard.execute('SELECT content_hash FROM document'):
+                assert shard_for_hash(row['content_hash'], SHARDS) == index
+                assert shard.execute('SELECT 1 FROM document_layout WHERE content_hash = ?',
+                                     (row['content_hash'],)).fetchone() is not None
+
+        assert insert_document('D.xml', 'plaintiff', 'defendants')['id'] > 4
+
+    # An upload of migrated content goes to the shard holding its layout index
+    client = app.test_client()
+    duplicate = upload_file(client, 'A.xml').get_json()
+
+    with app.app_context():
+        for shard in get_shards():
+            shard.execute("UPDATE document SET plaintiff = 'HELLO WORLD' WHERE filename = 'A.xml'")
+            shard.commit()
+        assert client.post('/documents/{}/reextract'.format(duplicate['id'])).status_code == 200
+        assert [find_document_by_id(document['id'])['plaintiff'] for document in (expected[0], expected[3], duplicate)] \
+            == [expected[0]['plaintiff']] * 3
+
+        # Shards with documents are never overwritten
+        with pytest.raises(ValueError):
+            migrate_to_shards()
+
+    close_app(app)
+
+def make_app(database, shards):
+    return create_app({
+        'TESTING': True,
+        'DATABASE': database,
+        'DB_SHARDS': shards,
+        'INGEST_SPOOL_DIR': os.path.join(os.path.dirname(database), 'spool'),
+    })
+
+def close_app(app):
+    app.extensions['ingest_queue'].stop()
+    app.extensions['group_commit_writer'].stop()
+    close_pools(app)
+
+def upload_file(client, file_name):
+    path = os.path.join(os.path.dirname(__file__), file_name)
+    return client.post('/documents/upload', data={'file': (open(path, 'rb'), file_name)})
@@ -0,0 +1,60 @@
+"""Unit Test for app.writer.GroupCommitWriter"""
+
+import threading
+
+from app import find_document_by_id, insert_document
+from app.db import get_db
+
+def test_group_commit_insert_document(app):
+    """
+    GIVEN an app with the INSERT_GROUP_COMMIT config enabled
+    WHEN insert_document is called from many threads at once
+    THEN every caller gets its own row id
+    AND every row is committed
+    """
+    app.config['INSERT_GROUP_COMMIT'] = True
+    row_ids = []
+
+    def insert(i):
+        with app.app_context():
+            row_ids.append(insert_document('{}.xml'.format(i), 'plaintiff', 'defendants')['id'])
+
+    threads = [threading.Thread(target=insert, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(row_ids) == list(range(1, 21))
+
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM document').fetchone()[0] == 20
+        assert find_document_by_id(row_ids[0])['filename'].endswith('.xml')
+
+def test_group_commit_failing_statement(app):
+    """
+    GIVEN an app with the INSERT_GROUP_COMMIT config enabled
+    WHEN a statement in a group fails
+    THEN only that statement reports an error
+    """
+    writer = app.extensions['group_commit_writer']
+    good = writer.submit("INSERT INTO document (filename, plaintiff, defendants) VALUES (?, ?, ?)", ('A.xml', '', ''))
+    bad = writer.submit("INSERT INTO document (filename, plaintiff, defendants) VALUES (?, ?, ?)", (None, '', ''))
+
+    assert good.result(timeout=5) == 1
+    assert bad.exception(timeout=5) is not None
+
+def test_group_commit_stop_flushes(app):
+    """
+    GIVEN a GroupCommitWriter with queued statements
+    WHEN the writer is stopped
+    THEN every queued statement is committed first
+    """
+    writer = app.extensions['group_commit_writer']
+    futures = [
+        writer.submit("INSERT INTO document (filename, plaintiff, defendants) VALUES (?, ?, ?)", ('A.xml', '', ''))
+        for i in range(5)
+    ]
+    writer.stop()
+
+    assert [future.result(timeout=0) for future in futures] == [1, 2, 3, 4, 5]